@@ -1,11 +1,17 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 import re
 from contextlib import contextmanager
+import ctypes
 import errno
+import fcntl
 import itertools
+import mmap
 import os
 import stat
+import struct
 import tempfile
+import threading
+import time
 from typing import Optional
 
 from curtin import util
@@ -19,6 +25,26 @@ from curtin import storage_config
 
 SECTOR_SIZE_BYTES = 512
 
+# block device ioctls from linux/fs.h, each takes a uint64_t[2] range of
+# (offset, length) in bytes
+BLKDISCARD = 0x1277
+BLKSECDISCARD = 0x127d
+BLKZEROOUT = 0x127f
+
+# fallocate(2) modes from linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+FALLOC_FL_ZERO_RANGE = 0x10
+
+# Range handed to a single ioctl or fallocate call when zeroing or
+# discarding, so a wipe of a large device reports progress as it goes.
+WIPE_CHUNK_BYTES = 1 << 30
+
+# errnos indicating a device or filesystem does not support an offloaded
+# zero or discard operation
+_WIPE_UNSUPPORTED_ERRNOS = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+                            errno.ENOSYS)
+
 
 def get_dev_name_entry(devname):
     """
@@ -1159,22 +1185,200 @@ def exclusive_open(path, exclusive=True):
             yield fo
 
 
+_ZERO_BUFFER = None
+_ZERO_BUFFER_LOCK = threading.Lock()
+
+
+def _zero_buffer(buflen):
+    """Return a page aligned buffer of buflen zero bytes.
+
+    The buffer is an anonymous mapping shared by all callers, which keeps
+    it suitable for O_DIRECT writes and avoids allocating a new one for
+    every wipe.  It is only ever replaced by a larger one, and a view
+    handed out earlier keeps the mapping it was taken from alive, so
+    concurrent wipes can share it.
+    """
+    global _ZERO_BUFFER
+    with _ZERO_BUFFER_LOCK:
+        if _ZERO_BUFFER is None or len(_ZERO_BUFFER) < buflen:
+            _ZERO_BUFFER = mmap.mmap(-1, buflen)
+        return memoryview(_ZERO_BUFFER)[:buflen]
+
+
+_LIBC = ctypes.CDLL(None, use_errno=True)
+# fallocate64 takes 64 bit offsets on 32 bit targets too; libcs whose
+# off_t is always 64 bits only provide fallocate
+_libc_fallocate = getattr(_LIBC, 'fallocate64', None) or _LIBC.fallocate
+_libc_fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+                            ctypes.c_int64]
+_libc_fallocate.restype = ctypes.c_int
+
+
+def _fallocate(fd, mode, offset, length):
+    ret = _libc_fallocate(fd, mode, offset, length)
+    if ret != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def _blkdev_range_ioctl(fd, request, offset, length):
+    fcntl.ioctl(fd, request, struct.pack('QQ', offset, length))
+
+
+def _set_direct_io(fd, enable):
+    """Toggle O_DIRECT on fd, returning whether it is now enabled."""
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    if enable:
+        flags |= os.O_DIRECT
+    else:
+        flags &= ~os.O_DIRECT
+    try:
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+    except OSError as e:
+        LOG.debug('Unable to set O_DIRECT=%s: %s', enable, e)
+        return False
+    return enable
+
+
+def _apply_range(path, fd, size, func, name):
+    """Call func(fd, offset, length) over [0, size) in chunks."""
+    offset = 0
+    while offset < size:
+        length = min(WIPE_CHUNK_BYTES, size - offset)
+        func(fd, offset, length)
+        offset += length
+        LOG.debug('%s %s: %s/%s bytes', name, path, offset, size)
+
+
+def _try_offload(path, fd, size, methods):
+    """Apply the first supported of methods, a list of (name, func)
+    pairs, over the whole of fd.  Returns the name used or None."""
+    for name, func in methods:
+        try:
+            _apply_range(path, fd, size, func, name)
+        except OSError as e:
+            if e.errno not in _WIPE_UNSUPPORTED_ERRNOS:
+                raise
+            LOG.debug('%s not supported on %s: %s', name, path, e)
+            continue
+        return name
+    return None
+
+
+def _write_zeros(fd, size, buflen):
+    """Write size bytes of zeros to fd, bypassing the page cache when
+    the underlying device or filesystem allows it."""
+    buf = _zero_buffer(buflen)
+    direct = _set_direct_io(fd, True)
+    pos = 0
+    while pos < size:
+        count = min(buflen, size - pos)
+        try:
+            pos += os.pwrite(fd, buf[:count], pos)
+        except OSError as e:
+            # an unaligned tail cannot be written with O_DIRECT
+            if direct and e.errno == errno.EINVAL:
+                direct = _set_direct_io(fd, False)
+                continue
+            raise
+    if not direct:
+        os.fsync(fd)
+
+
+def _log_wipe_rate(path, method, size, elapsed):
+    rate = size / elapsed if elapsed > 0 else float(size)
+    LOG.info('wiped %s (%s bytes) using %s in %.3fs (%.1f MiB/s)',
+             path, size, method, elapsed, rate / (1 << 20))
+
+
+def zero_device(path, buflen=4 * 1024 * 1024, offload=True, exclusive=True):
+    """
+    Write zeros over the whole of the block device or file at path.
+
+    If offload is True the zeroing is first attempted with the BLKZEROOUT
+    ioctl for block devices, or fallocate(2) for regular files, which lets
+    the device or filesystem zero the range without transferring any data.
+    Otherwise, or when neither is supported, zeros are written in buflen
+    sized chunks from a shared zero buffer using O_DIRECT if possible.
+
+    Returns the name of the method used.
+    """
+    with exclusive_open(path, exclusive=exclusive) as fp:
+        fd = fp.fileno()
+        size = os.lseek(fd, 0, os.SEEK_END)
+        start = time.monotonic()
+        method = None
+        if offload:
+            if stat.S_ISBLK(os.fstat(fd).st_mode):
+                methods = [
+                    ('BLKZEROOUT', lambda fd, off, length:
+                     _blkdev_range_ioctl(fd, BLKZEROOUT, off, length)),
+                ]
+            else:
+                methods = [
+                    ('fallocate-zero-range', lambda fd, off, length:
+                     _fallocate(fd, FALLOC_FL_ZERO_RANGE, off, length)),
+                    ('fallocate-punch-hole', lambda fd, off, length:
+                     _fallocate(fd, FALLOC_FL_PUNCH_HOLE |
+                                FALLOC_FL_KEEP_SIZE, off, length)),
+                ]
+            method = _try_offload(path, fd, size, methods)
+        if method is None:
+            _write_zeros(fd, size, buflen)
+            method = 'write'
+        _log_wipe_rate(path, method, size, time.monotonic() - start)
+    return method
+
+
+def discard_device(path, secure=False, exclusive=True):
+    """
+    Discard every block of the block device or file at path.
+
+    Block devices are discarded with BLKDISCARD, or BLKSECDISCARD if
+    secure is True; regular files have their contents punched out.
+
+    Returns the name of the method used or None if discarding is not
+    supported for path.
+    """
+    with exclusive_open(path, exclusive=exclusive) as fp:
+        fd = fp.fileno()
+        size = os.lseek(fd, 0, os.SEEK_END)
+        start = time.monotonic()
+        if stat.S_ISBLK(os.fstat(fd).st_mode):
+            request = BLKSECDISCARD if secure else BLKDISCARD
+            name = 'BLKSECDISCARD' if secure else 'BLKDISCARD'
+            methods = [
+                (name, lambda fd, off, length:
+                 _blkdev_range_ioctl(fd, request, off, length)),
+            ]
+        else:
+            methods = [
+                ('fallocate-punch-hole', lambda fd, off, length:
+                 _fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                            off, length)),
+            ]
+        method = _try_offload(path, fd, size, methods)
+        if method is not None:
+            _log_wipe_rate(path, method, size, time.monotonic() - start)
+    return method
+
+
 def wipe_file(path, reader=None, buflen=4 * 1024 * 1024, exclusive=True):
     """
     wipe the existing file at path.
     if reader is provided, it will be called as a 'reader(buflen)'
-    to provide data for each write.  Otherwise, zeros are used.
+    to provide data for each write.  Otherwise, zeros are written with
+    zero_device.
     writes will be done in size of buflen.
     """
-    if reader:
-        readfunc = reader
-    else:
-        buf = buflen * b'\0'
-
-        def readfunc(size):
-            return buf
-
     size = util.file_size(path)
+    if not reader:
+        LOG.debug("%s is %s bytes. zeroing with buflen=%s",
+                  path, size, buflen)
+        zero_device(path, buflen=buflen, offload=False, exclusive=exclusive)
+        return
+
+    readfunc = reader
     LOG.debug("%s is %s bytes. wiping with buflen=%s",
               path, size, buflen)
 
@@ -1287,6 +1491,11 @@ def wipe_volume(path, mode="superblock", exclusive=True):
     :param mode: how to wipe it.
        pvremove: wipe a lvm physical volume
        zero: write zeros to the entire volume
+       zeroout: zero the entire volume, letting the device do it
+                (BLKZEROOUT) where supported
+       discard: discard the entire volume (BLKDISCARD) and zero the
+                beginning and the end, or zero it all if discard is not
+                supported
        random: write random data (/dev/urandom) to the entire volume
        superblock: zero the beginning and the end of the volume
        superblock-recursive: zero the beginning of the volume, the end of the
@@ -1306,6 +1515,16 @@ def wipe_volume(path, mode="superblock", exclusive=True):
         lvm.lvm_scan()
     elif mode == "zero":
         wipe_file(path, exclusive=exclusive)
+    elif mode == "zeroout":
+        zero_device(path, exclusive=exclusive)
+    elif mode == "discard":
+        if discard_device(path, exclusive=exclusive) is None:
+            LOG.debug('discard not supported on %s, zeroing instead', path)
+            zero_device(path, exclusive=exclusive)
+        else:
+            # discarded blocks are not guaranteed to read back as zeros,
+            # make sure no old signatures can be found
+            quick_zero(path, partitions=False, exclusive=exclusive)
     elif mode == "random":
         with open("/dev/urandom", "rb") as reader:
             wipe_file(path, reader=reader.read, exclusive=exclusive)
@@ -394,7 +394,7 @@ def ensure_bcache_is_registered(bcache_device, expected, retry=None):
         LOG.debug('check just created bcache %s if it is registered,'
                   ' try=%s', bcache_device, attempt + 1)
         try:
-            udevadm_settle()
+            udevadm_settle(exists=expected)
             if os.path.exists(expected):
                 LOG.debug('Found bcache dev %s at expected path %s',
                           bcache_device, expected)
@@ -6,8 +6,12 @@ top of a block device, making it possible to reuse the block device without
 having to reboot the system
 """
 
+from collections import OrderedDict
+from concurrent import futures
+import errno
 import glob
 import os
+import threading
 import time
 
 from curtin import (block, udev, util)
@@ -18,6 +22,7 @@ from curtin.block import mdadm
 from curtin.block import multipath
 from curtin.block import zfs
 from curtin.log import LOG
+from curtin.reporter import events
 
 # poll frequenty, but wait up to 60 seconds total
 MDADM_RELEASE_RETRIES = [0.4] * 150
@@ -239,6 +244,9 @@ def shutdown_mdadm(device):
         raise
 
 
+_SHARED_LAYER_LOCK = threading.Lock()
+
+
 def wipe_superblock(device):
     """
     Wrapper for block.wipe_volume compatible with shutdown function interface
@@ -273,51 +281,58 @@ def wipe_superblock(device):
     # gather any partitions
     partitions = block.get_sysfs_partitions(device)
 
-    # release zfs member by exporting the pool
-    if zfs.zfs_supported() and block.is_zfs_member(blockdev):
-        poolname = zfs.device_to_poolname(blockdev)
-        # only export pools that have been imported
-        if poolname in zfs.zpool_list():
-            try:
-                zfs.zpool_export(poolname)
-            except util.ProcessExecutionError as e:
-                LOG.warning('Failed to export zpool "%s": %s', poolname, e)
-
-    if is_swap_device(blockdev):
-        shutdown_swap(blockdev)
-
-    # some volumes will be claimed by the bcache layer but do not surface
-    # an actual /dev/bcacheN device which owns the parts (backing, cache)
-    # The result is that some volumes cannot be wiped while bcache claims
-    # the device.  Resolve this by stopping bcache layer on those volumes
-    # if present.
-    for bcache_path in ['bcache', 'bcache/set']:
-        stop_path = os.path.join(device, bcache_path)
-        if os.path.exists(stop_path):
-            LOG.debug('Attempting to release bcache layer from device: %s:%s',
-                      device, stop_path)
-            if stop_path.endswith('set'):
-                rp = os.path.realpath(stop_path)
-                bcache.stop_cacheset(rp)
-            else:
-                bcache._stop_device(stop_path)
-
-    # the blockdev (e.g. /dev/sda2) may be a multipath partition which can
-    # only be wiped via its device mapper device (e.g. /dev/dm-4)
-    # check for this and determine the correct device mapper value to use.
-    if multipath.multipath_supported():
-        # handle /dev/mapper/mpatha , base mp device
-        if multipath.is_mpath_device(blockdev):
-            # if mpath device has "partitions" those need to be removed.
-            # clear-holders will have already wiped these devices as they
-            # are higher up in the dependency tree.
-            mpath_id = multipath.find_mpath_id(blockdev)
-            for mp_part_id in multipath.find_mpath_partitions(mpath_id):
-                multipath.remove_partition(mp_part_id)
-        # handle /dev/sdX which are held by multipath layer
-        if multipath.is_mpath_member(blockdev):
-            LOG.debug('Skipping multipath partition path member: %s', blockdev)
-            return
+    # exporting a zpool, stopping a bcache cache set and removing multipath
+    # partitions act on layers shared between disks, so they run one disk
+    # at a time even when clear_holders wipes several disks concurrently
+    with _SHARED_LAYER_LOCK:
+        # release zfs member by exporting the pool
+        if zfs.zfs_supported() and block.is_zfs_member(blockdev):
+            poolname = zfs.device_to_poolname(blockdev)
+            # only export pools that have been imported
+            if poolname in zfs.zpool_list():
+                try:
+                    zfs.zpool_export(poolname)
+                except util.ProcessExecutionError as e:
+                    LOG.warning('Failed to export zpool "%s": %s',
+                                poolname, e)
+
+        if is_swap_device(blockdev):
+            shutdown_swap(blockdev)
+
+        # some volumes will be claimed by the bcache layer but do not surface
+        # an actual /dev/bcacheN device which owns the parts (backing, cache)
+        # The result is that some volumes cannot be wiped while bcache claims
+        # the device.  Resolve this by stopping bcache layer on those volumes
+        # if present.
+        for bcache_path in ['bcache', 'bcache/set']:
+            stop_path = os.path.join(device, bcache_path)
+            if os.path.exists(stop_path):
+                LOG.debug('Attempting to release bcache layer from device:'
+                          ' %s:%s', device, stop_path)
+                if stop_path.endswith('set'):
+                    rp = os.path.realpath(stop_path)
+                    bcache.stop_cacheset(rp)
+                else:
+                    bcache._stop_device(stop_path)
+
+        # the blockdev (e.g. /dev/sda2) may be a multipath partition which
+        # can only be wiped via its device mapper device (e.g. /dev/dm-4)
+        # check for this and determine the correct device mapper value to
+        # use.
+        if multipath.multipath_supported():
+            # handle /dev/mapper/mpatha , base mp device
+            if multipath.is_mpath_device(blockdev):
+                # if mpath device has "partitions" those need to be
+                # removed.  clear-holders will have already wiped these
+                # devices as they are higher up in the dependency tree.
+                mpath_id = multipath.find_mpath_id(blockdev)
+                for mp_part_id in multipath.find_mpath_partitions(mpath_id):
+                    multipath.remove_partition(mp_part_id)
+            # handle /dev/sdX which are held by multipath layer
+            if multipath.is_mpath_member(blockdev):
+                LOG.debug('Skipping multipath partition path member: %s',
+                          blockdev)
+                return
 
     _wipe_superblock(blockdev)
 
@@ -442,10 +457,129 @@ def get_holders(device):
     return holders
 
 
-def gen_holders_tree(device):
+class HoldersSnapshot(object):
+    """
+    A single read of the block device graph in sysfs.
+
+    On first use the holders, partitions and device mapper uuid of every
+    device in /sys/class/block are read into memory.  Holder trees for any
+    number of devices can then be generated without walking sysfs again or
+    running dmsetup and udevadm for each device, as the identify functions
+    do.
+    """
+
+    def __init__(self, sysfs_root='/sys/class/block'):
+        self.sysfs_root = sysfs_root
+        self._devices = None
+
+    @property
+    def devices(self):
+        if self._devices is None:
+            self.refresh()
+        return self._devices
+
+    def refresh(self):
+        """
+        (re)read the block device graph from sysfs
+        """
+        devices = {}
+        for kname in os.listdir(self.sysfs_root):
+            devpath = os.path.join(self.sysfs_root, kname)
+            try:
+                holders = os.listdir(os.path.join(devpath, 'holders'))
+            except OSError:
+                # the device went away while reading
+                continue
+            dm_uuid = None
+            uuid_file = os.path.join(devpath, 'dm', 'uuid')
+            if os.path.exists(uuid_file):
+                dm_uuid = util.load_file(uuid_file).strip()
+            devices[kname] = {
+                'holders': sorted(holders),
+                'partition': os.path.exists(
+                    os.path.join(devpath, 'partition')),
+                'partitions': [],
+                'realpath': os.path.realpath(devpath),
+                'dm_uuid': dm_uuid,
+            }
+
+        # partitions live in a subdirectory of their disk in /sys/devices
+        by_realpath = {info['realpath']: kname
+                       for kname, info in devices.items()}
+        for kname in sorted(devices):
+            info = devices[kname]
+            if not info['partition']:
+                continue
+            parent = by_realpath.get(os.path.dirname(info['realpath']))
+            if parent:
+                devices[parent]['partitions'].append(kname)
+
+        LOG.debug('Read %s block devices from %s',
+                  len(devices), self.sysfs_root)
+        self._devices = devices
+
+    def dev_type(self, kname):
+        """
+        identify the type of a device in the snapshot, following the same
+        rules as the 'ident' functions in DEV_TYPES
+        """
+        info = self.devices[kname]
+        dm_uuid = info['dm_uuid'] or ''
+        # multipath partitions are dm devices created by kpartx, which
+        # gives them a dm uuid of 'partN-mpath-<wwid>'
+        partition = info['partition'] or (
+            kname.startswith('dm') and dm_uuid.startswith('part') and
+            '-mpath-' in dm_uuid)
+        if partition:
+            return 'partition'
+        if kname.startswith('dm') and dm_uuid.startswith('LVM'):
+            return 'lvm'
+        if kname.startswith('dm') and dm_uuid.startswith('CRYPT'):
+            return 'crypt'
+        if kname.startswith('md'):
+            return 'raid'
+        if kname.startswith('bcache'):
+            return 'bcache'
+        return DEFAULT_DEV_TYPE
+
+    def holders_tree(self, device):
+        """
+        generate the holders tree for device, see gen_holders_tree
+        """
+        kname = block.path_to_kname(device)
+        if kname not in self.devices:
+            # the device may have appeared after the snapshot was taken
+            self.refresh()
+        if kname not in self.devices:
+            err = OSError("devname '{}' did not have existing syspath "
+                          "'{}'".format(device, os.path.join(self.sysfs_root,
+                                                             kname)))
+            err.errno = errno.ENOENT
+            raise err
+        return self._tree(kname)
+
+    def _tree(self, kname):
+        info = self.devices[kname]
+        # as with gen_holders_tree, holders are the devices in the holders/
+        # dir and any partitions on the device
+        holders = [h for h in info['holders'] + info['partitions']
+                   if h in self.devices]
+        return {
+            'device': os.path.join(self.sysfs_root, kname),
+            'dev_type': self.dev_type(kname), 'name': kname,
+            'holders': [self._tree(h) for h in holders],
+        }
+
+
+def gen_holders_tree(device, snapshot=None):
     """
     generate a tree representing the current storage hierarchy above 'device'
+
+    If snapshot, a HoldersSnapshot, is provided the tree is generated from
+    it rather than by walking sysfs and identifying each device.
     """
+    if snapshot is not None:
+        return snapshot.holders_tree(device)
     device = block.sys_block_path(device)
     dev_name = block.path_to_kname(device)
     # the holders for a device should consist of the devices in the holders/
@@ -603,7 +737,8 @@ def assert_clear(base_paths):
         base_paths = [base_paths]
     base_paths = [block.sys_block_path(path, strict=False)
                   for path in base_paths]
-    for holders_tree in [gen_holders_tree(p)
+    snapshot = HoldersSnapshot()
+    for holders_tree in [gen_holders_tree(p, snapshot=snapshot)
                          for p in base_paths if os.path.exists(p)]:
         if any(holder_type not in valid and path not in base_paths
                for (holder_type, path) in get_holder_types(holders_tree)):
@@ -611,12 +746,87 @@ def assert_clear(base_paths):
                           .format(format_holders_tree(holders_tree)))
 
 
-def clear_holders(base_paths, try_preserve=False):
+def _get_holder_disk(dev_info):
+    """
+    return the sysfs path of the disk a disk or partition from a shutdown
+    plan lives on
+    """
+    device = dev_info['device']
+    if dev_info['dev_type'] == 'partition':
+        if os.path.exists(os.path.join(device, 'partition')):
+            return os.path.dirname(os.path.realpath(device))
+        # multipath partitions are device mapper devices on top of the map
+        slaves = sorted(glob.glob(os.path.join(device, 'slaves', '*')))
+        if slaves:
+            return os.path.realpath(slaves[0])
+    return os.path.realpath(device)
+
+
+def _run_shutdown(dev_info, shutdown_function, report_stack=None):
+    """
+    run shutdown_function on the device in dev_info if it is still present,
+    reporting an event for the device if report_stack is provided
+    """
+    if not os.path.exists(dev_info['device']):
+        return
+    LOG.info("shutdown running on holder type: '%s' syspath: '%s'",
+             dev_info['dev_type'], dev_info['device'])
+    if report_stack is None:
+        shutdown_function(dev_info['device'])
+        return
+    kname = block.path_to_kname(dev_info['device'])
+    with events.ReportEventStack(
+            name=kname, parent=report_stack, level='DEBUG',
+            description="shutting down %s %s" % (
+                dev_info['dev_type'], kname)):
+        shutdown_function(dev_info['device'])
+
+
+def _run_shutdown_batch(batch, workers, report_stack=None):
+    """
+    run a batch of shutdown steps that may proceed concurrently for
+    different disks.  steps for the same disk run in plan order.
+    """
+    def run_steps(steps):
+        for dev_info, shutdown_function in steps:
+            _run_shutdown(dev_info, shutdown_function, report_stack)
+
+    if workers <= 1:
+        run_steps(batch)
+        return
+
+    by_disk = OrderedDict()
+    for dev_info, shutdown_function in batch:
+        by_disk.setdefault(_get_holder_disk(dev_info), []).append(
+            (dev_info, shutdown_function))
+    if len(by_disk) <= 1:
+        run_steps(batch)
+        return
+
+    LOG.debug('Running shutdown on %s disks with %s workers',
+              len(by_disk), workers)
+    with futures.ThreadPoolExecutor(
+            max_workers=min(workers, len(by_disk))) as executor:
+        pending = [executor.submit(run_steps, steps)
+                   for steps in by_disk.values()]
+    for future in pending:
+        # raise the first error, after every disk had its chance to finish
+        future.result()
+
+
+def clear_holders(base_paths, try_preserve=False, workers=1,
+                  report_stack=None):
     """
     Clear all storage layers depending on the devices specified in 'base_paths'
     A single device or list of devices can be specified.
     Device paths can be specified either as paths in /dev or /sys/block
     Will throw OSError if any holders could not be shut down
+
+    If workers is greater than 1, consecutive wipes of disks and partitions
+    in the shutdown plan run concurrently on up to that many disks at once.
+    Other holders (raid, lvm, crypt, bcache) are always shut down one at a
+    time in plan order.  If report_stack is provided, a reporting event is
+    emitted under it for each device shut down.
     """
     # handle single path
     if not isinstance(base_paths, (list, tuple)):
@@ -624,13 +834,16 @@ def clear_holders(base_paths, try_preserve=False):
     LOG.info('Generating device storage trees for path(s): %s', base_paths)
 
     # get current holders and plan how to shut them down
-    holder_trees = [gen_holders_tree(path) for path in base_paths]
+    snapshot = HoldersSnapshot()
+    holder_trees = [gen_holders_tree(path, snapshot=snapshot)
+                    for path in base_paths]
     LOG.info('Current device storage tree:\n%s',
              '\n'.join(format_holders_tree(tree) for tree in holder_trees))
     ordered_devs = plan_shutdown_holder_trees(holder_trees)
     LOG.info('Shutdown Plan:\n%s', "\n".join(map(str, ordered_devs)))
 
     # run shutdown functions
+    batch = []
     for dev_info in ordered_devs:
         dev_type = DEV_TYPES.get(dev_info['dev_type'])
         shutdown_function = dev_type.get('shutdown')
@@ -643,10 +856,15 @@ def clear_holders(base_paths, try_preserve=False):
                      dev_info['dev_type'])
             continue
 
-        if os.path.exists(dev_info['device']):
-            LOG.info("shutdown running on holder type: '%s' syspath: '%s'",
-                     dev_info['dev_type'], dev_info['device'])
-            shutdown_function(dev_info['device'])
+        if shutdown_function in CONCURRENT_SHUTDOWN_HANDLERS:
+            batch.append((dev_info, shutdown_function))
+            continue
+
+        _run_shutdown_batch(batch, workers, report_stack)
+        batch = []
+        _run_shutdown(dev_info, shutdown_function, report_stack)
+
+    _run_shutdown_batch(batch, workers, report_stack)
 
 
 def start_clear_holders_deps():
@@ -729,6 +947,9 @@ def start_clear_holders_deps():
 DEFAULT_DEV_TYPE = 'disk'
 # handlers that should not be run if an attempt is being made to preserve data
 DATA_DESTROYING_HANDLERS = [wipe_superblock]
+# handlers which may run for different disks at the same time; they must
+# hold _SHARED_LAYER_LOCK while acting on anything other than their device
+CONCURRENT_SHUTDOWN_HANDLERS = [wipe_superblock]
 # types of devices that could be encountered by clear holders and functions to
 # identify them and shut them down
 DEV_TYPES = _define_handlers_registry()
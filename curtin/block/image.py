@@ -0,0 +1,592 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""
+Stream disk images on to block devices.
+
+Images are fetched from a local file or url, decompressed by a pipeline of
+external commands (preferring multithreaded implementations when they are
+installed) and written to the device in large, aligned chunks that bypass
+the page cache where possible.
+"""
+
+import errno
+import hashlib
+import json
+import mmap
+import os
+import signal
+import stat
+import subprocess
+import threading
+import time
+
+from curtin import url_helper, util
+from curtin.block import (
+    BLKZEROOUT, FALLOC_FL_KEEP_SIZE, FALLOC_FL_PUNCH_HOLE,
+    _WIPE_UNSUPPORTED_ERRNOS, _blkdev_range_ioctl, _fallocate,
+    _set_direct_io, _zero_buffer)
+from curtin.log import LOG
+from curtin.reporter import events
+
+IMAGE_WRITE_BUFLEN = 8 * 1024 * 1024
+IMAGE_FETCH_BUFLEN = 1024 * 1024
+IMAGE_FETCH_RETRIES = 3
+IMAGE_FETCH_RETRY_DELAY = 3
+IMAGE_PROGRESS_INTERVAL = 10
+# how long to wait for the thread feeding a decompression pipeline once
+# the pipeline has finished
+IMAGE_FEED_TIMEOUT = 30
+DIRECT_IO_ALIGN = 4096
+
+# zero blocks of the image are not written in a sparse mode: 'skip' leaves
+# them alone, which is only correct when the target already reads back
+# zeros, and 'zeroout' zeroes them with BLKZEROOUT (or by punching a hole
+# in a regular file) which costs no data transfer on most devices
+SPARSE_MODES = (None, 'skip', 'zeroout')
+SPARSE_BLOCK = 1024 * 1024
+
+# each pipeline stage is a list of candidate commands, the first one that
+# is installed is used, falling back to the last one
+_GZIP = [['pigz', '-dc'], ['gzip', '-dc']]
+_XZ = [['xz', '-dc', '-T0']]
+_BZIP2 = [['lbzip2', '-dc'], ['pbzip2', '-dc'], ['bzip2', '-dc']]
+_TAR = [['tar', '-xOf', '-']]
+
+DECOMPRESS_PIPELINES = {
+    'dd-tgz': [_GZIP, _TAR],
+    'dd-txz': [_XZ, _TAR],
+    'dd-tbz': [_BZIP2, _TAR],
+    'dd-tar': [[['smtar', '-xOf', '-']]],
+    'dd-bz2': [_BZIP2],
+    'dd-gz': [_GZIP],
+    'dd-xz': [_XZ],
+    'dd-raw': [],
+    # fsimage sources are uncompressed filesystem images
+    'fsimage': [],
+}
+
+# sources written to a volume by block-meta, skipped by extract
+BLOCK_DEPLOYED_FILE = 'block-deployed-sources.json'
+
+# ext feature flags that ext3 does not know about, from blkid
+_EXT3_INCOMPAT = 0x0002 | 0x0004 | 0x0010
+_EXT3_RO_COMPAT = 0x0001 | 0x0002 | 0x0004
+_EXT_HAS_JOURNAL = 0x0004
+
+
+def _select_command(candidates):
+    for cmd in candidates:
+        if util.which(cmd[0]):
+            return cmd
+    return candidates[-1]
+
+
+def decompress_commands(image_type):
+    """
+    return the list of commands to pipe an image of image_type through
+    to get the raw disk image
+    """
+    if image_type not in DECOMPRESS_PIPELINES:
+        raise ValueError('Unsupported image type: %s' % image_type)
+    return [_select_command(stage)
+            for stage in DECOMPRESS_PIPELINES[image_type]]
+
+
+class ImageSource(object):
+    """Read an image from a local path or url.
+
+    Reads from a url that fail with a connection or server error are resumed
+    from the current offset with a range request, up to retries times, as
+    long as the content at the url has not changed."""
+
+    def __init__(self, uri, retries=IMAGE_FETCH_RETRIES,
+                 retry_delay=IMAGE_FETCH_RETRY_DELAY):
+        self.uri = uri
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.offset = 0
+        self._fp = None
+        self._validator = None
+        if uri.startswith('file://'):
+            self.path = uri[len('file://'):]
+        elif '://' not in uri:
+            self.path = uri
+        else:
+            self.path = None
+        self._open()
+
+    def _open(self):
+        if self.path is not None:
+            self._fp = open(self.path, 'rb')
+            self._fp.seek(self.offset)
+        elif self.offset:
+            # only resume from the content that was being read
+            self._fp = url_helper.UrlReader(self.uri, offset=self.offset,
+                                            validator=self._validator)
+        else:
+            self._fp = url_helper.UrlReader(self.uri)
+            self._validator = url_helper.response_validator(self._fp.info)
+
+    def extents(self):
+        """
+        yield (length, is_data) for the extents of a local image, using
+        SEEK_DATA/SEEK_HOLE to find holes.  For urls, or filesystems that
+        do not report holes, a single data extent of unknown length (None)
+        is yielded.
+        """
+        if self.path is None:
+            yield (None, True)
+            return
+        # a separate fd, as seeking for holes moves the file offset
+        fd = os.open(self.path, os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            size = os.fstat(fd).st_size
+            pos = self.offset
+            while pos < size:
+                try:
+                    data = os.lseek(fd, pos, os.SEEK_DATA)
+                except OSError as e:
+                    if e.errno == errno.ENXIO:
+                        # only a hole remains
+                        data = size
+                    elif e.errno == errno.EINVAL and pos == self.offset:
+                        yield (None, True)
+                        return
+                    else:
+                        raise
+                if data > pos:
+                    yield (data - pos, False)
+                if data >= size:
+                    break
+                hole = os.lseek(fd, data, os.SEEK_HOLE)
+                yield (hole - data, True)
+                pos = hole
+        finally:
+            os.close(fd)
+
+    def skip(self, length):
+        """skip over length bytes of a local image"""
+        self.offset += length
+        self._fp.seek(self.offset)
+
+    def read(self, buflen=IMAGE_FETCH_BUFLEN):
+        attempts = 0
+        while True:
+            try:
+                buf = self._fp.read(buflen)
+                break
+            except url_helper.UrlError as e:
+                if ((e.code is not None and e.code < 500) or
+                        attempts >= self.retries):
+                    raise
+                attempts += 1
+                LOG.warning('Reading %s failed at offset %s: %s. Resuming in'
+                            ' %s seconds.', self.uri, self.offset, e,
+                            self.retry_delay)
+                self.close()
+                time.sleep(self.retry_delay)
+                self._open()
+        self.offset += len(buf)
+        return buf
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, trace):
+        self.close()
+
+
+class ImageWriter(object):
+    """Write a stream to a block device in buflen sized chunks.
+
+    Data is collected in a page aligned buffer, so full chunks can be
+    written with O_DIRECT.  The unaligned tail of the image, or all of it
+    if the device does not support O_DIRECT, goes through the page cache
+    and is flushed on close.
+
+    With a sparse mode from SPARSE_MODES, SPARSE_BLOCK sized blocks of
+    zeros are skipped or zeroed out rather than written."""
+
+    def __init__(self, devpath, buflen=IMAGE_WRITE_BUFLEN, report_name=None,
+                 report_interval=IMAGE_PROGRESS_INTERVAL, sparse=None):
+        if sparse not in SPARSE_MODES:
+            raise ValueError('Invalid sparse mode: %s' % sparse)
+        if sparse and buflen % SPARSE_BLOCK:
+            raise ValueError('buflen must be a multiple of %s' % SPARSE_BLOCK)
+        self.devpath = devpath
+        self.buflen = buflen
+        self.report_name = report_name
+        self.report_interval = report_interval
+        self.sparse = sparse
+        # written is the offset in the image reached, skipped how much of
+        # it was zeros that were not written
+        self.written = 0
+        self.skipped = 0
+        self._buf = mmap.mmap(-1, buflen)
+        self._view = memoryview(self._buf)
+        self._fill = 0
+        self._fd = os.open(devpath, os.O_WRONLY | os.O_CLOEXEC)
+        self._blockdev = stat.S_ISBLK(os.fstat(self._fd).st_mode)
+        self._can_zeroout = True
+        self._zeros = bytes(SPARSE_BLOCK) if sparse else None
+        self._direct = _set_direct_io(self._fd, True)
+        self._start = time.monotonic()
+        self._last_report = self._start
+
+    def write(self, data):
+        data = memoryview(data)
+        while len(data):
+            count = min(len(data), self.buflen - self._fill)
+            self._view[self._fill:self._fill + count] = data[:count]
+            self._fill += count
+            data = data[count:]
+            if self._fill == self.buflen:
+                self._flush()
+
+    def readfrom(self, fp):
+        """read from fp directly into the write buffer, returning the
+        number of bytes read, 0 at the end of fp"""
+        count = fp.readinto(self._view[self._fill:])
+        if not count:
+            return 0
+        self._fill += count
+        if self._fill == self.buflen:
+            self._flush()
+        return count
+
+    def _pwrite(self, view):
+        while len(view):
+            try:
+                count = os.pwrite(self._fd, view, self.written)
+            except OSError as e:
+                if self._direct and e.errno == errno.EINVAL:
+                    self._direct = _set_direct_io(self._fd, False)
+                    continue
+                raise
+            self.written += count
+            view = view[count:]
+
+    def _write_data(self, start, end):
+        if self._direct:
+            aligned = end - (end - start) % DIRECT_IO_ALIGN
+            self._pwrite(self._view[start:aligned])
+            if aligned < end:
+                self._direct = _set_direct_io(self._fd, False)
+                self._pwrite(self._view[aligned:end])
+        else:
+            self._pwrite(self._view[start:end])
+
+    def _zeroout(self, length):
+        if not self._can_zeroout:
+            return False
+        try:
+            if self._blockdev:
+                _blkdev_range_ioctl(self._fd, BLKZEROOUT, self.written, length)
+            else:
+                _fallocate(self._fd,
+                           FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                           self.written, length)
+        except OSError as e:
+            if e.errno not in _WIPE_UNSUPPORTED_ERRNOS:
+                raise
+            LOG.debug('Unable to zero out ranges of %s: %s, writing zeros',
+                      self.devpath, e)
+            self._can_zeroout = False
+            return False
+        return True
+
+    def _zero(self, length):
+        if self.sparse == 'zeroout' and not self._zeroout(length):
+            while length:
+                count = min(length, self.buflen)
+                self._pwrite(_zero_buffer(count))
+                length -= count
+            return
+        self.written += length
+        self.skipped += length
+
+    def _flush_sparse(self, length):
+        start = 0
+        for pos in range(0, length - length % SPARSE_BLOCK, SPARSE_BLOCK):
+            # slicing the mmap copies, but comparing bytes is much faster
+            # than comparing memoryviews
+            if self._buf[pos:pos + SPARSE_BLOCK] != self._zeros:
+                continue
+            if start < pos:
+                self._write_data(start, pos)
+            self._zero(SPARSE_BLOCK)
+            start = pos + SPARSE_BLOCK
+        if start < length:
+            self._write_data(start, length)
+
+    def _flush(self):
+        if self.sparse:
+            self._flush_sparse(self._fill)
+        else:
+            self._write_data(0, self._fill)
+        self._fill = 0
+        self._report_progress()
+
+    def skip(self, length):
+        """advance over length bytes of zeros in the image, which must be
+        written in a sparse mode"""
+        if not self.sparse:
+            raise ValueError('skip requires a sparse mode')
+        if self._fill:
+            self._flush()
+        self._zero(length)
+
+    def rate(self):
+        elapsed = time.monotonic() - self._start
+        return self.written / elapsed if elapsed > 0 else float(self.written)
+
+    def _report_progress(self):
+        now = time.monotonic()
+        if not self.report_name or now - self._last_report < (
+                self.report_interval):
+            return
+        self._last_report = now
+        events.report_progress_event(
+            self.report_name, 'wrote %s bytes to %s (%.1f MiB/s)' % (
+                self.written, self.devpath, self.rate() / (1 << 20)),
+            level='DEBUG')
+
+    def close(self):
+        if self._fd is None:
+            return
+        try:
+            if self._fill:
+                self._flush()
+            if (self.sparse and not self._blockdev and
+                    os.fstat(self._fd).st_size < self.written):
+                # skipped zeros at the end of the image leave a file short
+                os.ftruncate(self._fd, self.written)
+            os.fsync(self._fd)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+            self._view.release()
+            self._buf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, trace):
+        self.close()
+
+
+def _feed(source, stdin, digest, errors):
+    try:
+        while True:
+            buf = source.read()
+            if not buf:
+                break
+            if digest:
+                digest.update(buf)
+            stdin.write(buf)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        try:
+            stdin.close()
+        except OSError:
+            pass
+
+
+def _start_pipeline(commands):
+    procs = []
+    stdin = subprocess.PIPE
+    for cmd in commands:
+        proc = subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE)
+        if procs:
+            # only the next process in the pipeline may hold the pipe
+            procs[-1].stdout.close()
+        procs.append(proc)
+        stdin = proc.stdout
+    return procs
+
+
+def _failed_command(commands, procs):
+    """Return (cmd, returncode) of the command that failed a finished
+    pipeline, or None.
+
+    A command killed by SIGPIPE only failed because a command after it
+    exited before reading all of its output, which is fine when the last
+    command succeeded, so it is never the one reported."""
+    failed = [(cmd, proc.returncode) for cmd, proc in zip(commands, procs)
+              if proc.returncode != 0 and
+              (proc is procs[-1] or proc.returncode != -signal.SIGPIPE)]
+    if failed:
+        return failed[0]
+    return None
+
+
+def _write_local_extents(src, writer, digest):
+    for length, data in src.extents():
+        if not data:
+            src.skip(length)
+            writer.skip(length)
+            if digest:
+                # holes read as zeros, so they are part of the checksum
+                while length:
+                    count = min(length, SPARSE_BLOCK)
+                    digest.update(_zero_buffer(count))
+                    length -= count
+            continue
+        while length is None or length > 0:
+            buf = src.read(IMAGE_FETCH_BUFLEN if length is None
+                           else min(length, IMAGE_FETCH_BUFLEN))
+            if not buf:
+                break
+            if digest:
+                digest.update(buf)
+            writer.write(buf)
+            if length is not None:
+                length -= len(buf)
+
+
+def probe_fstype(uri):
+    """
+    Return the type of the filesystem image at uri from its superblock:
+    one of 'ext2', 'ext3', 'ext4', 'xfs' or 'squashfs', or None.
+    """
+    with ImageSource(uri) as src:
+        head = b''
+        while len(head) < 2048:
+            buf = src.read(2048 - len(head))
+            if not buf:
+                break
+            head += buf
+    if head[:4] == b'XFSB':
+        return 'xfs'
+    if head[:4] == b'hsqs':
+        return 'squashfs'
+    if head[1080:1082] == b'\x53\xef':
+        compat, incompat, ro_compat = (
+            int.from_bytes(head[o:o + 4], 'little')
+            for o in (1116, 1120, 1124))
+        if incompat & ~_EXT3_INCOMPAT or ro_compat & ~_EXT3_RO_COMPAT:
+            return 'ext4'
+        if compat & _EXT_HAS_JOURNAL:
+            return 'ext3'
+        return 'ext2'
+    return None
+
+
+def source_sparse_mode(source):
+    """Return the sparse mode, one of SPARSE_MODES, that the optional
+    'sparse' key of a dd- source asks for.  It defaults to 'zeroout' and
+    false disables sparse writing."""
+    sparse = source.get('sparse', 'zeroout')
+    if sparse is None or sparse is False:
+        return None
+    if sparse not in SPARSE_MODES:
+        raise ValueError(
+            "Invalid sparse mode %r for source %s, expected 'zeroout', "
+            "'skip' or false" % (sparse, source.get('uri')))
+    return sparse
+
+
+def save_block_deployed(scratch, uris):
+    """Record the uris of sources block-meta wrote to a volume."""
+    with open(os.path.join(scratch, BLOCK_DEPLOYED_FILE), 'w') as fp:
+        json.dump(sorted(uris), fp)
+
+
+def load_block_deployed(scratch):
+    """Return the uris of sources block-meta wrote to a volume."""
+    try:
+        with open(os.path.join(scratch, BLOCK_DEPLOYED_FILE)) as fp:
+            return set(json.load(fp))
+    except FileNotFoundError:
+        return set()
+
+
+def write_image(source, devpath, buflen=IMAGE_WRITE_BUFLEN,
+                report_name='write-image', sparse=None):
+    """
+    Stream the dd- image described by source on to devpath.
+
+    source is a sanitized source dict, with 'type' and 'uri' keys and an
+    optional 'sha256' key holding the checksum of the file at uri, which is
+    verified as the image is fetched.  Progress is reported as events
+    named report_name.  sparse is one of SPARSE_MODES, see ImageWriter;
+    holes in local raw images are then found with SEEK_HOLE rather than
+    read.  Returns the number of bytes written.
+    """
+    commands = decompress_commands(source['type'])
+    expected = source.get('sha256')
+    digest = hashlib.sha256() if expected else None
+    LOG.debug('Writing image %s to %s through %s', source['uri'], devpath,
+              commands)
+
+    with ImageSource(source['uri']) as src, \
+            ImageWriter(devpath, buflen=buflen, report_name=report_name,
+                        sparse=sparse) as writer:
+        if not commands and sparse:
+            _write_local_extents(src, writer, digest)
+        elif not commands:
+            while True:
+                buf = src.read()
+                if not buf:
+                    break
+                if digest:
+                    digest.update(buf)
+                writer.write(buf)
+        else:
+            procs = _start_pipeline(commands)
+            errors = []
+            feeder = threading.Thread(
+                target=_feed, args=(src, procs[0].stdin, digest, errors),
+                daemon=True)
+            feeder.start()
+            try:
+                while writer.readfrom(procs[-1].stdout):
+                    pass
+            except BaseException:
+                for proc in procs:
+                    proc.kill()
+                raise
+            finally:
+                procs[-1].stdout.close()
+                procs[-1].wait()
+                # the feeder can be stuck reading the source, with the
+                # commands upstream waiting on it
+                feeder.join(IMAGE_FEED_TIMEOUT)
+                if feeder.is_alive():
+                    for proc in procs:
+                        proc.kill()
+                for proc in procs:
+                    proc.wait()
+            if feeder.is_alive():
+                raise OSError(errno.ETIMEDOUT,
+                              'Timed out reading image %s' % source['uri'])
+            # a failed command also breaks the pipe the feeder writes to,
+            # so report the command first
+            failed = _failed_command(commands, procs)
+            if failed:
+                cmd, returncode = failed
+                raise util.ProcessExecutionError(
+                    cmd=cmd, exit_code=returncode,
+                    description='Decompressing image %s failed' %
+                    source['uri'])
+            # a command may finish without reading all of its input, which
+            # is not an error when the pipeline succeeded
+            errors = [e for e in errors if not isinstance(e, BrokenPipeError)]
+            if errors:
+                raise errors[0]
+
+    if digest and digest.hexdigest() != expected.lower():
+        raise ValueError('sha256 mismatch for image %s: expected %s got %s' %
+                         (source['uri'], expected, digest.hexdigest()))
+    LOG.info('Wrote %s bytes of image %s to %s (%.1f MiB/s), %s bytes of '
+             'zeros were not written', writer.written, source['uri'],
+             devpath, writer.rate() / (1 << 20), writer.skipped)
+    return writer.written
+
+# vi: ts=4 expandtab syntax=python
@@ -34,8 +34,10 @@ def block_info_main(args):
             res['holders'].append(format_name(holder))
         return res
 
+    snapshot = block.clear_holders.HoldersSnapshot()
     trees = [add_size_to_holders_tree(t) for t in
-             [block.clear_holders.gen_holders_tree(d) for d in args.devices]]
+             [block.clear_holders.gen_holders_tree(d, snapshot=snapshot)
+              for d in args.devices]]
 
     print(util.json_dumps(trees) if args.json else
           '\n'.join(block.clear_holders.format_holders_tree(t) for t in
@@ -1,14 +1,16 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 from collections import OrderedDict, namedtuple
-from curtin import (block, compat, config, paths, storage_actions, util)
+from curtin import (block, compat, config, paths, storage_actions, tracing,
+                    util)
 from curtin.block import schemas
-from curtin.block import (bcache, clear_holders, dasd, iscsi, lvm, mdadm, mkfs,
-                          multipath, zfs)
+from curtin.block import (bcache, clear_holders, dasd, image, iscsi, lvm,
+                          mdadm, mkfs, multipath, zfs)
 from curtin import distro
 from curtin.log import LOG, logged_time
 from curtin.reporter import events
 from curtin.storage_config import (
+    StorageConfigGraph,
     extract_storage_ordered_dict,
     ptable_part_type_to_flag,
     )
@@ -23,6 +25,7 @@ from curtin.udev import (
     udevadm_trigger,
     )
 
+from concurrent import futures
 import glob
 import json
 import os
@@ -31,6 +34,7 @@ import platform
 import string
 import sys
 import tempfile
+import threading
 import time
 
 
@@ -65,6 +69,12 @@ MSDOS_FLAGS = {
     'logical': 'logical',
 }
 
+# Storage action types whose handlers only touch the device they configure
+# and its parents, so actions on independent disks may run concurrently.
+# Every other type (lvm, raid, bcache, dm_crypt, zfs, mount, ...) scans or
+# assembles global state and runs with no other action in flight.
+PARALLEL_ACTION_TYPES = {'disk', 'partition', 'format'}
+
 DNAME_BYID_KEYS = ['DM_UUID', 'ID_WWN_WITH_EXTENSION', 'ID_WWN', 'ID_SERIAL',
                    'ID_SERIAL_SHORT']
 CMD_ARGUMENTS = (
@@ -85,6 +95,9 @@ CMD_ARGUMENTS = (
                    'action': 'store_true', 'default': False}),
      ('--testmode', {'help': 'enable some test actions',
                      'action': 'store_true', 'default': False}),
+     ('--plan', {'help': ('write the storage actions custom mode would run '
+                          'and their cost as json, changing nothing'),
+                 'action': 'store_true', 'default': False}),
      ('mode', {'help': 'meta-mode to use',
                'choices': [CUSTOM, SIMPLE, SIMPLE_BOOT]}),
      )
@@ -94,12 +107,22 @@ CMD_ARGUMENTS = (
 @logged_time("BLOCK_META")
 def block_meta(args):
     # main entry point for the block-meta command.
+    if getattr(args, 'plan', False):
+        # the plan only describes the actions of a custom storage config
+        if args.mode != CUSTOM:
+            raise ValueError('--plan is only supported with mode=%s, not '
+                             'mode=%s' % (CUSTOM, args.mode))
+        from curtin.commands.block_meta_plan import meta_plan
+        return meta_plan(args)
     if args.testmode:
         state = {}
     else:
         state = util.load_command_environment(strict=True)
     cfg = config.load_command_config(args, state)
     dd_images = util.get_dd_images(cfg.get('sources', {}))
+    # reject a bad sparse mode before any device is cleared
+    for source in dd_images:
+        image.source_sparse_mode(source)
 
     # run clear holders on potential devices
     devices = args.devices
@@ -116,7 +139,8 @@ def block_meta(args):
 
     LOG.debug('clearing devices=%s', devices)
     if devices:
-        meta_clear(devices, state.get('report_stack_prefix', ''))
+        meta_clear(devices, state.get('report_stack_prefix', ''),
+                   workers=cfg.get('storage', {}).get('workers', 1))
 
     # dd-images requires use of meta_simple
     if len(dd_images) > 0 and args.force_mode is False:
@@ -146,27 +170,11 @@ def write_image_to_disk(source, dev):
     Write disk image to block device
     """
     LOG.info('writing image to disk %s, %s', source, dev)
-    extractor = {
-        'dd-tgz': '| tar -xOzf -',
-        'dd-txz': '| tar -xOJf -',
-        'dd-tbz': '| tar -xOjf -',
-        'dd-tar': '| smtar -xOf -',
-        'dd-bz2': '| bzcat',
-        'dd-gz': '| zcat',
-        'dd-xz': '| xzcat',
-        'dd-raw': ''
-    }
-    uri = source['uri']
-    if uri.startswith('file://'):
-        uri = uri[len('file://'):]
-        fetch = 'cat "$1"'
-    else:
-        fetch = 'wget "$1" --progress=dot:mega -O - '
     (devname, devnode) = block.get_dev_name_entry(dev)
-    util.subp(args=[
-        'sh', '-c',
-        fetch + extractor[source['type']] + ' | dd bs=4M of="$2"',
-        '--', uri, devnode])
+    # zero blocks in the image are zeroed out on the device rather than
+    # written, unless the source says the device already reads as zeros
+    image.write_image(source, devnode,
+                      sparse=image.source_sparse_mode(source))
     util.subp(['partprobe', devnode])
 
     for i in range(3):
@@ -235,9 +243,15 @@ def get_partition_format_type(cfg, machine=None, uefi_bootable=None):
     return "mbr"
 
 
-def devsync(devpath):
+def devsync(devpath, wait_for=None):
+    # wait_for is the node partprobe of devpath should create, e.g. one of
+    # its partitions.  Without one, settle fully so the remove and change
+    # events for whatever partprobe dropped are processed too.
     util.subp(['partprobe', devpath], rcs=[0, 1])
-    udevadm_settle()
+    if wait_for:
+        udevadm_settle(exists=wait_for)
+    else:
+        udevadm_settle()
     for x in range(0, 10):
         if os.path.exists(devpath):
             LOG.debug('devsync happy - path %s now exists', devpath)
@@ -489,36 +503,101 @@ def v1_get_path_to_disk(vol):
     return volume_path
 
 
-def v2_get_path_to_disk(vol):
-    all_disks = []
-    link2dev = {}
+class BlockDeviceInventory:
+    """Indexes of the udev properties of whole block devices.
 
-    for dev in udev_all_block_device_properties():
-        if 'DM_PART' in dev or 'PARTN' in dev:
-            continue
-        if 'DEVNAME' not in dev:
-            # Some block devices, typically nvme*c*n* devices (e.g., nvme0c0n1)
-            # have no DEVNAME. Skip them to avoid raising a KeyError
-            # (LP: #2095211).
-            continue
-        for link in dev.get('DEVLINKS', '').split():
-            link2dev[link] = dev
-        link2dev[dev['DEVNAME']] = dev
-        all_disks.append(dev)
-
-    def disks_matching(key, value):
-        return [dev for dev in all_disks if key in dev and dev[key] == value]
-
-    def disk_by_path(path):
-        return link2dev[path]
-
-    def disk_by_keys(val, *keys):
-        for key in keys:
-            devs = disks_matching(key, val)
-            if devs:
-                return devs
+    Enumerating every block device through udev is expensive on systems
+    with many disks, so the enumeration is done once and indexed by device
+    node and devlink as well as by the serial and wwn properties used to
+    match disk actions.  Lookups that miss refresh the indexes once, to
+    pick up devices created since they were built, and handlers that
+    create or remove devices call invalidate().
+
+    Resolved storage volume paths are remembered as well.  A path is only
+    remembered once it has been synced, so repeated lookups of the same
+    volume return it without re-resolving parents or running partprobe
+    and udevadm settle again, as long as the device node still exists.
+    """
+
+    INDEXED_KEYS = ('DM_WWN', 'ID_WWN_WITH_EXTENSION', 'ID_WWN',
+                    'DM_SERIAL', 'ID_SERIAL', 'ID_SERIAL_SHORT')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_path = None
+        self._by_key = None
+        self._volume_paths = {}
+
+    def _build(self):
+        by_path = {}
+        by_key = {key: {} for key in self.INDEXED_KEYS}
+        for dev in udev_all_block_device_properties():
+            if 'DM_PART' in dev or 'PARTN' in dev:
+                continue
+            if 'DEVNAME' not in dev:
+                # Some block devices, typically nvme*c*n* devices (e.g.,
+                # nvme0c0n1) have no DEVNAME. Skip them to avoid raising a
+                # KeyError (LP: #2095211).
+                continue
+            for link in dev.get('DEVLINKS', '').split():
+                by_path[link] = dev
+            by_path[dev['DEVNAME']] = dev
+            for key in self.INDEXED_KEYS:
+                if key in dev:
+                    by_key[key].setdefault(dev[key], []).append(dev)
+        LOG.debug('block device inventory: indexed %s paths', len(by_path))
+        self._by_path = by_path
+        self._by_key = by_key
+
+    def _indexes(self, refresh=False):
+        with self._lock:
+            if refresh or self._by_path is None:
+                self._build()
+            return self._by_path, self._by_key
+
+    def invalidate(self):
+        """Drop all indexes, they are rebuilt on the next lookup."""
+        with self._lock:
+            self._by_path = None
+            self._by_key = None
+            self._volume_paths = {}
+
+    def by_path(self, path):
+        """Return the properties of the device at path (a device node or
+        devlink), raising KeyError if there is no such device."""
+        by_path, _ = self._indexes()
+        if path not in by_path:
+            by_path, _ = self._indexes(refresh=True)
+        return by_path[path]
+
+    def by_keys(self, value, *keys):
+        """Return the devices whose value for the first of keys that has
+        any match equals value."""
+        for refresh in (False, True):
+            _, by_key = self._indexes(refresh=refresh)
+            for key in keys:
+                devs = by_key[key].get(value)
+                if devs:
+                    return list(devs)
         return []
 
+    def volume_path(self, volume):
+        """Return the previously resolved and synced path of a storage
+        volume if it is still present."""
+        path = self._volume_paths.get(volume)
+        if path is not None and os.path.exists(path):
+            return path
+        return None
+
+    def remember_volume_path(self, volume, path):
+        with self._lock:
+            self._volume_paths[volume] = path
+
+
+def v2_get_path_to_disk(vol, inventory=None):
+    if inventory is None:
+        inventory = BlockDeviceInventory()
+
     cands = []
 
     def add_cands(*devs):
@@ -527,17 +606,16 @@ def v2_get_path_to_disk(vol):
             if multipath.is_mpath_member(dev['DEVNAME'], dev):
                 mpath_id = multipath.get_mpath_id_from_device(
                     dev['DEVNAME'], dev)
-                dev = link2dev['/dev/mapper/' + mpath_id]
+                dev = inventory.by_path('/dev/mapper/' + mpath_id)
             new_devs.append(dev)
         cands.append(set([dev['DEVNAME'] for dev in new_devs]))
 
     if 'wwn' in vol:
-        add_cands(*disk_by_keys(vol['wwn'],
-                                'DM_WWN', 'ID_WWN_WITH_EXTENSION', 'ID_WWN'))
+        add_cands(*inventory.by_keys(
+            vol['wwn'], 'DM_WWN', 'ID_WWN_WITH_EXTENSION', 'ID_WWN'))
     if 'serial' in vol:
-        add_cands(
-            *disk_by_keys(
-                vol['serial'], 'DM_SERIAL', 'ID_SERIAL', 'ID_SERIAL_SHORT'))
+        add_cands(*inventory.by_keys(
+            vol['serial'], 'DM_SERIAL', 'ID_SERIAL', 'ID_SERIAL_SHORT'))
     if 'device_id' in vol:
         dasd_device = dasd.DasdDevice(vol['device_id'])
         cands.append(set([dasd_device.devname]))
@@ -550,7 +628,7 @@ def v2_get_path_to_disk(vol):
         if path.startswith('iscsi:'):
             i = iscsi.ensure_disk_connected(path)
             path = i.devdisk_path
-        dev = disk_by_path(path)
+        dev = inventory.by_path(path)
         if dev is not None:
             add_cands(dev)
         else:
@@ -581,6 +659,14 @@ def get_path_to_storage_volume(volume, storage_config):
     if not vol:
         raise ValueError("volume with id '%s' not found" % volume)
 
+    inventory = getattr(storage_config, 'inventory', None)
+    if inventory is not None:
+        # already synced in this run, and its node is still there
+        volume_path = inventory.volume_path(volume)
+        if volume_path is not None:
+            LOG.debug('return known volume path %s', volume_path)
+            return volume_path
+
     # Find path to block device
     if vol.get('type') == "partition":
         partnumber = determine_partition_number(vol.get('id'), storage_config)
@@ -598,7 +684,7 @@ def get_path_to_storage_volume(volume, storage_config):
         # Get path to block device for disk. Device_id param should refer
         # to id of device in storage config
         if getattr(storage_config, 'version', 1) > 1:
-            volume_path = v2_get_path_to_disk(vol)
+            volume_path = v2_get_path_to_disk(vol, inventory)
         else:
             volume_path = v1_get_path_to_disk(vol)
 
@@ -654,9 +740,12 @@ def get_path_to_storage_volume(volume, storage_config):
             volume '%s' with type '%s'" % (volume, vol.get('type')))
 
     # sync devices
-    if not devsync_vol:
-        devsync_vol = volume_path
-    devsync(devsync_vol)
+    if devsync_vol:
+        devsync(devsync_vol, wait_for=volume_path)
+    else:
+        devsync(volume_path)
+    if inventory is not None:
+        inventory.remember_volume_path(volume, volume_path)
 
     LOG.debug('return volume path %s', volume_path)
     return volume_path
@@ -710,14 +799,15 @@ def image_handler(info, storage_config, context):
         if os.path.exists(path) and not image.preserve:
             os.unlink(path)
         raise
-    context.id_to_device[image.id] = info['dev'] = dev
+    info['dev'] = dev
+    context.record_device(image.id, dev)
     DEVS.add(dev)
     context.handlers['disk'](info, storage_config, context)
 
 
 def device_handler(info, storage_config, context):
     device: Device = storage_actions.asobject(info)
-    context.id_to_device[device.id] = device.path
+    context.record_device(device.id, device.path)
     context.handlers['disk'](info, storage_config, context)
 
 
@@ -774,7 +864,7 @@ def disk_handler(info, storage_config, context):
             'Invalid partition table type: %s in %s' % (ptable, info))
 
     disk = get_path_to_storage_volume(info.get('id'), storage_config)
-    context.id_to_device[info['id']] = disk
+    context.record_device(info['id'], disk)
     # For disks, 'preserve' is what indicates whether the partition
     # table should be reused or recreated but for compound devices
     # such as raids, it indicates if the raid should be created or
@@ -824,6 +914,7 @@ def disk_handler(info, storage_config, context):
                 )
                 clear_holders.clear_holders(disk)
                 clear_holders.assert_clear(disk)
+                context.inventory.invalidate()
 
     # Make the name if needed
     if info.get('name'):
@@ -1027,7 +1118,7 @@ def partition_handler(info, storage_config, context):
     disk_kname = block.path_to_kname(disk)
     part_path = block.dev_path(block.partition_kname(disk_kname, partnumber))
     check_passed_path(info, part_path)
-    context.id_to_device[info['id']] = part_path
+    context.record_device(info['id'], part_path)
 
     # consider the disks logical sector size when calculating sectors
     try:
@@ -1203,6 +1294,36 @@ def partition_handler(info, storage_config, context):
         make_dname(info.get('id'), storage_config)
 
 
+def _block_deploy_source(info, storage_config, context):
+    """Return the source to write to the volume of format action info.
+
+    Only the root filesystem is deployed at block level, from an fsimage
+    source with deploy: block holding a filesystem of the same type.
+    """
+    sources = [s for s in context.sources if s.get('deploy') == 'block']
+    if not sources:
+        return None
+    if not any(action.get('type') == 'mount' and
+               action.get('device') == info['id'] and
+               action.get('path') == '/'
+               for action in storage_config.values()):
+        return None
+    if len(sources) > 1:
+        raise ValueError('Only one source can be deployed at block level')
+    source = sources[0]
+    if source['type'] != 'fsimage':
+        LOG.warning('Cannot deploy %s source %s at block level, copying'
+                    ' files', source['type'], source['uri'])
+        return None
+    from curtin.commands.block_meta_v2 import growers
+    fstype = image.probe_fstype(source['uri'])
+    if fstype != info.get('fstype') or fstype not in growers:
+        LOG.info('Image %s holds a %s filesystem, not %s; copying files',
+                 source['uri'], fstype, info.get('fstype'))
+        return None
+    return source
+
+
 def format_handler(info, storage_config, context):
     volume = info.get('volume')
     if not volume:
@@ -1217,9 +1338,15 @@ def format_handler(info, storage_config, context):
         # Volume marked to be preserved, not formatting
         return
 
-    # Make filesystem using block library
-    LOG.debug("mkfs %s info: %s", volume_path, info)
-    mkfs.mkfs_from_config(volume_path, info)
+    source = _block_deploy_source(info, storage_config, context)
+    if source is not None:
+        from curtin.commands.block_meta_v2 import deploy_fsimage
+        deploy_fsimage(volume_path, source, info)
+        context.record_block_deployed(source['uri'])
+    else:
+        # Make filesystem using block library
+        LOG.debug("mkfs %s info: %s", volume_path, info)
+        mkfs.mkfs_from_config(volume_path, info)
 
     device_type = storage_config.get(volume).get('type')
     LOG.debug('Formatted device type: %s', device_type)
@@ -1608,7 +1735,7 @@ def lvm_partition_handler(info, storage_config, context):
 
     lv_path = get_path_to_storage_volume(info['id'], storage_config)
     check_passed_path(info, lv_path)
-    context.id_to_device[info['id']] = lv_path
+    context.record_device(info['id'], lv_path)
 
     wipe_mode = info.get('wipe', 'superblock')
     if wipe_mode and create_lv:
@@ -1646,7 +1773,7 @@ def dm_crypt_handler(info, storage_config, context):
         dm_name = info.get('id')
     dmcrypt_dev = os.path.join("/dev", "mapper", dm_name)
     check_passed_path(info, dmcrypt_dev)
-    context.id_to_device[info['id']] = dmcrypt_dev
+    context.record_device(info['id'], dmcrypt_dev)
     preserve = config.value_as_boolean(info.get('preserve'))
     if not volume:
         raise ValueError("volume for cryptsetup to operate on must be \
@@ -1814,7 +1941,7 @@ def raid_handler(info, storage_config, context):
     spare_devices = info.get('spare_devices')
     md_devname = block.md_path(info.get('name'))
     check_passed_path(info, md_devname)
-    context.id_to_device[info['id']] = md_devname
+    context.record_device(info['id'], md_devname)
     container = info.get('container')
     metadata = info.get('metadata')
     preserve = config.value_as_boolean(info.get('preserve'))
@@ -1993,7 +2120,7 @@ def bcache_handler(info, storage_config, context):
                                                   cache_mode, cset_uuid)
         # Not sure what to do in the preserve case here.
         check_passed_path(info, bcache_dev)
-        context.id_to_device[info['id']] = bcache_dev
+        context.record_device(info['id'], bcache_dev)
 
     if cache_mode and not backing_device:
         raise ValueError("cache mode specified which can only be set on "
@@ -2210,30 +2337,162 @@ def zfsroot_update_storage_config(storage_config):
 
 
 class BlockMetaContext:
+    """State shared by the handlers of one block-meta run.
+
+    With storage workers, handlers run on several threads, so they record
+    what they create through the methods here rather than changing the
+    attributes directly.  handlers and sources are only read while the
+    actions run.
+    """
 
     def __init__(self, handlers):
         self.handlers = handlers
         self.id_to_device = {}
+        self.inventory = BlockDeviceInventory()
+        # install sources, and the uris of those written to a volume
+        self.sources = []
+        self.block_deployed = set()
+        self._lock = threading.Lock()
+
+    def record_device(self, item_id, path):
+        with self._lock:
+            self.id_to_device[item_id] = path
 
+    def record_block_deployed(self, uri):
+        with self._lock:
+            self.block_deployed.add(uri)
 
-def meta_clear(devices, report_prefix=''):
+
+def meta_clear(devices, report_prefix='', workers=1):
     """ Run clear_holders on specified list of devices.
 
     :param: devices: a list of block devices (/dev/XXX) to be cleared
     :param: report_prefix: a string to pass to the ReportEventStack
+    :param: workers: how many disks clear_holders may wipe concurrently
     """
     # shut down any already existing storage layers above any disks used in
     # config that have 'wipe' set
     with events.ReportEventStack(
             name=report_prefix + '/clear-holders',
             reporting_enabled=True, level='INFO',
-            description="removing previous storage devices"):
+            description="removing previous storage devices") as stack:
         clear_holders.start_clear_holders_deps()
-        clear_holders.clear_holders(devices)
+        clear_holders.clear_holders(devices, workers=int(workers),
+                                    report_stack=stack)
         # if anything was not properly shut down, stop installation
         clear_holders.assert_clear(devices)
 
 
+def handle_storage_action(item_id, command, storage_config, context,
+                          stack_prefix):
+    handler = context.handlers.get(command['type'])
+    if not handler:
+        raise ValueError("unknown command type '%s'" % command['type'])
+    with events.ReportEventStack(
+            name=stack_prefix, reporting_enabled=True, level="INFO",
+            description="configuring %s: %s" % (command['type'],
+                                                command['id'])), \
+            tracing.span('%s_handler' % command['type'], cat='block',
+                         id=item_id):
+        try:
+            handler(command, storage_config, context)
+        except Exception as error:
+            LOG.error("An error occurred handling '%s': %s - %s" %
+                      (item_id, type(error).__name__, error))
+            raise
+
+
+def plan_storage_action_deps(storage_config):
+    """Compute which storage actions must finish before each action starts.
+
+    Actions in PARALLEL_ACTION_TYPES depend on the actions they reference
+    and on the previous action in config order that operates on the same
+    disk, so all work on one disk stays sequential while separate disks
+    proceed independently.  Any other action is a barrier: it waits for
+    everything before it and everything after it waits for it.
+
+    :param storage_config: ordered dict of storage actions keyed by id.
+    :returns: dict mapping action id to the set of ids it depends on.
+    """
+    graph = StorageConfigGraph(storage_config, validate=False)
+    deps = {}
+    chain_of = {}
+    chain_tail = {}
+    since_barrier = []
+    barrier = None
+    for item_id, command in storage_config.items():
+        # only references to earlier actions are ordering constraints, the
+        # sequential code path never waited on later ones either
+        refs = [ref for ref in graph.references(item_id) if ref in deps]
+        item_deps = set(refs)
+        if barrier is not None:
+            item_deps.add(barrier)
+        if command['type'] in PARALLEL_ACTION_TYPES:
+            chain = item_id
+            if refs and command['type'] != 'disk':
+                chain = chain_of.get(refs[0], refs[0])
+            if chain in chain_tail:
+                item_deps.add(chain_tail[chain])
+            chain_of[item_id] = chain
+            chain_tail[chain] = item_id
+            since_barrier.append(item_id)
+        else:
+            item_deps.update(since_barrier)
+            barrier = item_id
+            since_barrier = []
+            chain_tail = {}
+        deps[item_id] = item_deps
+    return deps
+
+
+def run_storage_actions(storage_config, context, stack_prefix, workers=1):
+    """Run the handler for every action in storage_config.
+
+    With workers <= 1 the actions run one after another in config order.
+    Otherwise the actions are scheduled on a pool of worker threads
+    according to plan_storage_action_deps.  Once an action fails no new
+    actions are started and the first error is raised after the running
+    ones complete.
+    """
+    workers = int(workers)
+    if workers <= 1:
+        for item_id, command in storage_config.items():
+            handle_storage_action(item_id, command, storage_config, context,
+                                  stack_prefix)
+        return
+
+    pending = plan_storage_action_deps(storage_config)
+    LOG.debug('Running storage actions with %s workers', workers)
+    done = set()
+    running = {}
+    error = None
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            if error is None:
+                ready = [item_id for item_id, item_deps in pending.items()
+                         if item_deps <= done]
+                for item_id in ready:
+                    del pending[item_id]
+                    future = executor.submit(
+                        handle_storage_action, item_id,
+                        storage_config[item_id], storage_config, context,
+                        stack_prefix)
+                    running[future] = item_id
+            if not running:
+                break
+            finished, _ = futures.wait(
+                running, return_when=futures.FIRST_COMPLETED)
+            for future in finished:
+                item_id = running.pop(future)
+                if future.exception() is not None:
+                    if error is None:
+                        error = future.exception()
+                else:
+                    done.add(item_id)
+    if error is not None:
+        raise error
+
+
 def meta_custom(args):
     """Does custom partitioning based on the layout provided in the config
     file. Section with the name storage contains information on which
@@ -2284,21 +2543,20 @@ def meta_custom(args):
     stack_prefix = state.get('report_stack_prefix', '')
 
     context = BlockMetaContext(command_handlers)
-
-    for item_id, command in storage_config_dict.items():
-        handler = context.handlers.get(command['type'])
-        if not handler:
-            raise ValueError("unknown command type '%s'" % command['type'])
-        with events.ReportEventStack(
-                name=stack_prefix, reporting_enabled=True, level="INFO",
-                description="configuring %s: %s" % (command['type'],
-                                                    command['id'])):
-            try:
-                handler(command, storage_config_dict, context)
-            except Exception as error:
-                LOG.error("An error occurred handling '%s': %s - %s" %
-                          (item_id, type(error).__name__, error))
-                raise
+    sources = cfg.get('sources', {})
+    if isinstance(sources, dict):
+        sources = [sources[k] for k in sorted(sources.keys())]
+    context.sources = [util.sanitize_source(s) for s in sources]
+    # path lookups only get the storage config, share the inventory via it
+    # like the config version
+    storage_config_dict.inventory = context.inventory
+
+    workers = cfg['storage'].get('workers', 1)
+    run_storage_actions(storage_config_dict, context, stack_prefix,
+                        workers=workers)
+
+    if context.block_deployed and state.get('scratch'):
+        image.save_block_deployed(state['scratch'], context.block_deployed)
 
     device_map_path = cfg['storage'].get('device_map_path')
     if device_map_path is not None:
@@ -0,0 +1,317 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""Compute what block-meta custom would do without doing it.
+
+plan_storage_actions walks a storage config in the order block-meta runs
+it and describes, for every action, the steps its handler would take and
+what they cost: the bytes its wipes would write and the span an md array
+created for it would resync.  Disks are looked up read-only to find their
+paths and sizes; nothing is wiped, partitioned, created or synced, so the
+plan can be computed before the machine is committed to the layout.
+"""
+
+import json
+import sys
+
+from curtin import block, config, util
+from curtin.commands.block_meta import (
+    BlockDeviceInventory,
+    extract_storage_ordered_dict,
+    v1_get_path_to_disk,
+    v2_get_path_to_disk,
+    zfsroot_update_storage_config,
+    )
+from curtin.commands.block_meta_v2 import (
+    DOSPartTable,
+    GPTPartTable,
+    ONE_MIB_BYTES,
+    _wipe_for_action,
+    )
+from curtin.log import LOG
+from curtin.storage_config import StorageConfigGraph
+
+# quick_zero zeroes 1MiB at the start and the end of a volume
+SUPERBLOCK_WIPE_BYTES = 2 * ONE_MIB_BYTES
+
+# raid levels whose arrays resync after they are created
+RESYNC_LEVELS = {'1', '4', '5', '6', '10'}
+
+PART_TABLES = {
+    'msdos': DOSPartTable,
+    'gpt': GPTPartTable,
+}
+
+
+def wipe_bytes(mode, size):
+    """Return how many bytes wiping a volume of size bytes with mode
+    writes, or None if that depends on a size that is not known."""
+    if not mode or mode == 'pvremove':
+        return 0
+    if mode in ('superblock', 'superblock-recursive'):
+        # superblock-recursive zeroes the partitions already on the
+        # volume as well, which only the running system knows about
+        if size is None:
+            return SUPERBLOCK_WIPE_BYTES
+        return min(size, SUPERBLOCK_WIPE_BYTES)
+    # zero, zeroout, random and discard cover the whole volume
+    return size
+
+
+def _raid_level(raidlevel):
+    level = str(raidlevel).lower()
+    if level.startswith('raid'):
+        level = level[len('raid'):]
+    return {'mirror': '1', 'stripe': '0'}.get(level, level)
+
+
+def _raid_size(level, member_sizes):
+    """Return the size of a level array of members with member_sizes."""
+    if not member_sizes or None in member_sizes:
+        return None
+    count, member = len(member_sizes), min(member_sizes)
+    if level in ('0', 'linear'):
+        return sum(member_sizes)
+    if level == '1':
+        return member
+    if level in ('4', '5'):
+        return (count - 1) * member
+    if level == '6':
+        return (count - 2) * member
+    if level == '10':
+        return count * member // 2
+    return None
+
+
+def _size(value):
+    if value is None:
+        return None
+    try:
+        return int(util.human2bytes(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class StoragePlanner(object):
+    """Describe the storage actions in storage_config.
+
+    :param storage_config: OrderedDict of storage actions keyed by id.
+    :param version: the storage config version.
+    :param resolve: look up the path, size and sector size of disks.
+    """
+
+    def __init__(self, storage_config, version=1, resolve=True):
+        self.storage_config = storage_config
+        self.version = version
+        self.resolve = resolve
+        self.graph = StorageConfigGraph(storage_config, validate=False)
+        self.paths = {}
+        self._sizes = {}
+        self._entries = {}
+        self._inventory = None
+
+    def _disk_path(self, action):
+        if self.version > 1:
+            if self._inventory is None:
+                self._inventory = BlockDeviceInventory()
+            return v2_get_path_to_disk(action, self._inventory)
+        if str(action.get('path', '')).startswith('iscsi:'):
+            # finding it would log in to the target
+            return None
+        return v1_get_path_to_disk(action)
+
+    def path(self, item_id):
+        """Return the path of an existing device item_id, if known."""
+        if item_id not in self.paths:
+            action = self.storage_config[item_id]
+            path = None
+            if action['type'] == 'device':
+                path = action.get('path')
+            elif action['type'] == 'disk' and self.resolve:
+                try:
+                    path = self._disk_path(action)
+                except Exception as e:
+                    LOG.debug('plan: cannot find disk %s: %s', item_id, e)
+            self.paths[item_id] = path
+        return self.paths[item_id]
+
+    def _sector_size(self, item_id):
+        path = self.path(item_id)
+        if path:
+            try:
+                return block.get_blockdev_sector_size(path)[0]
+            except Exception as e:
+                LOG.debug('plan: cannot read sector size of %s: %s', path, e)
+        return 512
+
+    def size(self, item_id):
+        """Return the size in bytes of device item_id, or None."""
+        if item_id in self._sizes:
+            return self._sizes[item_id]
+        # a cyclic config must not recurse forever
+        self._sizes[item_id] = None
+        action = self.storage_config.get(item_id, {})
+        stype = action.get('type')
+        size = None
+        if stype in ('partition', 'lvm_partition', 'image'):
+            size = _size(action.get('size'))
+        elif stype in ('disk', 'device'):
+            path = self.path(item_id)
+            if path:
+                try:
+                    size = block.read_sys_block_size_bytes(
+                        block.path_to_kname(path))
+                except (OSError, ValueError) as e:
+                    LOG.debug('plan: cannot read size of %s: %s', path, e)
+        elif stype == 'raid':
+            size = _raid_size(
+                _raid_level(action.get('raidlevel')),
+                [self.size(dev) for dev in action.get('devices', [])])
+        elif stype == 'lvm_volgroup':
+            sizes = [self.size(dev) for dev in action.get('devices', [])]
+            if sizes and None not in sizes:
+                size = sum(sizes)
+        elif stype == 'dm_crypt':
+            size = self.size(action.get('volume'))
+        elif stype == 'bcache':
+            size = self.size(action.get('backing_device'))
+        self._sizes[item_id] = size
+        return size
+
+    def _partition_entries(self, disk):
+        """Lay out the partitions of disk as block-meta v2 does."""
+        table_cls = PART_TABLES.get(disk.get('ptable'))
+        if table_cls is None or self.version < 2:
+            return
+        table = table_cls(self._sector_size(disk['id']))
+        for action in self.storage_config.values():
+            if (action['type'] == 'partition' and
+                    action.get('device') == disk['id']):
+                entry = table.add(action)
+                self._entries[action['id']] = (
+                    entry, table.sectors2bytes(entry.start),
+                    table.sectors2bytes(entry.size))
+
+    def _wipe(self, steps, item_id, mode):
+        if mode:
+            steps.append({'step': 'wipe', 'mode': mode,
+                          'bytes': wipe_bytes(mode, self.size(item_id))})
+
+    def plan_action(self, action):
+        """Return the plan of one storage action."""
+        item_id, stype = action['id'], action['type']
+        preserve = config.value_as_boolean(action.get('preserve'))
+        wipe = action.get('wipe')
+        steps = []
+        resync = 0
+        if stype == 'disk':
+            self._partition_entries(action)
+            if not preserve:
+                if config.value_as_boolean(wipe):
+                    self._wipe(steps, item_id, wipe)
+                ptable = action.get('ptable')
+                if config.value_as_boolean(ptable):
+                    if ptable == 'gpt':
+                        self._wipe(steps, item_id, 'superblock')
+                    steps.append({'step': 'ptable', 'label': ptable})
+        elif stype == 'partition':
+            step = {'step': 'partition', 'number': action.get('number'),
+                    'offset': _size(action.get('offset')),
+                    'size': self.size(item_id)}
+            if item_id in self._entries:
+                entry, offset, size = self._entries[item_id]
+                step.update(number=entry.number, offset=offset, size=size)
+            if preserve:
+                step['preserve'] = True
+            steps.append(step)
+            if self.version > 1:
+                wipe = _wipe_for_action(action)
+            elif preserve:
+                wipe = None
+            self._wipe(steps, item_id, wipe)
+        elif stype == 'format':
+            if not preserve:
+                steps.append({'step': 'mkfs', 'fstype': action.get('fstype')})
+        elif stype == 'raid':
+            level = _raid_level(action.get('raidlevel'))
+            if not preserve:
+                steps.append({'step': 'create', 'raidlevel': level,
+                              'devices': len(action.get('devices', []))})
+                if level in RESYNC_LEVELS:
+                    sizes = [self.size(dev)
+                             for dev in action.get('devices', [])]
+                    resync = min(sizes) if sizes and None not in sizes \
+                        else None
+            if wipe and (wipe != 'superblock' or preserve):
+                self._wipe(steps, item_id, wipe)
+        elif stype == 'lvm_partition':
+            if not preserve:
+                steps.append({'step': 'create'})
+                self._wipe(steps, item_id, action.get('wipe', 'superblock'))
+        elif stype == 'dm_crypt':
+            if not preserve:
+                steps.append({'step': 'create'})
+            if wipe and (wipe != 'superblock' or preserve):
+                self._wipe(steps, item_id, wipe)
+        elif stype in ('lvm_volgroup', 'bcache', 'zpool', 'zfs'):
+            if not preserve:
+                steps.append({'step': 'create'})
+            if stype == 'bcache':
+                self._wipe(steps, item_id, wipe)
+        else:
+            steps.append({'step': stype})
+
+        wiped = [step['bytes'] for step in steps if step['step'] == 'wipe']
+        return {
+            'id': item_id,
+            'type': stype,
+            'path': self.path(item_id),
+            'size': self.size(item_id),
+            'depends': self.graph.references(item_id),
+            'steps': steps,
+            'cost': {
+                'wipe_bytes': None if None in wiped else sum(wiped),
+                'resync_bytes': resync,
+            },
+        }
+
+    def plan(self):
+        """Return the plan of every action in storage_config."""
+        actions = [self.plan_action(action)
+                   for action in self.storage_config.values()]
+        totals = {}
+        for key in ('wipe_bytes', 'resync_bytes'):
+            costs = [action['cost'][key] for action in actions]
+            totals[key] = None if None in costs else sum(costs)
+        return {'version': self.version, 'actions': actions,
+                'totals': totals}
+
+
+def plan_storage_actions(storage_config, version=1, resolve=True):
+    """Return the plan of the storage actions in storage_config.
+
+    The plan has the actions in the order block-meta custom would run
+    them.  Each lists the ids it depends on, its steps and its cost, the
+    bytes its wipes would write and the bytes each member of a new md
+    array would resync, and the plan totals those costs.  A cost that
+    depends on a size which is not known, such as that of a disk that
+    cannot be found, is None.
+    """
+    return StoragePlanner(storage_config, version=version,
+                          resolve=resolve).plan()
+
+
+def meta_plan(args):
+    """Write the plan for the storage config as json."""
+    state = util.load_command_environment()
+    cfg = config.load_command_config(args, state)
+    if not cfg.get('storage'):
+        raise ValueError('no storage config to plan')
+    version = cfg['storage'].get('version', 1)
+    storage_config = zfsroot_update_storage_config(
+        extract_storage_ordered_dict(cfg))
+    plan = plan_storage_actions(storage_config, version=version)
+    sys.stdout.write(json.dumps(plan, indent=1) + '\n')
+    sys.stdout.flush()
+    return 0
+
+# vi: ts=4 expandtab syntax=python
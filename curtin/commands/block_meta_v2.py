@@ -1,6 +1,8 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 import os
+import tempfile
+import uuid
 from typing import (
     List,
     Optional,
@@ -9,6 +11,7 @@ from typing import (
 import attr
 
 from curtin import (block, compat, util)
+from curtin.block import image
 from curtin.commands.block_meta import (
     _get_volume_fstype,
     disk_handler as disk_handler_v1,
@@ -130,6 +133,66 @@ resizers = {
 }
 
 
+def grow_xfs(path, size):
+    # xfs only grows, and only while mounted.  The filesystem still has
+    # the uuid of the image it was written from and xfs refuses to mount
+    # a second filesystem with the uuid of one already mounted, such as
+    # the live system booted from the same image.
+    with tempfile.TemporaryDirectory() as mnt:
+        util.subp(['mount', '-t', 'xfs', '-o', 'nouuid', path, mnt])
+        try:
+            util.subp(['xfs_growfs', mnt])
+        finally:
+            util.subp(['umount', mnt])
+
+
+def set_ext_identity(path, fs_uuid, label=None):
+    cmd = ['tune2fs', '-U', fs_uuid]
+    if label is not None:
+        cmd.extend(['-L', label])
+    util.subp(cmd + [path])
+
+
+def set_xfs_identity(path, fs_uuid, label=None):
+    cmd = ['xfs_admin', '-U', fs_uuid]
+    if label is not None:
+        cmd.extend(['-L', label])
+    util.subp(cmd + [path])
+
+
+# filesystems an fsimage can be deployed as at block level
+growers = {
+    'ext2': resize_ext,
+    'ext3': resize_ext,
+    'ext4': resize_ext,
+    'xfs': grow_xfs,
+}
+
+identity_setters = {
+    'ext2': set_ext_identity,
+    'ext3': set_ext_identity,
+    'ext4': set_ext_identity,
+    'xfs': set_xfs_identity,
+}
+
+
+def deploy_fsimage(path, source, info):
+    """Write the filesystem image of source to path in place of mkfs.
+
+    The filesystem is grown to fill the volume and given the uuid and label
+    of the format action, or a new uuid, so that copies of an image do not
+    share one.  Returns the uuid."""
+    fstype = info['fstype']
+    LOG.info('Deploying %s filesystem image %s to %s', fstype,
+             source['uri'], path)
+    image.write_image(source, path, sparse='zeroout')
+    size = block.read_sys_block_size_bytes(os.path.realpath(path))
+    growers[fstype](path, size)
+    fs_uuid = info.get('uuid') or str(uuid.uuid4())
+    identity_setters[fstype](path, fs_uuid, label=info.get('label'))
+    return fs_uuid
+
+
 FLAG_TO_GUID = {
     flag: guid for (guid, flag) in GPT_GUID_TO_CURTIN_MAP.items()
     }
@@ -536,8 +599,8 @@ def disk_handler_v2(info, storage_config, context):
 
 
 def partition_handler_v2(info, storage_config, context):
-    context.id_to_device[info['id']] = get_path_to_storage_volume(
-        info.get('id'), storage_config)
+    context.record_device(info['id'], get_path_to_storage_volume(
+        info.get('id'), storage_config))
 
 
 # vi: ts=4 expandtab syntax=python
@@ -1,31 +1,68 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
+from concurrent import futures
+import os
 import sys
 import curtin.block as block
+from curtin.reporter import events
 from . import populate_one_subcmd
 from .. import log
 
 LOG = log.LOG
 
 
+def wipe_one(blockdev, mode):
+    LOG.debug('Wiping volume %s with mode=%s', blockdev, mode)
+    block.wipe_volume(blockdev, mode=mode)
+
+
+def wipe_one_reported(blockdev, mode):
+    with events.ReportEventStack(
+            name='block-wipe/%s' % os.path.basename(blockdev),
+            reporting_enabled=True, level='DEBUG',
+            description='wiping %s with mode=%s' % (blockdev, mode)):
+        wipe_one(blockdev, mode)
+
+
 def wipe_main(args):
-    for blockdev in args.devices:
-        try:
-            LOG.debug('Wiping volume %s with mode=%s', blockdev, args.mode)
-            block.wipe_volume(blockdev, mode=args.mode)
-        except Exception as e:
+    workers = min(args.workers, len(args.devices))
+    if workers <= 1:
+        for blockdev in args.devices:
+            try:
+                wipe_one(blockdev, args.mode)
+            except Exception as e:
+                sys.stderr.write(
+                    "Failed to wipe volume %s in mode %s: %s" %
+                    (blockdev, args.mode, e))
+                sys.exit(1)
+        sys.exit(0)
+
+    # with several wipes in flight, report each device so their progress
+    # can be told apart
+    failed = False
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        results = [
+            (blockdev,
+             executor.submit(wipe_one_reported, blockdev, args.mode))
+            for blockdev in args.devices]
+    for blockdev, result in results:
+        if result.exception() is not None:
             sys.stderr.write(
-                "Failed to wipe volume %s in mode %s: %s" %
-                (blockdev, args.mode, e))
-            sys.exit(1)
-    sys.exit(0)
+                "Failed to wipe volume %s in mode %s: %s\n" %
+                (blockdev, args.mode, result.exception()))
+            failed = True
+    sys.exit(1 if failed else 0)
 
 
 CMD_ARGUMENTS = (
     ((('-m', '--mode'),
       {'help': 'mode for wipe.', 'action': 'store',
        'default': 'superblock',
-       'choices': ['zero', 'superblock', 'superblock-recursive', 'random']}),
+       'choices': ['zero', 'zeroout', 'discard', 'superblock',
+                   'superblock-recursive', 'random']}),
+     (('-j', '--workers'),
+      {'help': 'number of devices to wipe concurrently', 'type': int,
+       'default': 1}),
      ('devices',
       {'help': 'devices to wipe', 'default': [], 'nargs': '+'}),
      )
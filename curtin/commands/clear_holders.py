@@ -33,8 +33,10 @@ def clear_holders_main(args):
     block.clear_holders.start_clear_holders_deps()
     if args.shutdown_plan:
         # get current holders and plan how to shut them down
-        holder_trees = [block.clear_holders.gen_holders_tree(path)
-                        for path in devices]
+        snapshot = block.clear_holders.HoldersSnapshot()
+        holder_trees = [
+            block.clear_holders.gen_holders_tree(path, snapshot=snapshot)
+            for path in devices]
         LOG.info('Current device storage tree:\n%s',
                  '\n'.join(block.clear_holders.format_holders_tree(tree)
                            for tree in holder_trees))
@@ -22,6 +22,7 @@ import sys
 import tempfile
 
 
+from .. import tracing
 from .. import util
 from .. import version
 from ..config import load_config, merge_config
@@ -71,6 +72,8 @@ def create_log_tarfile(tarfile, config):
     alllogs = instcfg.get('post_files', [])
     if logfile:
         alllogs.append(logfile)
+    if instcfg.get('trace_file'):
+        alllogs.append(instcfg['trace_file'])
     # Prune duplicates and files which do not exist
     stderr = sys.stderr
     valid_logs = []
@@ -99,6 +102,9 @@ def create_log_tarfile(tarfile, config):
             _collect_system_info(tar_dir, config)
             for logfile in valid_logs:
                 shutil.copy(logfile, tar_dir)
+            trace_file = instcfg.get('trace_file')
+            if trace_file and os.path.exists(trace_file):
+                _write_subp_profile(tar_dir, trace_file)
             _redact_sensitive_information(tar_dir, redact_values)
             util.subp(cmd, capture=True)
     finally:
@@ -107,6 +113,17 @@ def create_log_tarfile(tarfile, config):
     sys.stderr.write('Wrote: %s\n' % tarfile)
 
 
+def _write_subp_profile(target_dir, trace_file):
+    """Write the profile of the commands in trace_file to target_dir."""
+    try:
+        profile = tracing.subp_profile(tracing.load(trace_file))
+    except ValueError as e:
+        sys.stderr.write('Unable to profile %s: %s\n' % (trace_file, e))
+        return
+    util.write_file(os.path.join(target_dir, 'subp-profile.txt'),
+                    tracing.format_profile(profile, top=0) + '\n')
+
+
 def _collect_system_info(target_dir, config):
     """Copy and create system information files in the provided target_dir."""
     util.write_file(
@@ -2233,6 +2233,8 @@ def curthooks(args):
     cfg = config.load_command_config(args, state)
     stack_prefix = state.get('report_stack_prefix', '')
     curthooks_mode = cfg.get('curthooks', {}).get('mode', 'auto')
+    util.ChrootableTarget.use_executor = config.value_as_boolean(
+        cfg.get('curthooks', {}).get('target_executor', False))
 
     util.EFIVarFSBug.apply_workaround_if_affected()
 
@@ -2250,7 +2252,13 @@ def curthooks(args):
         if util.run_hook_if_exists(target, 'curtin-hooks'):
             sys.exit(0)
 
-    builtin_curthooks(cfg, target, state)
+    if util.ChrootableTarget.use_executor:
+        # hooks that chroot into the target all share one executor and the
+        # mounts it runs in, which are settled and unmounted once at the end
+        with util.ChrootableTarget(target):
+            builtin_curthooks(cfg, target, state)
+    else:
+        builtin_curthooks(cfg, target, state)
     sys.exit(0)
 
 
@@ -5,14 +5,19 @@ try:
 except ImportError:
     ABC = object
 import abc
+from concurrent import futures
 import os
+import re
 import shutil
 import sys
 import tempfile
+import threading
+import time
 
 import curtin.config
 from curtin.log import LOG
 from curtin import util
+from curtin.block import image
 from curtin.futil import write_files
 from curtin.reporter import events
 from curtin import url_helper
@@ -46,9 +51,12 @@ def tar_xattr_opts(cmd=None):
     return []
 
 
-def extract_root_tgz_url(url, target):
+def extract_root_tgz_url(url, target, cache=None, sha256=None):
     # extract a -root.tar.gz url in the 'target' directory
     path = _path_from_file_url(url)
+    if cache is not None and path == url and not os.path.isfile(path):
+        path = cache.fetch(url, sha256=sha256, retries=3,
+                           connections=url_helper.DOWNLOAD_CONNECTIONS)
     if path != url or os.path.isfile(path):
         util.subp(args=['smtar', '-C', target] + tar_xattr_opts() +
                   ['-Sxpf', path, '--numeric-owner'])
@@ -94,50 +102,151 @@ class AbstractSourceHandler(ABC):
         pass
 
 
+# layers of an fsimage-layered source downloaded at the same time
+LAYER_DOWNLOAD_WORKERS = 4
+LAYER_PROGRESS_INTERVAL = 10
+
+
+class _LayerProgress(object):
+    """Report the total progress of concurrent layer downloads."""
+
+    def __init__(self, name, interval=LAYER_PROGRESS_INTERVAL):
+        self.name = name
+        self.interval = interval
+        self._sizes = {}
+        self._done = {}
+        self._lock = threading.Lock()
+        self._last_report = time.monotonic()
+
+    def reporthook(self, layer):
+        """return a urlretrieve style reporthook for layer"""
+        def hook(blocknum, blocksize, size):
+            size = int(size)
+            done = blocknum * blocksize
+            with self._lock:
+                self._sizes[layer] = size
+                self._done[layer] = min(done, size) if size >= 0 else done
+                self._report()
+        return hook
+
+    def _report(self):
+        now = time.monotonic()
+        if now - self._last_report < self.interval:
+            return
+        self._last_report = now
+        events.report_progress_event(
+            self.name, 'downloaded %s of %s bytes of %s layers' % (
+                sum(self._done.values()),
+                sum(s for s in self._sizes.values() if s >= 0),
+                len(self._sizes)),
+            level='DEBUG')
+
+
 class LayeredSourceHandler(AbstractSourceHandler):
 
-    def __init__(self, image_stack):
+    def __init__(self, image_stack, cache=None, sha256=None):
         self.image_stack = image_stack
+        self.cache = cache
+        # the expected sha256 of a single image
+        self.sha256 = sha256
         self._tmpdir = None
         self._mounts = []
 
-    def _download(self):
-        new_image_stack = []
-        for path in self.image_stack:
-            if url_helper.urlparse(path).scheme not in ["", "file"]:
-                new_path = os.path.join(self._tmpdir, os.path.basename(path))
-                url_helper.download(path, new_path, retries=3)
-            else:
-                new_path = _path_from_file_url(path)
-            new_image_stack.append(new_path)
+    def _download_layer(self, url, progress):
+        kwargs = {'retries': 3,
+                  'connections': url_helper.DOWNLOAD_CONNECTIONS,
+                  'reporthook': progress.reporthook(url)}
+        if self.cache is not None:
+            # cached layers are mounted from the cache, read only
+            sha256 = self.sha256 if len(self.image_stack) == 1 else None
+            return self.cache.fetch(url, sha256=sha256, **kwargs)
+        path = os.path.join(self._tmpdir, os.path.basename(url))
+        url_helper.download(url, path, **kwargs)
+        return path
+
+    def _check_layer(self, img):
+        # Check that the image exists on disk and is not empty
+        if not os.path.isfile(img) or os.path.getsize(img) <= 0:
+            raise ValueError(
+                ("Failed to use fsimage: '%s' doesn't exist " +
+                 "or is invalid") % (img,))
+
+    def _mount_layer(self, img):
+        self._check_layer(img)
+        mp = os.path.join(self._tmpdir, os.path.basename(img) + ".dir")
+        os.mkdir(mp)
+        mount(img, mp, options='loop,ro')
+        self._mounts.append(mp)
+        return mp
+
+    def _fetch_layers(self, ready):
+        """
+        Download the remote layers of the image stack concurrently,
+        calling ready(index, path) as soon as each layer is available.
+        Returns the local paths of the layers in image stack order.
+        """
+        new_image_stack = list(self.image_stack)
+        remote = [i for i, path in enumerate(self.image_stack)
+                  if url_helper.urlparse(path).scheme not in ["", "file"]]
+        progress = _LayerProgress('extract/download-layers')
+        workers = max(1, min(LAYER_DOWNLOAD_WORKERS, len(remote)))
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = {
+                executor.submit(self._download_layer,
+                                self.image_stack[i], progress): i
+                for i in remote}
+            for i, path in enumerate(self.image_stack):
+                if i not in remote:
+                    new_image_stack[i] = _path_from_file_url(path)
+                    ready(i, new_image_stack[i])
+            # on error, running downloads finish before the executor exits
+            # and their files are removed by cleanup
+            for future in futures.as_completed(pending):
+                i = pending[future]
+                new_image_stack[i] = future.result()
+                ready(i, new_image_stack[i])
         self.image_stack = new_image_stack
+        return new_image_stack
 
-    def setup(self):
+    def _download_and_mount(self):
+        """Mount each layer as soon as it is available.  Returns the
+        mountpoints in image stack order."""
+        mountpoints = [None] * len(self.image_stack)
+
+        def ready(i, img):
+            mountpoints[i] = self._mount_layer(img)
+
+        self._fetch_layers(ready)
+        return mountpoints
+
+    def fetch(self):
+        """Make the layers available locally without mounting them.
+
+        Returns the paths of the image files, base layer first.  Files
+        downloaded here are removed by cleanup."""
         self._tmpdir = tempfile.mkdtemp()
+        try:
+            return self._fetch_layers(lambda i, img: self._check_layer(img))
+        except Exception:
+            self.cleanup()
+            raise
+
+    def setup(self):
+        # layers already fetched live in the existing tmpdir
+        if self._tmpdir is None:
+            self._tmpdir = tempfile.mkdtemp()
         LOG.debug(f"Setting up Layered Source for stack {self.image_stack}")
         try:
-            self._download()
-            # Check that all images exists on disk and are not empty
-            for img in self.image_stack:
-                if not os.path.isfile(img) or os.path.getsize(img) <= 0:
-                    raise ValueError(
-                        ("Failed to use fsimage: '%s' doesn't exist " +
-                         "or is invalid") % (img,))
-            for img in self.image_stack:
-                mp = os.path.join(
-                    self._tmpdir, os.path.basename(img) + ".dir")
-                os.mkdir(mp)
-                mount(img, mp, options='loop,ro')
-                self._mounts.append(mp)
-            if len(self._mounts) == 1:
-                root_dir = self._mounts[0]
+            mountpoints = self._download_and_mount()
+            if len(mountpoints) == 1:
+                root_dir = mountpoints[0]
             else:
                 # Multiple image files, merge them with an overlay.
                 root_dir = os.path.join(self._tmpdir, "root.dir")
                 os.mkdir(root_dir)
                 mount(
                     'overlay', root_dir, type='overlay',
-                    options='lowerdir=' + ':'.join(reversed(self._mounts)))
+                    options='lowerdir=' + ':'.join(reversed(mountpoints)))
                 self._mounts.append(root_dir)
             return root_dir
         except Exception:
@@ -189,28 +298,91 @@ def _get_image_stack(uri):
     return image_stack
 
 
-def get_handler_for_source(source):
-    """Return an AbstractSourceHandler for setting up `source`."""
+def get_handler_for_source(source, cache=None):
+    """Return an AbstractSourceHandler for setting up `source`.
+
+    Remote images are downloaded through `cache`, a DownloadCache, if
+    provided."""
     if source['uri'].startswith("cp://"):
         return TrivialSourceHandler(source['uri'][5:])
     elif source['type'] == "fsimage":
-        return LayeredSourceHandler([source['uri']])
+        return LayeredSourceHandler([source['uri']], cache=cache,
+                                    sha256=source.get('sha256'))
     elif source['type'] == "fsimage-layered":
-        return LayeredSourceHandler(_get_image_stack(source['uri']))
+        return LayeredSourceHandler(_get_image_stack(source['uri']),
+                                    cache=cache)
     else:
         return None
 
 
-def extract_source(source, target, *, extra_rsync_args=None):
-    handler = get_handler_for_source(source)
-    if handler is not None:
-        root_dir = handler.setup()
-        try:
+def get_source_cache(cfg):
+    """Return the DownloadCache configured in cfg, or None."""
+    cache_cfg = cfg.get('install', {}).get('source_cache')
+    if not cache_cfg:
+        return None
+    if isinstance(cache_cfg, str):
+        cache_cfg = {'path': cache_cfg}
+    max_size = cache_cfg.get('max_size')
+    if max_size is not None:
+        max_size = util.human2bytes(max_size)
+    return url_helper.DownloadCache(cache_cfg['path'], max_size=max_size)
+
+
+COPY_MODES = ('rsync', 'unsquashfs')
+
+
+def get_copy_mode(cfg):
+    """Return the install copy_mode configured in cfg."""
+    copy_mode = cfg.get('install', {}).get('copy_mode') or 'rsync'
+    if copy_mode not in COPY_MODES:
+        raise ValueError("Invalid copy_mode '%s', expected one of %s" %
+                         (copy_mode, ', '.join(COPY_MODES)))
+    if copy_mode == 'unsquashfs' and not util.which('unsquashfs'):
+        LOG.warning("unsquashfs not available, using copy_mode rsync")
+        copy_mode = 'rsync'
+    return copy_mode
+
+
+def _unsquashfs_images(handler, copy_mode, extra_rsync_args):
+    """Return the local images of handler to unpack with unsquashfs, or
+    None if the source is to be copied with rsync."""
+    if copy_mode != 'unsquashfs' or not isinstance(handler,
+                                                   LayeredSourceHandler):
+        return None
+    if extra_rsync_args:
+        LOG.warning('install extra_rsync_args are set, using rsync instead '
+                    'of copy_mode unsquashfs')
+        return None
+    images = handler.fetch()
+    fstypes = [image.probe_fstype(img) for img in images]
+    if any(fstype != 'squashfs' for fstype in fstypes):
+        LOG.info('not all of %s are squashfs images (%s), using rsync',
+                 images, fstypes)
+        return None
+    return images
+
+
+def extract_source(source, target, *, extra_rsync_args=None, cache=None,
+                   copy_mode='rsync'):
+    handler = get_handler_for_source(source, cache=cache)
+    if handler is None:
+        extract_root_tgz_url(source['uri'], target=target, cache=cache,
+                             sha256=source.get('sha256'))
+        return
+    try:
+        images = _unsquashfs_images(handler, copy_mode, extra_rsync_args)
+        if images is not None:
+            try:
+                unsquashfs_to_target(images, target)
+            except SquashfsListingError as e:
+                LOG.warning('%s, using rsync instead of copy_mode '
+                            'unsquashfs', e)
+                images = None
+        if images is None:
+            root_dir = handler.setup()
             copy_to_target(root_dir, target, extra_rsync_args=extra_rsync_args)
-        finally:
-            handler.cleanup()
-    else:
-        extract_root_tgz_url(source['uri'], target=target)
+    finally:
+        handler.cleanup()
 
 
 def copy_to_target(source, target, *, extra_rsync_args=None):
@@ -229,6 +401,131 @@ def copy_to_target(source, target, *, extra_rsync_args=None):
         cwd=target)
 
 
+# unsquashfs -lln output: mode, owner, size or "major, minor", date, path
+SQUASHFS_LISTING_RE = re.compile(
+    r'^(?P<mode>[-a-zA-Z]{10}) +\S+ +(?P<size>\d+|\d+, *\d+) '
+    r'\d{4}-\d\d-\d\d \d\d:\d\d (?P<path>.*)$')
+OVERLAY_OPAQUE_XATTR = 'trusted.overlay.opaque'
+
+
+class SquashfsListingError(ValueError):
+    """The listing of a squashfs image cannot be parsed unambiguously."""
+
+
+def squashfs_listing(image, root):
+    """Return the entries of squashfs image as if extracted to root.
+
+    Returns a dict of target path to (type, size), where type is the first
+    character of the mode string and size is a (major, minor) tuple for
+    devices.
+
+    unsquashfs lists paths without quoting them, so a name containing a
+    newline, or a symlink whose name or target contains " -> ", cannot be
+    told apart from the lines around it.  SquashfsListingError is raised
+    for such images."""
+    out, _err = util.subp(['unsquashfs', '-lln', '-d', root, image],
+                          capture=True, decode=False)
+    lines = out.decode('utf-8', 'surrogateescape').split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    entries = {}
+    for line in lines:
+        match = SQUASHFS_LISTING_RE.match(line)
+        if not match:
+            # only the messages before the first entry are not entries
+            if entries:
+                raise SquashfsListingError(
+                    'cannot parse listing of %s: %r' % (image, line))
+            continue
+        kind = match.group('mode')[0]
+        path = match.group('path')
+        if kind == 'l':
+            if path.count(' -> ') != 1:
+                raise SquashfsListingError(
+                    'ambiguous symlink in listing of %s: %r' % (image, path))
+            path = path.split(' -> ')[0]
+        if path != root and not path.startswith(root.rstrip('/') + '/'):
+            raise SquashfsListingError(
+                'path outside of %s in listing of %s: %r' %
+                (root, image, path))
+        size = match.group('size')
+        if ',' in size:
+            size = tuple(int(n) for n in size.split(','))
+        else:
+            size = int(size)
+        entries[path] = (kind, size)
+    return entries
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def _prepare_layer(entries):
+    """Remove what a layer hides or replaces before it is unpacked."""
+    for path, (kind, size) in entries.items():
+        is_dir = os.path.isdir(path) and not os.path.islink(path)
+        if kind == 'c' and size == (0, 0):
+            # overlay whiteout
+            _remove(path)
+        elif (kind == 'd') != is_dir and os.path.lexists(path):
+            _remove(path)
+
+
+def _finish_layer(entries):
+    """Remove whiteouts and the lower contents of opaque directories."""
+    for path, (kind, size) in entries.items():
+        if kind == 'c' and size == (0, 0):
+            _remove(path)
+        elif kind == 'd':
+            try:
+                opaque = os.getxattr(path, OVERLAY_OPAQUE_XATTR,
+                                     follow_symlinks=False)
+            except OSError:
+                continue
+            if opaque != b'y':
+                continue
+            for name in os.listdir(path):
+                child = os.path.join(path, name)
+                if child not in entries:
+                    _remove(child)
+            os.removexattr(path, OVERLAY_OPAQUE_XATTR, follow_symlinks=False)
+
+
+def unsquashfs_to_target(images, target):
+    """Unpack squashfs images, base layer first, directly into target.
+
+    Upper layers are applied the way overlayfs would present them:
+    whiteouts delete the lower path and opaque directories hide the lower
+    contents.  unsquashfs keeps xattrs, hardlinks and sparse files.
+
+    Raises SquashfsListingError, before target is changed, if the contents
+    of an image cannot be listed unambiguously."""
+    target = os.path.abspath(target)
+    # list every layer before anything is unpacked, so an image that
+    # cannot be listed leaves target untouched
+    listings = [squashfs_listing(img, target) for img in images]
+    os.makedirs(target, exist_ok=True)
+    processors = len(os.sched_getaffinity(0))
+    for img, entries in zip(images, listings):
+        _prepare_layer(entries)
+        start = time.monotonic()
+        util.subp(['unsquashfs', '-f', '-no-progress', '-p', str(processors),
+                   '-d', target, img], capture=True)
+        elapsed = max(time.monotonic() - start, 0.001)
+        _finish_layer(entries)
+        size = sum(s for k, s in entries.values() if k == '-')
+        events.report_progress_event(
+            'extract/unsquashfs',
+            'unpacked %s: %d files (%d files/s), %s (%s/s)' % (
+                os.path.basename(img), len(entries),
+                len(entries) / elapsed, util.bytes2human(size),
+                util.bytes2human(int(size / elapsed))))
+
+
 def _path_from_file_url(url):
     return url[7:] if url.startswith("file://") else url
 
@@ -254,6 +551,11 @@ def extract(args):
 
     LOG.debug("Installing sources: %s to target at %s" % (sources, target))
     stack_prefix = state.get('report_stack_prefix', '')
+    cache = get_source_cache(cfg)
+    copy_mode = get_copy_mode(cfg)
+    block_deployed = set()
+    if state.get('scratch'):
+        block_deployed = image.load_block_deployed(state['scratch'])
 
     for source in sources:
         with events.ReportEventStack(
@@ -262,9 +564,14 @@ def extract(args):
                 source['uri']):
             if source['type'].startswith('dd-'):
                 continue
+            if source['uri'] in block_deployed:
+                LOG.info('%s was written to the root filesystem by '
+                         'block-meta', source['uri'])
+                continue
             extra_rsync_args = cfg.get(
                 'install', {}).get('extra_rsync_args', [])
-            extract_source(source, target, extra_rsync_args=extra_rsync_args)
+            extract_source(source, target, extra_rsync_args=extra_rsync_args,
+                           cache=cache, copy_mode=copy_mode)
 
     if cfg.get('write_files'):
         LOG.info("Applying write_files from config.")
@@ -5,11 +5,15 @@ from copy import deepcopy
 import json
 import os
 import re
+import selectors
 import shlex
 import shutil
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+import traceback
 
 import attr
 
@@ -18,8 +22,10 @@ from curtin import config
 from curtin import distro
 from curtin import util
 from curtin import paths
+from curtin import tracing
 from curtin import version
 from curtin.log import LOG, logged_time
+from curtin import reporter
 from curtin.reporter.legacy import load_reporter
 from curtin.reporter import events
 from . import populate_one_subcmd
@@ -212,12 +218,110 @@ class WorkingDir:
             json.dump(attr.asdict(self), fh)
 
 
+# stage command output is read in chunks of STAGE_OUTPUT_BUFLEN and written
+# out a line at a time; a partial line (a prompt or progress bar) is written
+# once the command has been quiet for STAGE_OUTPUT_FLUSH_INTERVAL seconds.
+# The last STAGE_OUTPUT_TAIL bytes are kept for the error of a failed command
+STAGE_OUTPUT_BUFLEN = 64 * 1024
+STAGE_OUTPUT_FLUSH_INTERVAL = 0.5
+STAGE_OUTPUT_TAIL = 1024 * 1024
+
+
+def is_curtin_command(cmd):
+    """Return True if cmd runs a curtin subcommand, as the builtin stage
+    commands do."""
+    return isinstance(cmd, list) and len(cmd) > 1 and cmd[0] == 'curtin'
+
+
+def _run_forked(cmd, env, wfd):
+    """Run curtin command cmd as the child process forked to run it and
+    exit with its exit code, never returning."""
+    rc = 1
+    try:
+        os.dup2(wfd, 1)
+        os.dup2(wfd, 2)
+        os.close(wfd)
+        sys.stdout = os.fdopen(1, 'w', closefd=False)
+        sys.stderr = os.fdopen(2, 'w', closefd=False)
+        os.environ.clear()
+        os.environ.update(env)
+        sys.argv = list(cmd)
+        tracing.SUBP_PROFILE.clear()
+        from .main import main
+        main(cmd[1:])
+        rc = 0
+    except SystemExit as e:
+        if e.code is None:
+            rc = 0
+        elif isinstance(e.code, int):
+            rc = e.code & 0xff
+        else:
+            sys.stderr.write('%s\n' % e.code)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except Exception:
+                pass
+        os._exit(rc)
+
+
+def can_fork():
+    """Return True if a curtin command can be run by a forked child.
+
+    A child forked while other threads run, such as a reporting webhook
+    worker or a udev monitor, starts with whatever locks those threads
+    held, and could deadlock on one of them."""
+    return threading.active_count() == 1
+
+
+class ForkedCommand(object):
+    """A curtin command run by a forked child of this process, which has
+    curtin imported and the install config parsed already.
+
+    Stands in for the subprocess.Popen of the command with stderr combined
+    into stdout."""
+
+    def __init__(self, cmd, env):
+        # anything buffered would be written again by the child
+        sys.stdout.flush()
+        sys.stderr.flush()
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(rfd)
+            _run_forked(cmd, env, wfd)
+        os.close(wfd)
+        self.pid = pid
+        self.stdout = os.fdopen(rfd, 'rb')
+        self.returncode = None
+
+    def wait(self):
+        if self.returncode is None:
+            _pid, status = os.waitpid(self.pid, 0)
+            if os.WIFSIGNALED(status):
+                self.returncode = -os.WTERMSIG(status)
+            else:
+                self.returncode = os.WEXITSTATUS(status)
+        return self.returncode
+
+
 class Stage(object):
 
-    def __init__(self, name, commands, env, reportstack=None, logfile=None):
+    def __init__(self, name, commands, env, reportstack=None, logfile=None,
+                 timestamps=False, fork_commands=False):
         self.name = name
         self.commands = commands
         self.env = env
+        # run curtin commands in a forked child rather than a new curtin
+        self.fork_commands = fork_commands
+        # prefix each line of output with the time it was read
+        self.timestamps = timestamps
+        self._line_start = True
+        # {cmdname: {'bytes': n, 'lines': n, 'seconds': n}}
+        self.stats = {}
         if logfile is None:
             logfile = INSTALL_LOG
         self.install_log = self._open_install_log(logfile)
@@ -250,8 +354,20 @@ class Stage(object):
         sys.stdout.write(data)
         sys.stdout.flush()
 
+    def _timestamp(self, data):
+        stamp = time.strftime('[%Y-%m-%d %H:%M:%S] ').encode()
+        out = []
+        for line in data.splitlines(keepends=True):
+            if self._line_start:
+                out.append(stamp)
+            out.append(line)
+            self._line_start = line.endswith(b'\n')
+        return b''.join(out)
+
     def write(self, data):
         """Write data to stdout and to the install_log."""
+        if self.timestamps:
+            data = self._timestamp(data)
         self.write_stdout(data)
         if self.install_log is not None:
             self.install_log.write(data)
@@ -273,21 +389,24 @@ class Stage(object):
             with util.LogTimer(LOG.debug, cmdname):
                 with cur_res:
                     try:
-                        sp = subprocess.Popen(
-                            cmd, stdout=subprocess.PIPE,
-                            stderr=subprocess.STDOUT,
-                            env=env, shell=shell)
+                        fork = (self.fork_commands and
+                                is_curtin_command(cmd))
+                        if fork and not can_fork():
+                            LOG.debug('%s: other threads are running, not '
+                                      'forking to run %s', cmdname, cmd)
+                            fork = False
+                        if fork:
+                            sp = ForkedCommand(cmd, env)
+                        else:
+                            sp = subprocess.Popen(
+                                cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                env=env, shell=shell)
                     except OSError as e:
                         LOG.warning("%s command failed", cmdname)
                         raise util.ProcessExecutionError(cmd=cmd, reason=e)
 
-                    output = b""
-                    while True:
-                        data = sp.stdout.read(1)
-                        if not data and sp.poll() is not None:
-                            break
-                        self.write(data)
-                        output += data
+                    output = self._drain(cmdname, sp)
 
                     rc = sp.returncode
                     if rc != 0:
@@ -296,6 +415,49 @@ class Stage(object):
                             stdout=output, stderr="",
                             exit_code=rc, cmd=cmd)
 
+    def _drain(self, cmdname, sp):
+        """Copy the output of sp to stdout and the install log until it
+        exits.  Returns the last STAGE_OUTPUT_TAIL bytes of output."""
+        fd = sp.stdout.fileno()
+        tail = bytearray()
+        pending = b''
+        nbytes = nlines = 0
+        start = time.monotonic()
+        with selectors.DefaultSelector() as selector:
+            selector.register(fd, selectors.EVENT_READ)
+            while True:
+                if not selector.select(timeout=STAGE_OUTPUT_FLUSH_INTERVAL):
+                    if pending:
+                        self.write(pending)
+                        pending = b''
+                    continue
+                data = os.read(fd, STAGE_OUTPUT_BUFLEN)
+                if not data:
+                    break
+                nbytes += len(data)
+                nlines += data.count(b'\n')
+                tail += data
+                if len(tail) > 2 * STAGE_OUTPUT_TAIL:
+                    del tail[:-STAGE_OUTPUT_TAIL]
+                pending += data
+                end = pending.rfind(b'\n') + 1
+                if end:
+                    self.write(pending[:end])
+                    pending = pending[end:]
+        if pending:
+            self.write(pending)
+        sp.stdout.close()
+        sp.wait()
+
+        elapsed = time.monotonic() - start
+        self.stats[cmdname] = {'bytes': nbytes, 'lines': nlines,
+                               'seconds': elapsed}
+        rate = max(elapsed, 0.001)
+        LOG.debug('%s wrote %d bytes, %d lines in %.3fs (%.0f bytes/s,'
+                  ' %.0f lines/s)', cmdname, nbytes, nlines, elapsed,
+                  nbytes / rate, nlines / rate)
+        return bytes(tail[-STAGE_OUTPUT_TAIL:])
+
 
 def apply_power_state(pstate):
     """
@@ -483,6 +645,10 @@ def cmd_install(args):
     # Load reporter
     if not logfile_append:
         clear_install_log(logfile)
+    trace_file = instcfg.get('trace_file')
+    if trace_file:
+        tracing.start(trace_file, append=logfile_append)
+        tracing.name_process('curtin install')
     legacy_reporter = load_reporter(cfg)
     legacy_reporter.files = post_files
 
@@ -504,6 +670,12 @@ def cmd_install(args):
         if len(dd_images) > 1:
             raise ValueError("You may not use more than one disk image")
 
+        fork_commands = instcfg.get('fork_commands', False)
+        if fork_commands:
+            # what the forked commands would parse from the config file
+            config.cache_config(workingd.config_file,
+                                json.loads(json.dumps(cfg)))
+
         LOG.debug(workingd.env())
         env = os.environ.copy()
         env.update(workingd.env())
@@ -519,7 +691,10 @@ def cmd_install(args):
                 commands_name = '%s_commands' % name
                 with util.LogTimer(LOG.debug, 'stage_%s' % name):
                     stage = Stage(name, cfg.get(commands_name, {}), env,
-                                  reportstack=reportstack, logfile=logfile)
+                                  reportstack=reportstack, logfile=logfile,
+                                  timestamps=instcfg.get('log_timestamps',
+                                                         False),
+                                  fork_commands=fork_commands)
                     stage.run()
 
         if apply_kexec(cfg.get('kexec'), workingd.target):
@@ -570,6 +745,8 @@ def cmd_install(args):
 
             shutil.rmtree(workingd.top)
 
+    # the final events must be delivered before a reboot or poweroff
+    reporter.flush()
     apply_power_state(cfg.get('power_state'))
 
     sys.exit(0)
@@ -17,7 +17,7 @@ SUB_COMMAND_MODULES = [
     'apply_net', 'apt-config', 'block-attach-iscsi', 'block-detach-iscsi',
     'block-discover', 'block-info', 'block-meta', 'block-wipe',
     'clear-holders', 'curthooks', 'collect-logs', 'extract', 'features',
-    'hook', 'install', 'mkfs', 'in-target', 'net-meta', 'pack',
+    'hook', 'install', 'mkfs', 'in-target', 'net-meta', 'pack', 'profile',
     'schema-validate', 'swap', 'system-install', 'system-upgrade',
     'unmount', 'version',
 ]
@@ -126,8 +126,8 @@ def main(argv=None):
                        verbosity=verbosity)
 
     # Above here, only standard library modules can be assumed.
-    from .. import config
-    from ..reporter import (events, update_configuration)
+    from .. import config, tracing
+    from ..reporter import (events, flush, update_configuration)
 
     parser = get_main_parser(stacktrace=stacktrace, verbosity=verbosity)
     subps = parser.add_subparsers(dest="subcmd")
@@ -196,6 +196,7 @@ def main(argv=None):
     args.reportstack = events.ReportEventStack(
         name=stack_prefix, reporting_enabled=True, level="DEBUG",
         description="curtin command %s" % args.subcmd)
+    tracing.name_process('curtin %s' % args.subcmd)
 
     try:
         with args.reportstack:
@@ -206,6 +207,13 @@ def main(argv=None):
             traceback.print_exc()
         sys.stderr.write("%s\n" % e)
         sys.exit(3)
+    finally:
+        # deliver events still queued by asynchronous handlers
+        flush()
+        if tracing.SUBP_PROFILE:
+            log.LOG.debug('Commands run by curtin %s:\n%s', args.subcmd,
+                          tracing.format_profile(tracing.SUBP_PROFILE,
+                                                 top=10))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,40 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import sys
+
+from .. import tracing
+from . import populate_one_subcmd
+
+
+def profile_main(args):
+    """List the commands an install spent the most time in."""
+    path = args.trace
+    if not path:
+        path = args.config.get('install', {}).get('trace_file')
+    if not path:
+        sys.stderr.write('No trace file given and install/trace_file is not'
+                         ' configured\n')
+        sys.exit(1)
+    profile = tracing.subp_profile(tracing.load(path))
+    calls = sum(entry['calls'] for entry in profile.values())
+    seconds = sum(entry['seconds'] for entry in profile.values())
+    sys.stdout.write('%d commands ran for %.3f seconds\n' % (calls, seconds))
+    sys.stdout.write(tracing.format_profile(profile, top=args.top) + '\n')
+    sys.exit(0)
+
+
+CMD_ARGUMENTS = (
+    (('trace',
+      {'help': 'the trace file to profile [default install/trace_file]',
+       'nargs': '?', 'default': None}),
+     (('-n', '--top'),
+      {'help': 'list this many commands, 0 for all [default 20]',
+       'type': int, 'default': 20}),
+     )
+)
+
+
+def POPULATE_SUBCMD(parser):
+    populate_one_subcmd(parser, CMD_ARGUMENTS, profile_main)
+
+# vi: ts=4 expandtab syntax=python
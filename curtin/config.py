@@ -1,6 +1,8 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
+import copy
 import json
+import os
 import typing
 
 import attr
@@ -11,6 +13,10 @@ ARCHIVE_TYPE = "text/curtin-config-archive"
 CONFIG_HEADER = "#curtin-config"
 CONFIG_TYPE = "text/curtin-config"
 
+# path -> (stat stamp, config) of configs handed to load_command_config by
+# cache_config, such as the install config for stage commands it forks
+_CONFIG_CACHE = {}
+
 try:
     # python2
     _STRING_TYPES = (str, basestring, unicode)
@@ -116,11 +122,28 @@ def load_command_config(args, state):
 
     if not cfg_file:
         cfg = {}
+    elif cfg_file in _CONFIG_CACHE:
+        stamp, cfg = _CONFIG_CACHE[cfg_file]
+        if stamp == _config_stamp(cfg_file):
+            return copy.deepcopy(cfg)
+        del _CONFIG_CACHE[cfg_file]
+        cfg = load_config(cfg_file)
     else:
         cfg = load_config(cfg_file)
     return cfg
 
 
+def _config_stamp(cfg_file):
+    st = os.stat(cfg_file)
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def cache_config(cfg_file, cfg):
+    """Have load_command_config return a copy of cfg rather than parse
+    cfg_file, for as long as cfg_file is unchanged."""
+    _CONFIG_CACHE[cfg_file] = (_config_stamp(cfg_file), copy.deepcopy(cfg))
+
+
 def dump_config(config):
     return yaml.dump(config, default_flow_style=False, indent=2)
 
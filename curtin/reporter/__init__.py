@@ -2,6 +2,8 @@
 
 """Reporter Abstract Base Class."""
 
+import os
+
 from .registry import DictRegistry
 from .handlers import available_handlers
 
@@ -20,16 +22,35 @@ def update_configuration(config):
     """
     for handler_name, handler_config in config.items():
         if not handler_config:
+            old = instantiated_handler_registry.registered_items.get(
+                handler_name)
+            if old is not None:
+                old.flush()
             instantiated_handler_registry.unregister_item(
                 handler_name, force=True)
             continue
         handler_config = handler_config.copy()
         cls = available_handlers.registered_items[handler_config.pop('type')]
+        old = instantiated_handler_registry.registered_items.get(handler_name)
+        if old is not None:
+            old.flush()
         instantiated_handler_registry.unregister_item(handler_name)
         instance = cls(**handler_config)
         instantiated_handler_registry.register_item(handler_name, instance)
 
 
+def flush(timeout=None):
+    """Wait for the events published to every handler to be delivered."""
+    for handler in instantiated_handler_registry.registered_items.values():
+        handler.flush(timeout=timeout)
+
+
+def _after_fork():
+    for handler in instantiated_handler_registry.registered_items.values():
+        handler.after_fork()
+
+
 instantiated_handler_registry = DictRegistry()
 update_configuration(DEFAULT_CONFIG)
+os.register_at_fork(after_in_child=_after_fork)
 # vi: ts=4 expandtab syntax=python
@@ -11,10 +11,12 @@ import os.path
 import time
 
 from . import instantiated_handler_registry
+from .. import tracing
 
 FINISH_EVENT_TYPE = 'finish'
 START_EVENT_TYPE = 'start'
 RESULT_EVENT_TYPE = 'result'
+PROGRESS_EVENT_TYPE = 'progress'
 
 DEFAULT_EVENT_ORIGIN = 'curtin'
 
@@ -128,6 +130,16 @@ def report_start_event(event_name, event_description, level=None):
     return report_event(event)
 
 
+def report_progress_event(event_name, event_description, level=None):
+    """Report a "progress" event for a long running operation.
+
+    See :py:func:`.report_start_event` for parameter details.
+    """
+    event = ReportingEvent(PROGRESS_EVENT_TYPE, event_name, event_description,
+                           level=level)
+    return report_event(event)
+
+
 class ReportEventStack(object):
     """Context Manager for using :py:func:`report_event`
 
@@ -197,6 +209,9 @@ class ReportEventStack(object):
 
     def __enter__(self):
         self.result = status.SUCCESS
+        self._span = tracing.span(self.fullname, cat='report',
+                                  description=self.description)
+        self._span.__enter__()
         if self.reporting_enabled:
             report_start_event(self.fullname, self.description,
                                level=self.level)
@@ -239,6 +254,7 @@ class ReportEventStack(object):
         return self._childrens_finish_info()
 
     def __exit__(self, exc_type, exc_value, traceback):
+        self._span.__exit__(exc_type, exc_value, traceback)
         (result, msg) = self._finish_info(exc_value)
         if self.parent:
             self.parent.children[self.name] = (result, msg)
@@ -1,6 +1,9 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 import abc
+import collections
+import threading
+import time
 
 from .registry import DictRegistry
 from .. import url_helper
@@ -21,6 +24,16 @@ class ReportingHandler(object):
     def publish_event(self, event):
         """Publish an event to the ``INFO`` log level."""
 
+    def flush(self, timeout=None):
+        """Wait for published events to be delivered.
+
+        Returns False if they were not all delivered within timeout."""
+        return True
+
+    def after_fork(self):
+        """Called in a child process forked while the handler was
+        registered."""
+
 
 class LogHandler(ReportingHandler):
     """Publishes events to the curtin log at the ``DEBUG`` log level."""
@@ -52,10 +65,25 @@ class PrintHandler(ReportingHandler):
         print(event.as_string())
 
 
+# asynchronous webhook delivery: events wait in a queue of at most
+# WEBHOOK_QUEUE_SIZE events and are posted by a background thread, up to
+# batch_size events per post.  A post that fails is retried after each
+# delay in WEBHOOK_BACKOFF before its events are given up on
+WEBHOOK_QUEUE_SIZE = 1000
+WEBHOOK_FLUSH_TIMEOUT = 60
+WEBHOOK_BACKOFF = (1, 2, 4, 8, 16)
+# what to do with an event published while the queue is full: 'drop' it, or
+# 'coalesce' it with or in place of a queued progress event.  finish events
+# are never dropped, they wait for room in the queue instead
+WEBHOOK_OVERFLOW_POLICIES = ('drop', 'coalesce')
+
+
 class WebHookHandler(ReportingHandler):
     def __init__(self, endpoint, consumer_key=None, token_key=None,
                  token_secret=None, consumer_secret=None, timeout=None,
-                 retries=None, level="DEBUG"):
+                 retries=None, level="DEBUG", asynchronous=False,
+                 queue_size=WEBHOOK_QUEUE_SIZE, batch_size=1,
+                 overflow='drop', flush_timeout=WEBHOOK_FLUSH_TIMEOUT):
         super(WebHookHandler, self).__init__()
 
         self.oauth_helper = url_helper.OauthUrlHelper(
@@ -70,16 +98,123 @@ class WebHookHandler(ReportingHandler):
             LOG.warning("invalid level '%s', using WARN", level)
             self.level = logging.WARN
         self.headers = {'Content-Type': 'application/json'}
+        if overflow not in WEBHOOK_OVERFLOW_POLICIES:
+            raise ValueError("Invalid overflow policy '%s', expected one of"
+                             " %s" % (overflow,
+                                      ', '.join(WEBHOOK_OVERFLOW_POLICIES)))
+        self.asynchronous = asynchronous
+        self.queue_size = max(1, int(queue_size))
+        self.batch_size = max(1, int(batch_size))
+        self.overflow = overflow
+        self.flush_timeout = flush_timeout
+        self.dropped = 0
+        self._queue = collections.deque()
+        # events queued or being posted
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._worker = None
+
+    def _post(self, events):
+        # a batch is posted as a list, single events as before
+        if self.batch_size > 1:
+            data = [event.as_dict() for event in events]
+        else:
+            data = events[0].as_dict()
+        return self.oauth_helper.geturl(
+            url=self.endpoint, data=data, headers=self.headers,
+            retries=self.retries)
 
     def publish_event(self, event):
+        if self.asynchronous:
+            return self._enqueue(event)
         try:
-            return self.oauth_helper.geturl(
-                url=self.endpoint, data=event.as_dict(),
-                headers=self.headers, retries=self.retries)
+            return self._post([event])
         except Exception as e:
             LOG.warning("failed posting event: %s [%s]" %
                         (event.as_string(), e))
 
+    def _make_room(self, event):
+        """Called with the queue full, return True if event can be queued."""
+        if self.overflow == 'coalesce':
+            progress = [i for i, queued in enumerate(self._queue)
+                        if queued.event_type == 'progress']
+            same = [i for i in progress if self._queue[i].name == event.name]
+            if event.event_type == 'progress' and same:
+                # a later progress event supersedes a queued one
+                self._queue[same[-1]] = event
+                return False
+            if progress:
+                del self._queue[progress[0]]
+                self._pending -= 1
+                self.dropped += 1
+                return True
+        if event.event_type == 'finish' and self._cond.wait_for(
+                lambda: len(self._queue) < self.queue_size,
+                timeout=self.flush_timeout):
+            return True
+        self.dropped += 1
+        return False
+
+    def _enqueue(self, event):
+        with self._cond:
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._deliver, name='webhook-reporter',
+                    daemon=True)
+                self._worker.start()
+            if len(self._queue) >= self.queue_size:
+                if not self._make_room(event):
+                    return
+            self._queue.append(event)
+            self._pending += 1
+            self._cond.notify_all()
+
+    def _deliver(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue)
+                batch = [self._queue.popleft() for _ in
+                         range(min(self.batch_size, len(self._queue)))]
+                self._cond.notify_all()
+            for delay in (0,) + WEBHOOK_BACKOFF:
+                time.sleep(delay)
+                try:
+                    self._post(batch)
+                    break
+                except Exception as e:
+                    error = e
+            else:
+                LOG.warning("failed posting %d events, first: %s [%s]",
+                            len(batch), batch[0].as_string(), error)
+            with self._cond:
+                self._pending -= len(batch)
+                self._cond.notify_all()
+
+    def after_fork(self):
+        # the worker thread did not come along and the lock may be held;
+        # events still queued are the parent's to post
+        self._queue = collections.deque()
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._worker = None
+
+    def flush(self, timeout=None):
+        """Wait for queued events to be posted, for up to timeout seconds
+        (flush_timeout by default)."""
+        if timeout is None:
+            timeout = self.flush_timeout
+        with self._cond:
+            done = self._cond.wait_for(lambda: not self._pending,
+                                       timeout=timeout)
+            if not done:
+                LOG.warning("%d events were not posted to %s",
+                            self._pending, self.endpoint)
+            if self.dropped:
+                LOG.warning("%d events were dropped from the full queue for"
+                            " %s", self.dropped, self.endpoint)
+                self.dropped = 0
+        return done
+
 
 class JournaldHandler(ReportingHandler):
 
@@ -93,6 +93,7 @@ STORAGE_CONFIG_SCHEMA = {
             },
             'additionalItems': False,
         },
+        'workers': {'type': 'integer', 'minimum': 1},
     },
     'additionalProperties': False,
 }
@@ -108,38 +109,81 @@ def load_and_validate(config_path):
     return validate_config(config.get('storage'), sourcefile=config_path)
 
 
+# compiled schema validators keyed by storage type, see _schema_validator
+_SCHEMA_VALIDATORS = {}
+
+
+def _schema_validator(stype):
+    """Return the validator for the schema of storage type stype, compiling
+    it on first use.
+
+    stype None returns the validator for the storage config document
+    itself, which only checks that its items are objects; each item is
+    validated against the schema of its own type instead of trying every
+    type schema as STORAGE_CONFIG_SCHEMA does."""
+    validator = _SCHEMA_VALIDATORS.get(stype)
+    if validator is None:
+        import jsonschema
+        if stype is None:
+            schema = copy.deepcopy(STORAGE_CONFIG_SCHEMA)
+            schema['properties']['config']['items'] = {'type': 'object'}
+        else:
+            schema = STORAGE_CONFIG_TYPES[stype].schema
+        cls = jsonschema.validators.validator_for(schema)
+        cls.check_schema(schema)
+        validator = _SCHEMA_VALIDATORS[stype] = cls(schema)
+    return validator
+
+
+def _validate_item(item, sourcefile):
+    """Return a list of error messages for storage config item."""
+    if not isinstance(item, dict):
+        # reported by the document validator
+        return []
+    if 'type' not in item:
+        return ["'type' is a required property in %s" % item]
+    instance_type = item['type']
+    if (not isinstance(instance_type, str) or
+            instance_type not in STORAGE_CONFIG_TYPES):
+        return ["Unknown storage type: %s in %s" % (instance_type, item)]
+    messages = [error.message for error in
+                _schema_validator(instance_type).iter_errors(item)]
+    if not messages:
+        return []
+    return ["%s in %s\n%s" % ('\n'.join(messages), sourcefile,
+                              util.json_dumps(item))]
+
+
 def validate_config(config, sourcefile=None):
-    """Validate storage config object."""
+    """Validate storage config object.
+
+    config is either a storage config with 'version' and a 'config' list
+    or a single storage config item.  All errors found are raised together
+    in one ValueError."""
     if not sourcefile:
         sourcefile = ''
+    errors = []
     try:
-        import jsonschema
-        jsonschema.validate(config, STORAGE_CONFIG_SCHEMA)
+        if 'type' in config and 'config' not in config:
+            items = [config]
+        else:
+            for e in _schema_validator(None).iter_errors(config):
+                if isinstance(e.instance, int):
+                    errors.append(
+                        'Unexpected value (%s) for property "%s"' % (
+                            e.path[0], e.instance))
+                else:
+                    errors.append("%s in %s" % (e.message, e.instance))
+            items = config.get('config')
+            if not isinstance(items, list):
+                items = []
+        for item in items:
+            errors.extend(_validate_item(item, sourcefile))
     except ImportError:
         LOG.error('Cannot validate storage config, missing jsonschema')
         raise
-    except jsonschema.exceptions.ValidationError as e:
-        if isinstance(e.instance, int):
-            msg = 'Unexpected value (%s) for property "%s"' % (e.path[0],
-                                                               e.instance)
-            raise ValueError(msg)
-        if 'type' not in e.instance:
-            msg = "%s in %s" % (e.message, e.instance)
-            raise ValueError(msg)
-
-        instance_type = e.instance['type']
-        stype = get_storage_types().get(instance_type)
-        if stype:
-            try:
-                jsonschema.validate(e.instance, stype.schema)
-            except jsonschema.exceptions.ValidationError as f:
-                msg = "%s in %s\n%s" % (f.message, sourcefile,
-                                        util.json_dumps(e.instance))
-                raise ValueError(msg)
-        else:
-            msg = "Unknown storage type: %s in %s" % (instance_type,
-                                                      e.instance)
-            raise ValueError(msg)
+    if errors:
+        raise ValueError('\n'.join(errors))
 
 
 # FIXME: move this map to each types schema and extract these
@@ -380,6 +424,129 @@ def merge_config_trees_to_list(config_trees):
     return merged
 
 
+class StorageConfigGraph(object):
+    """ The dependencies between the items of a storage config.
+
+        The reference fields of every item (see _stype_to_deps) are indexed
+        once, along with which items hold each referenced value, so the
+        dependencies of all items resolve in time roughly linear in the
+        size of the config instead of rescanning the config for every
+        reference like find_item_dependencies does.
+
+        :param sconfig: OrderedDict of storage config items keyed by id, as
+                        returned by extract_storage_ordered_dict.
+        :param validate: check each reference with _validate_dep_type.
+    """
+
+    def __init__(self, sconfig, validate=True):
+        self.sconfig = sconfig
+        self.validate = validate
+        self._edges = {}
+        self._closures = {}
+        # (dep_key, value) -> ids of the items whose dep_key is value
+        self._referrers = {}
+        dep_keys = set()
+        for item_id, item_cfg in sconfig.items():
+            edges = []
+            for dep_key in sorted(self._dep_keys(item_cfg)):
+                dep_keys.add(dep_key)
+                if dep_key not in item_cfg:
+                    continue
+                dep_value = item_cfg[dep_key]
+                if not isinstance(dep_value, list):
+                    dep_value = [dep_value]
+                edges.extend((dep_key, dep) for dep in dep_value)
+            self._edges[item_id] = edges
+        for item_id, item_cfg in sconfig.items():
+            for dep_key in dep_keys.intersection(item_cfg):
+                try:
+                    key = (dep_key, item_cfg[dep_key])
+                    self._referrers.setdefault(key, []).append(item_id)
+                except TypeError:
+                    # lists and other unhashable values never equal an id
+                    pass
+
+    @staticmethod
+    def _dep_keys(item_cfg):
+        try:
+            return _stype_to_deps(item_cfg.get('type'))
+        except KeyError:
+            return set()
+
+    def edges(self, item_id):
+        """ Return (dep_key, dep_id) for each reference held by item_id."""
+        return list(self._edges.get(item_id, []))
+
+    def references(self, item_id):
+        """ Return the ids of the items item_id directly references."""
+        return [dep for _key, dep in self._edges.get(item_id, [])
+                if dep in self.sconfig]
+
+    def referrers(self, dep_key, dep_id):
+        """ Return the ids of the items whose dep_key field is dep_id."""
+        return list(self._referrers.get((dep_key, dep_id), []))
+
+    def closure(self, item_id):
+        """ Return the set of ids needed to construct item_id.
+
+            This is item_id, everything it references directly or
+            indirectly, and every item sharing one of those references;
+            the same ids get_config_tree collects.  A dependency cycle
+            raises ValueError.
+        """
+        return self._closure(item_id, [])
+
+    def _closure(self, item_id, path):
+        if item_id in self._closures:
+            return self._closures[item_id]
+        if item_id in path:
+            cycle = path[path.index(item_id):] + [item_id]
+            raise ValueError(
+                'Dependency cycle in storage config: %s' %
+                ' -> '.join(str(dep) for dep in cycle))
+        path.append(item_id)
+        closure = {item_id}
+        for dep_key, dep in self._edges.get(item_id, []):
+            if self.validate:
+                _validate_dep_type(item_id, dep_key, dep, self.sconfig)
+            closure.update(self._referrers.get((dep_key, dep), []))
+            if dep in self.sconfig:
+                closure.update(self._closure(dep, path))
+            else:
+                closure.add(dep)
+        path.pop()
+        self._closures[item_id] = closure
+        return closure
+
+    def ordered(self, item_ids=None):
+        """ Return the configs of item_ids, all items by default, sorted
+            from the least to the most dependent, like
+            merge_config_trees_to_list.
+
+            Items are ordered by the size of their closure, then by type
+            name and the type's _stype_to_order_key, and finally by their
+            position in item_ids.
+        """
+        if item_ids is None:
+            item_ids = list(self.sconfig)
+        seen = set()
+        configs = []
+        for item_id in item_ids:
+            if item_id in seen:
+                LOG.warning('Dropping duplicate id: %s' % item_id)
+                continue
+            seen.add(item_id)
+            configs.append(self.sconfig[item_id])
+
+        def sort_key(cfg):
+            order_key = operator.itemgetter(
+                *list(_stype_to_order_key(cfg['type'])))
+            return (len(self.closure(cfg['id'])), cfg['type'],
+                    order_key(cfg))
+
+        return sorted(configs, key=sort_key)
+
+
 def config_tree_to_list(config_tree):
     """ ConfigTrees are OrderedDicts which insert dependent storage configs
         from leaf to root.  Reversing this insertion order creates a list
@@ -412,6 +579,48 @@ def decode_libblkid_string(encoded: str) -> str:
     return encoded.encode('raw-unicode-escape').decode('unicode-escape')
 
 
+class ProbeIndex(object):
+    """ Lookups into probert 'blockdev' data built in one pass, so that
+        parsers resolve device names in constant time rather than by
+        scanning the DEVLINKS of every device.  extract_storage_config
+        shares one index between all of its parsers.
+    """
+
+    def __init__(self, blockdev_data):
+        self.blockdev_data = blockdev_data
+        # devlink -> kernel names of the devices with that link, in the
+        # order of the probe data
+        self.devlinks = {}
+        for bd_key, bdata in blockdev_data.items():
+            for link in bdata.get('DEVLINKS', '').split():
+                self.devlinks.setdefault(link, []).append(bd_key)
+        # parent kernel name -> {partition kernel name: ptable entry}
+        self._ptable_entries = {}
+
+    def lookup_devname(self, devname):
+        """ Return the kernel name of devname, a kernel name or devlink,
+            or None if no device has that name.
+        """
+        if devname in self.blockdev_data:
+            return devname
+        knames = self.devlinks.get(devname)
+        return knames[0] if knames else None
+
+    def ptable_entry(self, parent_devname, devname):
+        """ Return the entry for partition devname in the partition table
+            of parent_devname, or None.
+        """
+        entries = self._ptable_entries.get(parent_devname)
+        if entries is None:
+            entries = {}
+            ptable = self.blockdev_data[parent_devname].get('partitiontable')
+            for pentry in (ptable or {}).get('partitions', []):
+                entries.setdefault(self.lookup_devname(pentry['node']),
+                                   pentry)
+            self._ptable_entries[parent_devname] = entries
+        return entries.get(devname)
+
+
 class ProbertParser(object):
     """ Base class for parsing probert storage configuration.
 
@@ -426,7 +635,7 @@ class ProbertParser(object):
     probe_data_key = None
     class_data = None
 
-    def __init__(self, probe_data):
+    def __init__(self, probe_data, index=None):
         if not probe_data or not isinstance(probe_data, dict):
             raise ValueError('Invalid probe_data: %s' % probe_data)
 
@@ -447,6 +656,16 @@ class ProbertParser(object):
         self.blockdev_data = self.probe_data.get('blockdev', {})
         if not self.blockdev_data:
             LOG.warning('probe_data missing valid "blockdev" data')
+        self._index = index
+
+    @property
+    def index(self):
+        """ The ProbeIndex of blockdev_data, built on first use unless
+            one was given.
+        """
+        if self._index is None:
+            self._index = ProbeIndex(self.blockdev_data)
+        return self._index
 
     def parse(self):
         raise NotImplementedError()
@@ -460,15 +679,7 @@ class ProbertParser(object):
             the dictionary keys, search under 'DEVLINKS' of each
             device and return the dictionary for the kernel.
         """
-        if devname in self.blockdev_data:
-            return devname
-
-        for bd_key, bdata in self.blockdev_data.items():
-            devlinks = bdata.get('DEVLINKS', '').split()
-            if devname in devlinks:
-                return bd_key
-
-        return None
+        return self.index.lookup_devname(devname)
 
     def is_mpath_member(self, blockdev):
         return multipath.is_mpath_member(blockdev.get('DEVNAME', ''), blockdev)
@@ -582,8 +793,8 @@ class BcacheParser(ProbertParser):
 
     probe_data_key = 'bcache'
 
-    def __init__(self, probe_data):
-        super(BcacheParser, self).__init__(probe_data)
+    def __init__(self, probe_data, index=None):
+        super(BcacheParser, self).__init__(probe_data, index=index)
         self.backing = self.class_data.get('backing', {})
         self.caching = self.class_data.get('caching', {})
 
@@ -631,14 +842,9 @@ class BcacheParser(ProbertParser):
         def _find_bcache_devname(uuid, backing_data, blockdev_data):
             by_uuid = '/dev/bcache/by-uuid/' + uuid
             label = _sb_get(backing_data, 'dev.label')
-            for devname, data in blockdev_data.items():
-                if not devname:
-                    continue
-                if devname.startswith('/dev/bcache'):
-                    # DEVLINKS is a space separated list
-                    devlinks = data.get('DEVLINKS', '').split()
-                    if by_uuid in devlinks:
-                        return devname
+            for devname in self.index.devlinks.get(by_uuid, []):
+                if devname and devname.startswith('/dev/bcache'):
+                    return devname
             if label:
                 return label
             LOG.warning('Failed to find bcache %s ' % (by_uuid))
@@ -862,12 +1068,7 @@ class BlockdevParser(ProbertParser):
                     return None
             ptable = parent_blockdev.get('partitiontable')
             if ptable:
-                part = None
-                for pentry in ptable['partitions']:
-                    if self.lookup_devname(pentry['node']) == devname:
-                        part = pentry
-                        break
-
+                part = self.index.ptable_entry(parent_devname, devname)
                 if part is None:
                     # Could not find the partition in the partition table.
 
@@ -1469,8 +1670,11 @@ def extract_storage_config(probe_data, strict=False):
     configs = []
     errors = []
     LOG.debug('Extracting storage config from probe data')
+    index = None
+    if isinstance(probe_data, dict):
+        index = ProbeIndex(probe_data.get('blockdev') or {})
     for ptype, pname in convert_map.items():
-        parser = pname(probe_data)
+        parser = pname(probe_data, index=index)
         found_cfgs, found_errs = parser.parse()
         configs.extend(found_cfgs)
         errors.extend(found_errs)
@@ -1508,24 +1712,19 @@ def extract_storage_config(probe_data, strict=False):
         if strict:
             raise RuntimeError(errmsg)
 
-    # build and merge probed data into a valid storage config by
-    # generating a config tree for each item in the probed data
-    # and then merging the trees, which resolves dependencies
-    # and produced a dependency ordered storage config
+    # order the probed data into a valid storage config by resolving
+    # the dependencies of every item in one graph, which produces a
+    # dependency ordered storage config
     LOG.debug("Extracted (unmerged) storage config:\n%s",
               yaml.dump({'storage': ordered},
                         indent=4, default_flow_style=False))
 
-    LOG.debug("Generating storage config dependencies")
-    ctrees = []
-    for cfg in ordered:
-        tree = get_config_tree(cfg.get('id'), final_config)
-        ctrees.append(tree)
-
-    LOG.debug("Merging storage config dependencies")
+    LOG.debug("Resolving storage config dependencies")
+    graph = StorageConfigGraph(
+        OrderedDict((cfg['id'], cfg) for cfg in ordered))
     merged_config = {
         'version': 2,
-        'config': merge_config_trees_to_list(ctrees)
+        'config': graph.ordered([cfg.get('id') for cfg in ordered])
     }
     LOG.debug("Merged storage config:\n%s",
               yaml.dump({'storage': merged_config},
@@ -0,0 +1,191 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""Run commands in a target through one long-lived helper process.
+
+util.subp runs each command in a target as 'unshare --fork --pid
+--mount-proc ... -- chroot target cmd', paying for a new pid namespace and
+two extra execs per command.  A TargetExecutor instead starts a single
+helper in the target's pid namespace that chroots into the target once and
+then runs the commands it is sent over a socketpair, replying with their
+exit code and captured output.
+
+The helper runs as 'python3 -m curtin.target_executor FD TARGET' with the
+interpreter of the host, so it must not import anything after the chroot.
+"""
+
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+
+_HEADER = struct.Struct('!I')
+
+# how the output of a command is captured, see TargetExecutor.run
+CAPTURE_MODES = (None, 'pipe', 'combine')
+
+
+def _recv_exact(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise EOFError('connection closed')
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def send_message(sock, header, *blobs):
+    """Send a json header and the byte strings blobs over sock."""
+    header = dict(header, sizes=[len(blob) for blob in blobs])
+    payload = json.dumps(header).encode()
+    sock.sendall(_HEADER.pack(len(payload)) + payload + b''.join(blobs))
+
+
+def recv_message(sock):
+    """Return the header and blobs of the next message on sock."""
+    size, = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    header = json.loads(_recv_exact(sock, size))
+    blobs = [_recv_exact(sock, blob_size) if blob_size else b''
+             for blob_size in header.pop('sizes')]
+    return header, blobs
+
+
+def _run(request, data):
+    stdout = stderr = None
+    if request.get('capture') == 'pipe':
+        stdout = stderr = subprocess.PIPE
+    elif request.get('capture') == 'combine':
+        stdout, stderr = subprocess.PIPE, subprocess.STDOUT
+    try:
+        sp = subprocess.Popen(
+            request['args'], env=request.get('env'), cwd='/',
+            stdin=subprocess.PIPE if data else subprocess.DEVNULL,
+            stdout=stdout, stderr=stderr)
+        out, err = sp.communicate(data or None)
+    except OSError as e:
+        return {'errno': e.errno, 'error': e.strerror}, b'', b''
+    except Exception as e:
+        return {'errno': None, 'error': str(e)}, b'', b''
+    return ({'rc': sp.returncode, 'stdout': out is not None,
+             'stderr': err is not None}, out or b'', err or b'')
+
+
+def _reap():
+    # as pid 1 of the namespace the helper inherits any orphans
+    while True:
+        try:
+            pid, _status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+
+
+def serve(sock, target):
+    """Chroot into target and run the commands sent over sock until it is
+    closed."""
+    os.chroot(target)
+    os.chdir('/')
+    while True:
+        try:
+            request, blobs = recv_message(sock)
+        except EOFError:
+            return
+        response, out, err = _run(request, blobs[0])
+        _reap()
+        send_message(sock, response, out, err)
+
+
+class TargetExecutor(object):
+    """A helper process running commands in target.
+
+    unshare_args is the unshare command line, as from
+    util._get_unshare_pid_args, that puts the helper in its own pid
+    namespace."""
+
+    def __init__(self, target, unshare_args):
+        self.target = target
+        self.unshare_args = list(unshare_args)
+        self.proc = None
+        self.sock = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        unshare_args = list(self.unshare_args)
+        if any(arg.startswith('--mount-proc') for arg in unshare_args):
+            # let mounts made in the host after the helper started, and
+            # their unmounting, show in its mount namespace
+            unshare_args.insert(1, '--propagation=slave')
+        parent, child = socket.socketpair()
+        env = os.environ.copy()
+        topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join(
+            [topdir] + [p for p in [env.get('PYTHONPATH')] if p])
+        try:
+            self.proc = subprocess.Popen(
+                unshare_args + [sys.executable, '-m', __name__,
+                                str(child.fileno()), self.target],
+                pass_fds=[child.fileno()], stdin=subprocess.DEVNULL,
+                env=env)
+        except Exception:
+            parent.close()
+            raise
+        finally:
+            child.close()
+        self.sock = parent
+        return self
+
+    def run(self, args, env=None, data=None, capture=None):
+        """Run args in the target and return (rc, stdout, stderr).
+
+        capture is one of CAPTURE_MODES.  Output that is not captured goes
+        to the standard output and error the helper was started with and is
+        returned as None.  OSError is raised if args could not be run."""
+        if capture not in CAPTURE_MODES:
+            raise ValueError('unknown capture mode %s' % capture)
+        if isinstance(data, str):
+            data = data.encode()
+        request = {'args': [str(arg) for arg in args], 'env': env,
+                   'capture': capture}
+        with self._lock:
+            if self.sock is None:
+                raise OSError('executor for %s is not running' % self.target)
+            try:
+                send_message(self.sock, request, data or b'')
+                response, (out, err) = recv_message(self.sock)
+            except (OSError, EOFError) as e:
+                self._stop()
+                raise OSError('executor for %s failed: %s' % (self.target, e))
+        if 'rc' not in response:
+            raise OSError(response['errno'], response['error'])
+        return (response['rc'], out if response['stdout'] else None,
+                err if response['stderr'] else None)
+
+    def _stop(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if self.proc is not None:
+            self.proc.wait()
+            self.proc = None
+
+    def close(self):
+        """Stop the helper, which ends any process left in its namespace."""
+        with self._lock:
+            self._stop()
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    fd, target = argv
+    serve(socket.socket(fileno=int(fd)), target)
+
+
+if __name__ == '__main__':
+    main()
+
+# vi: ts=4 expandtab syntax=python
@@ -0,0 +1,202 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""
+Record where install time goes as a Chrome trace event file.
+
+Each curtin process appends complete ("X") events to the file named by
+the CURTIN_TRACE_FILE environment variable, so commands run by an install
+add to the same trace.  The file is a json array without its closing
+bracket, which trace viewers (chrome://tracing, https://ui.perfetto.dev)
+accept as is.  Each event carries the pid and thread id that recorded it
+and the name of the span it ran in as the parent argument.
+
+Every util.subp call is also accounted for in SUBP_PROFILE, traced or not,
+and its trace event carries the same figures so that the calls of all the
+processes of an install can be profiled from the trace.
+"""
+
+import json
+import os
+import threading
+import time
+
+TRACE_FILE_ENV = 'CURTIN_TRACE_FILE'
+
+_local = threading.local()
+_lock = threading.Lock()
+# (pid, path) -> fd, so a forked child opens the file again
+_fds = {}
+
+# util.subp calls of this process by argv class, see account_subp
+SUBP_PROFILE = {}
+SUBP_PROFILE_FIELDS = ('calls', 'seconds', 'max', 'failed', 'retries',
+                       'captured')
+
+
+def enabled():
+    return bool(os.environ.get(TRACE_FILE_ENV))
+
+
+def start(path, append=False):
+    """Trace this and child processes to path, a new trace unless append
+    is set and path exists."""
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    if not (append and os.path.exists(path)):
+        with open(path, 'w') as fp:
+            fp.write('[\n')
+    os.environ[TRACE_FILE_ENV] = path
+
+
+def stop():
+    """Stop tracing this process."""
+    os.environ.pop(TRACE_FILE_ENV, None)
+    with _lock:
+        for fd in _fds.values():
+            os.close(fd)
+        _fds.clear()
+
+
+def load(path):
+    """Return the events of the trace in path."""
+    with open(path) as fp:
+        data = fp.read().rstrip().rstrip(',')
+    if not data.endswith(']'):
+        data += ']'
+    return json.loads(data)
+
+
+def _write(event):
+    path = os.environ.get(TRACE_FILE_ENV)
+    if not path:
+        return
+    data = (json.dumps(event, default=str) + ',\n').encode()
+    key = (os.getpid(), path)
+    with _lock:
+        fd = _fds.get(key)
+        if fd is None:
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT |
+                         os.O_CLOEXEC, 0o644)
+            _fds[key] = fd
+        # one write per event, so events of processes do not interleave
+        os.write(fd, data)
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def name_process(name):
+    """Name this process in the trace."""
+    if enabled():
+        _write({'name': 'process_name', 'ph': 'M', 'pid': os.getpid(),
+                'args': {'name': name}})
+
+
+class span(object):
+    """Record the time spent in a with block as a trace event.
+
+    name and cat are the event's name and category, args are added to the
+    event's arguments."""
+
+    def __init__(self, name, cat='curtin', **args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self._start = None
+
+    def __enter__(self):
+        if not enabled():
+            return self
+        stack = _stack()
+        # the parent of a process' first span is the report stack it runs in
+        parent = (stack[-1] if stack else
+                  os.environ.get('CURTIN_REPORTSTACK'))
+        if parent:
+            self.args.setdefault('parent', parent)
+        stack.append(self.name)
+        self._start = (time.time(), time.monotonic())
+        return self
+
+    def __exit__(self, etype, value, trace):
+        if self._start is None:
+            return
+        stack = _stack()
+        if stack and stack[-1] == self.name:
+            stack.pop()
+        wall, start = self._start
+        self._start = None
+        if etype is not None:
+            self.args['error'] = etype.__name__
+        _write({'name': self.name, 'cat': self.cat, 'ph': 'X',
+                'ts': int(wall * 1e6),
+                'dur': int((time.monotonic() - start) * 1e6),
+                'pid': os.getpid(), 'tid': threading.get_ident(),
+                'args': self.args})
+
+
+def argv_class(cmd):
+    """Return the command name and subcommand of cmd, such as 'lvm vgs' or
+    'udevadm settle', to group calls of a command by."""
+    if not isinstance(cmd, (list, tuple)):
+        cmd = str(cmd).split()
+    if not cmd:
+        return ''
+    words = [os.path.basename(str(cmd[0]))]
+    if (len(cmd) > 1 and str(cmd[1])[:1].isalpha() and
+            '/' not in str(cmd[1]) and '=' not in str(cmd[1])):
+        words.append(str(cmd[1]))
+    return ' '.join(words)
+
+
+def _account(profile, cls, seconds, rc, retries, captured):
+    entry = profile.get(cls)
+    if entry is None:
+        entry = profile[cls] = dict.fromkeys(SUBP_PROFILE_FIELDS, 0)
+    entry['calls'] += 1
+    entry['seconds'] += seconds
+    entry['max'] = max(entry['max'], seconds)
+    entry['failed'] += int(rc != 0)
+    entry['retries'] += retries
+    entry['captured'] += captured
+
+
+def account_subp(cls, seconds, rc, retries, captured):
+    """Account for a util.subp call of argv class cls that took seconds,
+    exited with rc (None if it did not run) after retries retries, and
+    whose captured output was captured bytes long."""
+    with _lock:
+        _account(SUBP_PROFILE, cls, seconds, rc, retries, captured)
+
+
+def subp_profile(events):
+    """Return the profile of the util.subp calls in trace events."""
+    profile = {}
+    for event in events:
+        if event.get('cat') != 'subp' or event.get('ph') != 'X':
+            continue
+        args = event.get('args', {})
+        _account(profile, args.get('argv') or event['name'],
+                 event.get('dur', 0) / 1e6, args.get('rc', 0),
+                 args.get('retries', 0), args.get('captured', 0))
+    return profile
+
+
+def format_profile(profile, top=20):
+    """Return a table of the top commands of profile by total time."""
+    rows = sorted(profile.items(), key=lambda item: -item[1]['seconds'])
+    lines = ['%-32s %7s %10s %8s %8s %6s %7s %10s' % (
+        'command', 'calls', 'total s', 'mean s', 'max s', 'failed',
+        'retries', 'captured')]
+    for cls, entry in rows[:top] if top else rows:
+        lines.append('%-32s %7d %10.3f %8.3f %8.3f %6d %7d %10d' % (
+            cls[:32], entry['calls'], entry['seconds'],
+            entry['seconds'] / entry['calls'], entry['max'],
+            entry['failed'], entry['retries'], entry['captured']))
+    return '\n'.join(lines)
+
+# vi: ts=4 expandtab syntax=python
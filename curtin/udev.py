@@ -1,9 +1,12 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
+import collections
 import shlex
 import os
+import threading
+import time
 
-from curtin import util
+from curtin import tracing, util
 from curtin.log import logged_call, LOG
 
 try:
@@ -50,18 +53,169 @@ def generate_udev_rule(interface, mac):
     return '%s\n' % rule
 
 
+UDEV_CONTROL = '/run/udev/control'
+UDEV_QUEUE = '/run/udev/queue'
+# seconds to block on the monitor before re-checking the target and the
+# udev queue state
+UDEV_WAIT_SLICE = 0.5
+# matches the default timeout of 'udevadm settle'
+UDEV_WAIT_TIMEOUT = 120
+
+# udevadm settle waits on the global udev event queue; callers running
+# storage actions concurrently take turns rather than piling up settles.
+_SETTLE_LOCK = threading.Lock()
+
+
+class UdevDeviceWaiter(object):
+    """Wait for udev to announce specific block devices.
+
+    A single netlink monitor is opened on first use and kept for the
+    lifetime of the process, so waiting on a device costs a poll on an
+    already open socket instead of a 'udevadm settle' process that waits
+    for the entire udev queue to drain.  The monitor is only used when
+    running as root with systemd-udevd present; otherwise, or if pyudev
+    is unavailable, wait() returns None and callers fall back to
+    'udevadm settle'.
+
+    Concurrent waiters share the monitor.  Whichever waiter receives an
+    event appends it to a numbered log, and each waiter looks at every
+    event logged after it started, so no waiter loses an event another
+    one received.
+    """
+
+    # events kept for waiters that have not looked at them yet
+    EVENT_LOG_SIZE = 4096
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._monitor = None
+        self._available = None
+        self._events = collections.deque(maxlen=self.EVENT_LOG_SIZE)
+        self._seq = 0
+
+    def _get_monitor(self):
+        if self._available is None:
+            self._available = False
+            if os.geteuid() != 0 or not os.path.exists(UDEV_CONTROL):
+                return None
+            try:
+                import pyudev
+                monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+                monitor.filter_by('block')
+                monitor.start()
+            except Exception as e:
+                LOG.debug('udev monitor unavailable, using udevadm settle: '
+                          '%s', e)
+                return None
+            self._monitor = monitor
+            self._available = True
+        return self._monitor
+
+    def _receive(self, monitor, timeout):
+        """Receive one event into the log, with self._lock held.  Returns
+        False if no event arrived within timeout."""
+        try:
+            device = monitor.poll(timeout=timeout)
+        except EnvironmentError as e:
+            # e.g. ENOBUFS if events overflowed the socket while nobody
+            # was waiting; the path checks cover us.
+            LOG.debug('udev monitor receive failed: %s', e)
+            return False
+        if device is None:
+            return False
+        self._seq += 1
+        self._events.append((self._seq, device.action, device.device_node,
+                             tuple(device.device_links)))
+        return True
+
+    def _drain(self, monitor):
+        """Log the events received so far and return the number of the
+        last one.
+
+        Events from before a wait may announce a node that has been
+        removed or recreated since, so a wait only trusts later ones.
+        Waiters already running still see the drained events."""
+        while self._receive(monitor, timeout=0):
+            pass
+        return self._seq
+
+    @staticmethod
+    def _event_matches(event, devnode):
+        _seq, action, device_node, device_links = event
+        if action not in ('add', 'change'):
+            return False
+        return device_node == devnode or devnode in device_links
+
+    def wait(self, devnode, timeout=None):
+        """Wait until devnode exists.
+
+        :param devnode: path to a device node or udev symlink.
+        :param timeout: maximum number of seconds to wait.
+        :returns: seconds spent waiting, or None if the monitor is not
+                  available, udev went idle without creating devnode or
+                  the timeout expired.
+        """
+        monitor = self._get_monitor()
+        if monitor is None:
+            return None
+        if timeout is None:
+            timeout = UDEV_WAIT_TIMEOUT
+        start = time.monotonic()
+        with self._lock:
+            cursor = self._drain(monitor)
+        while True:
+            waited = time.monotonic() - start
+            if os.path.exists(devnode):
+                return waited
+            remaining = float(timeout) - waited
+            if remaining <= 0:
+                return None
+            with self._lock:
+                received = self._receive(
+                    monitor, timeout=min(remaining, UDEV_WAIT_SLICE))
+                events = [e for e in self._events if e[0] > cursor]
+                cursor = self._seq
+            if any(self._event_matches(e, devnode) for e in events):
+                # a later remove may already have undone the add
+                if os.path.exists(devnode):
+                    return time.monotonic() - start
+            elif not received and not os.path.exists(UDEV_QUEUE):
+                # udev is idle and devnode has not shown up, leave it
+                # to udevadm settle to decide
+                return None
+
+
+_DEVICE_WAITER = UdevDeviceWaiter()
+
+
 @logged_call()
 def udevadm_settle(exists=None, timeout=None):
+    with tracing.span('udevadm-settle', cat='udev', exists=exists):
+        _udevadm_settle(exists=exists, timeout=timeout)
+
+
+def _udevadm_settle(exists=None, timeout=None):
     settle_cmd = ["udevadm", "settle"]
     if exists:
         # skip the settle if the requested path already exists
         if os.path.exists(exists):
             return
+        waited = _DEVICE_WAITER.wait(exists, timeout=timeout)
+        if waited is not None:
+            LOG.debug('udevadm_settle: %s ready after %.3fs (udev monitor)',
+                      exists, waited)
+            return
         settle_cmd.extend(['--exit-if-exists=%s' % exists])
     if timeout:
         settle_cmd.extend(['--timeout=%s' % timeout])
 
-    util.subp(settle_cmd)
+    with _SETTLE_LOCK:
+        if exists and os.path.exists(exists):
+            return
+        start = time.monotonic()
+        util.subp(settle_cmd)
+        LOG.debug('udevadm_settle: %s took %.3fs', ' '.join(settle_cmd),
+                  time.monotonic() - start)
 
 
 def udevadm_trigger(devices):
@@ -1,10 +1,15 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
+from concurrent import futures
 from email.utils import parsedate
+import hashlib
+import http.client as http_client
 import json
 import os
 import socket
 import sys
+import tempfile
+import threading
 import time
 import uuid
 from functools import partial
@@ -15,6 +20,7 @@ try:
     from urllib import request as _u_re  # pylint: disable=no-name-in-module
     from urllib import error as _u_e     # pylint: disable=no-name-in-module
     from urllib.parse import urlparse    # pylint: disable=no-name-in-module
+    from urllib.parse import urljoin     # pylint: disable=no-name-in-module
     urllib_request = _u_re
     urllib_error = _u_e
 except ImportError:
@@ -22,6 +28,7 @@ except ImportError:
     import urllib2 as urllib_request
     import urllib2 as urllib_error
     from urlparse import urlparse  # pylint: disable=import-error
+    from urlparse import urljoin  # pylint: disable=import-error
 
 from .log import LOG
 
@@ -38,15 +45,97 @@ class _ReRaisedException(Exception):
         self.exc = exc
 
 
+class _ConnectionPool(object):
+    """Idle keep-alive http connections, by scheme and host."""
+
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def usable(url, data=None):
+        """connections are only pooled for plain GETs of http(s) urls
+        that do not go through a proxy"""
+        parsed = urlparse(url)
+        if data is not None or parsed.scheme not in ('http', 'https'):
+            return False
+        proxies = urllib_request.getproxies()
+        return (parsed.scheme not in proxies or
+                urllib_request.proxy_bypass(parsed.hostname or ''))
+
+    def get(self, key):
+        """return (connection, reused) for key, a (scheme, netloc) tuple"""
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self.connect(key), False
+
+    @staticmethod
+    def connect(key):
+        scheme, netloc = key
+        if scheme == 'https':
+            return http_client.HTTPSConnection(netloc)
+        return http_client.HTTPConnection(netloc)
+
+    def put(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+_POOL = _ConnectionPool()
+MAX_REDIRECTS = 5
+
+
 class UrlReader(object):
+    """Read url in chunks.
+
+    If offset or end is given, only the content from byte offset up to
+    end, or to the end of the content, is requested with a Range header.
+    A UrlError with reason RANGE_NOT_SUPPORTED is raised if the server
+    does not honor the range.  validator, the ETag or Last-Modified value
+    of an earlier response (see response_validator), is sent in an
+    If-Range header so the range is only served from that same content;
+    a UrlError with reason CONTENT_CHANGED is raised if it has changed.
+
+    Range requests of http(s) urls reuse keep-alive connections to the
+    same host, which are returned to a shared pool once the response has
+    been read completely.  Other requests go through urllib."""
     fp = None
+    _conn = None
+    _pool_key = None
 
-    def __init__(self, url, headers=None, data=None):
+    def __init__(self, url, headers=None, data=None, offset=0, end=None,
+                 validator=None):
         headers = _get_headers(headers)
+        ranged = bool(offset) or end is not None
+        if ranged:
+            headers['Range'] = 'bytes=%d-%s' % (
+                offset, '' if end is None else end - 1)
+            if validator:
+                headers['If-Range'] = validator
         self.url = url
         try:
-            req = urllib_request.Request(url=url, data=data, headers=headers)
-            self.fp = urllib_request.urlopen(req)
+            if ranged and _POOL.usable(url, data):
+                self._open_pooled(url, headers)
+            else:
+                req = urllib_request.Request(url=url, data=data,
+                                             headers=headers)
+                self.fp = urllib_request.urlopen(req)
+        except UrlError:
+            raise
         except urllib_error.HTTPError as exc:
             raise UrlError(exc, code=exc.code, headers=exc.headers, url=url,
                            reason=exc.reason)
@@ -56,6 +145,75 @@ class UrlReader(object):
 
         self.info = self.fp.info()
         self.size = self.info.get('content-length', -1)
+        if ranged:
+            self._check_range(validator)
+
+    def _check_range(self, validator):
+        code = self.fp.getcode()
+        reason = None
+        if code != 206:
+            # with If-Range, a server that supports ranges sends the whole
+            # content when it has changed
+            reason = CONTENT_CHANGED if validator else RANGE_NOT_SUPPORTED
+        elif (validator and validator.startswith('"') and
+                self.info.get('etag', validator) != validator):
+            # a server ignoring If-Range serves the range regardless
+            reason = CONTENT_CHANGED
+        if reason is None:
+            return
+        self.close()
+        raise UrlError(ValueError(reason), code=code, headers=self.info,
+                       url=self.url, reason=reason)
+
+    def _request(self, key, path, headers):
+        conn, reused = _POOL.get(key)
+        while True:
+            try:
+                conn.request('GET', path, headers=headers)
+                return conn, conn.getresponse()
+            except (http_client.HTTPException, OSError):
+                conn.close()
+                if not reused:
+                    raise
+            # the server closed the idle connection, retry on a new one
+            conn, reused = _POOL.connect(key), False
+
+    def _open_pooled(self, url, headers):
+        for _ in range(MAX_REDIRECTS + 1):
+            parsed = urlparse(url)
+            key = (parsed.scheme, parsed.netloc)
+            path = parsed.path or '/'
+            if parsed.query:
+                path += '?' + parsed.query
+            conn, resp = self._request(key, path, headers)
+            location = resp.getheader('location')
+            if resp.status in (301, 302, 303, 307, 308) and location:
+                resp.read()
+                self._release(key, conn, resp)
+                url = urljoin(url, location)
+                continue
+            # like urllib, treat 304 Not Modified as an error
+            if resp.status >= 400 or resp.status == 304:
+                conn.close()
+                exc = urllib_error.HTTPError(url, resp.status, resp.reason,
+                                             resp.msg, None)
+                raise UrlError(exc, code=resp.status, headers=resp.msg,
+                               url=url, reason=resp.reason)
+            self.fp = resp
+            self._conn = conn
+            self._pool_key = key
+            return
+        raise UrlError(ValueError('too many redirects'), code=None,
+                       headers=None, url=url, reason='too many redirects')
+
+    @staticmethod
+    def _release(key, conn, resp):
+        # a connection can only be reused once its response is consumed
+        if resp.isclosed() and not resp.will_close:
+            _POOL.put(key, conn)
+        else:
+            resp.close()
+            conn.close()
 
     def read(self, buflen):
         try:
@@ -71,9 +229,13 @@ class UrlReader(object):
         if not self.fp:
             return
         try:
-            self.fp.close()
+            if self._conn is not None:
+                self._release(self._pool_key, self._conn, self.fp)
+            else:
+                self.fp.close()
         finally:
             self.fp = None
+            self._conn = None
 
     def __enter__(self):
         return self
@@ -82,51 +244,330 @@ class UrlReader(object):
         self.close()
 
 
-def download(url, path, reporthook=None, data=None, retries=0, retry_delay=3):
+RANGE_NOT_SUPPORTED = 'range not supported'
+CONTENT_CHANGED = 'content changed'
+DOWNLOAD_BUFLEN = 1024 * 1024
+# files smaller than this are not split into concurrent range requests
+SPLIT_DOWNLOAD_MIN = 64 * 1024 * 1024
+# concurrent range requests used for large downloads, such as image layers
+DOWNLOAD_CONNECTIONS = 4
+
+
+def _retryable(error):
+    # connection errors have no code, retry them and server errors
+    return error.code is None or error.code >= 500
+
+
+def response_validator(info):
+    """Return the value of info, the headers of a response, that
+    identifies its content for an If-Range header: a strong ETag or the
+    Last-Modified date.  None if there is neither."""
+    etag = info.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return info.get('last-modified')
+
+
+def _open_at(url, pos, end=None, validator=None):
+    if pos or end is not None:
+        return UrlReader(url, offset=pos, end=end, validator=validator)
+    return UrlReader(url)
+
+
+def _pwrite_all(fd, buf, pos):
+    view = memoryview(buf)
+    while len(view):
+        count = os.pwrite(fd, view, pos)
+        view = view[count:]
+        pos += count
+
+
+def _fetch_range(url, fd, pos, end, rfp, retries, retry_delay, progress,
+                 validator=None):
+    """
+    write the content of url from byte pos up to end, or the end of the
+    content if end is None, into fd at the same offsets.  rfp is a
+    UrlReader already open at pos, or None.  Failed transfers are resumed
+    at the position reached, up to retries times, for as long as the
+    content still matches validator.  A transfer of the whole content
+    is restarted if it cannot be resumed.
+
+    Returns the position reached and the info of the last response.
+    """
+    start = pos
+    attempts = 0
+    while True:
+        try:
+            if rfp is None:
+                try:
+                    rfp = _open_at(url, pos, end, validator)
+                except UrlError as e:
+                    if (e.reason not in (RANGE_NOT_SUPPORTED,
+                                         CONTENT_CHANGED) or
+                            start or end is not None):
+                        raise
+                    LOG.debug('Cannot resume download of %s: %s, '
+                              'restarting download', url, e.reason)
+                    pos = 0
+                    rfp = UrlReader(url)
+                    validator = response_validator(rfp.info)
+            info = rfp.info
+            # a connection dropped part way through a response may just
+            # look like the end of the content, so check its length
+            limit = end
+            if limit is None and int(rfp.size) >= 0:
+                limit = pos + int(rfp.size)
+            while limit is None or pos < limit:
+                buflen = DOWNLOAD_BUFLEN
+                if limit is not None:
+                    buflen = min(buflen, limit - pos)
+                buf = rfp.read(buflen)
+                if not buf:
+                    break
+                _pwrite_all(fd, buf, pos)
+                pos += len(buf)
+                progress(len(buf), rfp.size)
+            if limit is not None and pos < limit:
+                raise UrlError(ValueError('short read'), code=None, url=url,
+                               reason='content ended at %s, expected %s' %
+                               (pos, limit))
+            return pos, info
+        except UrlError as e:
+            # retry on connection and internal server errors up to
+            # "retries #", resuming where the transfer stopped
+            if not _retryable(e) or attempts >= retries:
+                raise e
+            LOG.debug("Current download failed at byte %s with error: %s. "
+                      "Retrying in %d seconds.", pos, e, retry_delay)
+            attempts += 1
+            time.sleep(retry_delay)
+        finally:
+            if rfp is not None:
+                rfp.close()
+                rfp = None
+
+
+def _split_ranges(size, connections):
+    step = -(-size // connections)
+    return [(pos, min(pos + step, size)) for pos in range(0, size, step)]
+
+
+def download(url, path, reporthook=None, data=None, retries=0, retry_delay=3,
+             connections=1, headers=None):
     """Download url to path.
 
     reporthook is compatible with py3 urllib.request.urlretrieve.
-    urlretrieve does not exist in py2."""
+    urlretrieve does not exist in py2.
 
-    buflen = 8192
-    attempts = 0
+    Transfers failing with a connection or server error are retried up to
+    retries times, resuming from where they stopped with a Range request
+    when the server allows it and the content has not changed.  If
+    connections is greater than 1, files of at least SPLIT_DOWNLOAD_MIN
+    bytes from servers accepting range requests, and identifying the
+    content with an ETag or Last-Modified header, are fetched as that many
+    concurrent range requests.
+
+    headers are sent with the initial request only, so conditional
+    requests fail with a UrlError with code 304 if the content has not
+    changed."""
 
+    attempts = 0
     while True:
-        wfp = open(path, "wb")
         try:
-            buf = None
-            blocknum = 0
-            fsize = 0
-            start = time.time()
-            with UrlReader(url) as rfp:
-                if reporthook:
-                    reporthook(blocknum, buflen, rfp.size)
-
-                while True:
-                    buf = rfp.read(buflen)
-                    if not buf:
-                        break
-                    blocknum += 1
-                    if reporthook:
-                        reporthook(blocknum, buflen, rfp.size)
-                    wfp.write(buf)
-                    fsize += len(buf)
-            timedelta = time.time() - start
-            LOG.debug("Downloaded %d bytes from %s to %s in %.2fs (%.2fMbps)",
-                      fsize, url, path, timedelta,
-                      fsize / timedelta / 1024 / 1024)
-            return path, rfp.info
+            if headers:
+                rfp = UrlReader(url, headers=headers)
+            else:
+                rfp = UrlReader(url)
+            break
         except UrlError as e:
             # retry on internal server errors up to "retries #"
-            if (e.code < 500 or attempts >= retries):
+            if not _retryable(e) or attempts >= retries:
                 raise e
             LOG.debug("Current download failed with error: %s. Retrying in"
                       " %d seconds.",
                       e.code, retry_delay)
             attempts += 1
             time.sleep(retry_delay)
+
+    lock = threading.Lock()
+    blocknum = [0]
+
+    def progress(count, size):
+        if not reporthook:
+            return
+        with lock:
+            blocknum[0] += 1
+            reporthook(blocknum[0], DOWNLOAD_BUFLEN, rfp.size)
+
+    # ranges are only combined when they can be checked to come from the
+    # same content
+    validator = response_validator(rfp.info)
+    ranges = []
+    if (connections > 1 and rfp.info.get('accept-ranges') == 'bytes' and
+            validator and int(rfp.size) >= SPLIT_DOWNLOAD_MIN):
+        ranges = _split_ranges(int(rfp.size), connections)
+
+    start = time.time()
+    info = rfp.info
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    except OSError:
+        rfp.close()
+        raise
+    try:
+        if reporthook:
+            reporthook(0, DOWNLOAD_BUFLEN, rfp.size)
+        if not ranges:
+            fsize, info = _fetch_range(url, fd, 0, None, rfp, retries,
+                                       retry_delay, progress, validator)
+            os.ftruncate(fd, fsize)
+        else:
+            LOG.debug('Downloading %s in %s ranges', url, len(ranges))
+            fsize = int(rfp.size)
+            os.ftruncate(fd, fsize)
+            with futures.ThreadPoolExecutor(len(ranges)) as executor:
+                pending = [
+                    executor.submit(_fetch_range, url, fd, pos, end,
+                                    rfp if pos == 0 else None, retries,
+                                    retry_delay, progress, validator)
+                    for (pos, end) in ranges]
+            for future in pending:
+                future.result()
+    finally:
+        os.close(fd)
+    timedelta = time.time() - start
+    LOG.debug("Downloaded %d bytes from %s to %s in %.2fs (%.2fMbps)",
+              fsize, url, path, timedelta,
+              fsize / max(timedelta, 0.001) / 1024 / 1024)
+    return path, info
+
+
+class DownloadCache(object):
+    """An on-disk cache of downloaded files.
+
+    Files downloaded with an expected sha256 are stored by that checksum
+    and used without contacting the server again.  Other files are stored
+    by the sha256 of their url, along with the ETag and Last-Modified
+    validators the server sent, and are revalidated with a conditional
+    GET before use.
+
+    Once the cache grows past max_size bytes, the least recently used
+    entries are evicted, except those used by this process."""
+
+    META_SUFFIX = '.json'
+    PARTIAL_SUFFIX = '.partial'
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        self._in_use = set()
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _key(self, url, sha256=None):
+        if sha256:
+            return 'sha256-' + sha256.lower()
+        return 'url-' + hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def _load_meta(self, entry):
+        try:
+            with open(entry + self.META_SUFFIX) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+    def _use(self, entry):
+        with self._lock:
+            self._in_use.add(entry)
+        # the modification time orders entries for eviction
+        os.utime(entry)
+        return entry
+
+    def fetch(self, url, sha256=None, **kwargs):
+        """
+        return the path to a cached copy of url, downloading it with
+        download() and kwargs if it is not cached or has changed.
+        """
+        entry = os.path.join(self.path, self._key(url, sha256))
+        cached = os.path.isfile(entry)
+        if cached and sha256:
+            LOG.debug('Using cached %s for %s', entry, url)
+            return self._use(entry)
+
+        headers = {}
+        if cached:
+            meta = self._load_meta(entry)
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        fd, partial = tempfile.mkstemp(
+            dir=self.path, prefix=os.path.basename(entry) + '.',
+            suffix=self.PARTIAL_SUFFIX)
+        os.close(fd)
+        try:
+            try:
+                _, info = download(url, partial, headers=headers or None,
+                                   **kwargs)
+            except UrlError as e:
+                if cached and headers and e.code == 304:
+                    LOG.debug('Cached %s for %s is current', entry, url)
+                    return self._use(entry)
+                raise
+            if sha256:
+                digest = hashlib.sha256()
+                with open(partial, 'rb') as fp:
+                    for buf in iter(lambda: fp.read(DOWNLOAD_BUFLEN), b''):
+                        digest.update(buf)
+                if digest.hexdigest() != sha256.lower():
+                    raise ValueError(
+                        'sha256 mismatch for %s: expected %s got %s' %
+                        (url, sha256, digest.hexdigest()))
+            os.replace(partial, entry)
         finally:
-            wfp.close()
+            if os.path.exists(partial):
+                os.unlink(partial)
+
+        meta = {'url': url, 'etag': info.get('etag'),
+                'last_modified': info.get('last-modified')}
+        with open(entry + self.META_SUFFIX, 'w') as fp:
+            json.dump(meta, fp)
+        LOG.debug('Cached %s as %s', url, entry)
+        self._use(entry)
+        self.evict()
+        return entry
+
+    def evict(self):
+        """remove least recently used entries until the cache fits in
+        max_size, returning the paths of the removed entries"""
+        if self.max_size is None:
+            return []
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith((self.META_SUFFIX, self.PARTIAL_SUFFIX)):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for (_, size, _) in entries)
+        removed = []
+        with self._lock:
+            for (_, size, name) in sorted(entries):
+                if total <= self.max_size:
+                    break
+                entry = os.path.join(self.path, name)
+                if entry in self._in_use:
+                    continue
+                LOG.debug('Evicting %s from download cache', entry)
+                for path in (entry, entry + self.META_SUFFIX):
+                    if os.path.exists(path):
+                        os.unlink(path)
+                total -= size
+                removed.append(entry)
+        return removed
 
 
 def get_maas_version(endpoint):
@@ -16,6 +16,7 @@ import subprocess
 import stat
 import sys
 import tempfile
+import threading
 import time
 from typing import Dict, List, Optional
 
@@ -48,7 +49,7 @@ try:
 except NameError:
     FileMissingError = IOError
 
-from . import paths
+from . import paths, target_executor, tracing
 from .log import LOG, log_call
 
 binary_type = bytes
@@ -60,6 +61,12 @@ _INSTALLED_MAIN = 'usr/bin/curtin'
 
 _USES_SYSTEMD = None
 _HAS_UNSHARE_PID = None
+# target path -> TargetExecutor running commands there, see ChrootableTarget
+_TARGET_EXECUTORS = {}
+# target path -> the ChrootableTarget that set up the target, whose mounts,
+# resolv.conf and daemon policy ChrootableTargets entered meanwhile share
+_CHROOT_SESSIONS = {}
+_chroot_sessions_lock = threading.Lock()
 
 
 _DNS_REDIRECT_IP = None
@@ -73,6 +80,10 @@ class NotExclusiveError(OSError):
     EBUSY '''
 
 
+# the exit code of the last _subp call of each thread, for accounting
+_subp_result = threading.local()
+
+
 def _subp(args, data=None, stdin=None, rcs=None, env=None, capture=False,
           combine_capture=False, shell=False, logstring=False,
           decode="replace", target=None, cwd=None, log_captured=False,
@@ -111,17 +122,27 @@ def _subp(args, data=None, stdin=None, rcs=None, env=None, capture=False,
     if isinstance(args, string_types):
         args = [args]
 
-    try:
-        unshare_args = _get_unshare_pid_args(unshare_pid, tpath)
-    except RuntimeError as e:
-        raise RuntimeError("Unable to unshare pid (cmd=%s): %s" % (args, e))
+    executor = None
+    if tpath != "/" and unshare_pid is None and stdin is None:
+        executor = _TARGET_EXECUTORS.get(tpath)
 
-    args = unshare_args + chroot_args + sh_args + list(args)
+    if executor is not None:
+        # the executor already runs in the target's pid namespace and root
+        args = sh_args + list(args)
+    else:
+        try:
+            unshare_args = _get_unshare_pid_args(unshare_pid, tpath)
+        except RuntimeError as e:
+            raise RuntimeError(
+                "Unable to unshare pid (cmd=%s): %s" % (args, e))
+
+        args = unshare_args + chroot_args + sh_args + list(args)
 
     if not logstring:
         LOG.debug(
-            "Running command %s with allowed return codes %s (capture=%s)",
-            args, rcs, 'combine' if combine_capture else capture)
+            "Running command %s%s with allowed return codes %s (capture=%s)",
+            args, " in target executor" if executor is not None else "",
+            rcs, 'combine' if combine_capture else capture)
     else:
         LOG.debug(("Running hidden command to protect sensitive "
                    "input/output logstring: %s"), logstring)
@@ -143,11 +164,18 @@ def _subp(args, data=None, stdin=None, rcs=None, env=None, capture=False,
         else:
             devnull_fp = open(os.devnull)
             stdin = devnull_fp
-        sp = subprocess.Popen(args, stdout=stdout,
-                              stderr=stderr, stdin=stdin,
-                              env=env, shell=False, cwd=cwd)
-        # communicate in python2 returns str, python3 returns bytes
-        (out, err) = sp.communicate(data)
+        if executor is not None:
+            (rc, out, err) = executor.run(
+                args, env=env, data=data,
+                capture=('combine' if combine_capture else
+                         'pipe' if capture else None))
+        else:
+            sp = subprocess.Popen(args, stdout=stdout,
+                                  stderr=stderr, stdin=stdin,
+                                  env=env, shell=False, cwd=cwd)
+            # communicate in python2 returns str, python3 returns bytes
+            (out, err) = sp.communicate(data)
+            rc = sp.returncode  # pylint: disable=E1101
 
         # Just ensure blank instead of none.
         if capture or combine_capture:
@@ -172,7 +200,7 @@ def _subp(args, data=None, stdin=None, rcs=None, env=None, capture=False,
     if capture and log_captured:
         LOG.debug("Command returned stdout=%s, stderr=%s", out, err)
 
-    rc = sp.returncode  # pylint: disable=E1101
+    _subp_result.rc = rc
     if rc not in rcs:
         raise ProcessExecutionError(stdout=out, stderr=err,
                                     exit_code=rc,
@@ -320,17 +348,48 @@ def subp(*args, **kwargs):
     if 'args' in kwargs:
         cmd = kwargs['args']
 
-    # Retry with waits between the retried command.
-    for num, wait in enumerate(retries):
-        try:
-            return _subp(*args, **kwargs)
-        except ProcessExecutionError as e:
-            LOG.debug("try %s: command %s failed, rc: %s", num,
-                      cmd, e.exit_code)
-            time.sleep(wait)
-    # Final try without needing to wait or catch the error. If this
-    # errors here then it will be raised to the caller.
-    return _subp(*args, **kwargs)
+    # commands with a logstring are not logged, nor traced, as they are
+    traced = kwargs.get('logstring') or cmd
+    if isinstance(traced, (list, tuple)):
+        name = os.path.basename(str(traced[0])) if traced else ''
+    else:
+        name = str(traced).split(' ', 1)[0]
+    span = tracing.span(name, cat='subp', cmd=traced,
+                        argv=tracing.argv_class(traced))
+    start = time.monotonic()
+    num = 0
+    rc = None
+    captured = 0
+    try:
+        with span:
+            try:
+                # Retry with waits between the retried command.
+                for num, wait in enumerate(retries):
+                    try:
+                        out, err = _subp(*args, **kwargs)
+                        break
+                    except ProcessExecutionError as e:
+                        LOG.debug("try %s: command %s failed, rc: %s", num,
+                                  cmd, e.exit_code)
+                        time.sleep(wait)
+                else:
+                    num = len(retries)
+                    # Final try without needing to wait or catch the error.
+                    # If this errors here then it will be raised to the
+                    # caller.
+                    out, err = _subp(*args, **kwargs)
+                rc = getattr(_subp_result, 'rc', 0)
+                captured = len(out or '') + len(err or '')
+            except ProcessExecutionError as e:
+                # rc stays None when the command could not be run
+                rc = e.exit_code if isinstance(e.exit_code, int) else None
+                raise
+            finally:
+                span.args.update(rc=rc, retries=num, captured=captured)
+    finally:
+        tracing.account_subp(span.args['argv'], time.monotonic() - start,
+                             rc, num, captured)
+    return (out, err)
 
 
 def wait_for_removal(path, retries=[1, 3, 5, 7]):
@@ -463,9 +522,12 @@ class LogTimer(object):
 
     def __enter__(self):
         self.start = time.time()
+        self._span = tracing.span(self.msg, cat='timer')
+        self._span.__enter__()
         return self
 
     def __exit__(self, etype, value, trace):
+        self._span.__exit__(etype, value, trace)
         self.logfunc("%s took %0.3f seconds" %
                      (self.msg, time.time() - self.start))
 
@@ -766,8 +828,13 @@ def undisable_daemons_in_root(target):
 
 
 class ChrootableTarget(object):
+    # run subp commands in the target through a TargetExecutor while
+    # entered, unless given otherwise; see the curthooks target_executor
+    # config
+    use_executor = False
+
     def __init__(self, target, allow_daemons=False, sys_resolvconf=True,
-                 mounts=None):
+                 mounts=None, executor=None):
         if target is None:
             target = "/"
         self.target = paths.target_path(target)
@@ -783,8 +850,111 @@ class ChrootableTarget(object):
         self.sys_resolvconf = sys_resolvconf
         self.rconf_d = None
         self.rc_tmp = None
+        if executor is None:
+            executor = self.use_executor
+        self.executor = executor
+        self._executor = None
+        # the ChrootableTarget that set up the target, and for that one the
+        # number of ChrootableTargets using it
+        self.session = None
+        self.users = 0
+        self.toggled_daemons = False
+
+    def _start_executor(self):
+        if self.target == "/" or self.target in _TARGET_EXECUTORS:
+            # an enclosing ChrootableTarget already runs one
+            return
+        try:
+            unshare_args = _get_unshare_pid_args(None, self.target)
+        except RuntimeError as e:
+            LOG.debug("Not running a target executor: %s", e)
+            return
+        if not unshare_args:
+            LOG.debug("Not running a target executor: unable to unshare pid")
+            return
+        try:
+            executor = target_executor.TargetExecutor(
+                self.target, unshare_args).start()
+        except OSError as e:
+            LOG.warning("Unable to start target executor in %s: %s",
+                        self.target, e)
+            return
+        LOG.debug("Started target executor in %s", self.target)
+        self._executor = _TARGET_EXECUTORS[self.target] = executor
+
+    def _stop_executor(self):
+        if self._executor is None:
+            return
+        _TARGET_EXECUTORS.pop(self.target, None)
+        self._executor.close()
+        self._executor = None
+        LOG.debug("Stopped target executor in %s", self.target)
 
     def __enter__(self):
+        with _chroot_sessions_lock:
+            session = _CHROOT_SESSIONS.get(self.target)
+            if session is not None:
+                self._join(session)
+            else:
+                self._setup()
+                self.session = self
+                self.users = 1
+                _CHROOT_SESSIONS[self.target] = self
+        return self
+
+    def __exit__(self, etype, value, trace):
+        if self.session is None:
+            # never entered through __enter__
+            self._teardown()
+            return
+        with _chroot_sessions_lock:
+            if self.session is not self:
+                self._leave()
+            self.session.users -= 1
+            if self.session.users == 0:
+                if _CHROOT_SESSIONS.get(self.target) is self.session:
+                    del _CHROOT_SESSIONS[self.target]
+                self.session._teardown()
+            self.session = None
+
+    def _join(self, session):
+        """Use the target as set up by session, adding only the mounts and
+        daemon policy that differ."""
+        LOG.debug("Reusing chroot of %s", self.target)
+        self.session = session
+        session.users += 1
+        for p in self.mounts:
+            tpath = paths.target_path(self.target, p)
+            if do_mount(p, tpath, opts='--bind'):
+                self.umounts.append(tpath)
+        if self.allow_daemons:
+            if session.disabled_daemons:
+                self.toggled_daemons = undisable_daemons_in_root(self.target)
+        elif self.target != "/":
+            self.toggled_daemons = disable_daemons_in_root(self.target)
+        if self.executor:
+            self._start_executor()
+
+    def _leave(self):
+        self._stop_executor()
+        if self.toggled_daemons:
+            if self.allow_daemons:
+                disable_daemons_in_root(self.target)
+            else:
+                undisable_daemons_in_root(self.target)
+            self.toggled_daemons = False
+        self._umount()
+
+    def _umount(self):
+        # if /dev is to be unmounted, udevadm settle (LP: #1462139)
+        if paths.target_path(self.target, "/dev") in self.umounts:
+            log_call(subp, ['udevadm', 'settle'])
+
+        for p in reversed(self.umounts):
+            do_umount(p, private=True)
+        self.umounts = []
+
+    def _setup(self):
         for p in self.mounts:
             tpath = paths.target_path(self.target, p)
             if do_mount(p, tpath, opts='--bind'):
@@ -829,18 +999,18 @@ class ChrootableTarget(object):
                                    opts='--bind'):
             self.umounts.append(ischroot_mount_path)
 
-        return self
+        if self.executor:
+            self._start_executor()
+
+    def _teardown(self):
+        # stop the executor, and anything left in its namespace, before
+        # unmounting what it may use
+        self._stop_executor()
 
-    def __exit__(self, etype, value, trace):
         if self.disabled_daemons:
             undisable_daemons_in_root(self.target)
 
-        # if /dev is to be unmounted, udevadm settle (LP: #1462139)
-        if paths.target_path(self.target, "/dev") in self.umounts:
-            log_call(subp, ['udevadm', 'settle'])
-
-        for p in reversed(self.umounts):
-            do_umount(p, private=True)
+        self._umount()
 
         rconf = paths.target_path(self.target, "/etc/resolv.conf")
         if self.sys_resolvconf and self.rconf_d:
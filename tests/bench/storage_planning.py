@@ -0,0 +1,174 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""Time the storage planning phases on synthetic probe data.
+
+Each phase runs on the result of the ones before it, mirroring what
+happens between probing a machine and block-meta running its storage
+actions.  Run it with tools/bench-storage-planning.
+"""
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+from curtin import storage_config
+from curtin.commands import block_meta
+
+from .synthetic_probe import make_probe_data
+
+
+def _extract(state):
+    state['storage'] = storage_config.extract_storage_config(
+        state['probe_data'], strict=True)['storage']
+    state['sconfig'] = storage_config.extract_storage_ordered_dict(
+        {'storage': state['storage']})
+
+
+def _validate(state):
+    storage_config.validate_config(state['storage'])
+
+
+def _dependencies(state):
+    sconfig = state['sconfig']
+    for item_id in sconfig:
+        storage_config.find_item_dependencies(item_id, sconfig)
+
+
+def _graph(state):
+    storage_config.StorageConfigGraph(state['sconfig']).ordered()
+
+
+def _plan(state):
+    block_meta.plan_storage_action_deps(state['sconfig'])
+
+
+# name, function, description
+PHASES = [
+    ('extract', _extract, 'extract_storage_config from probe data'),
+    ('validate', _validate, 'validate_config of the extracted config'),
+    ('dependencies', _dependencies,
+     'find_item_dependencies of every item'),
+    ('graph', _graph, 'StorageConfigGraph ordering of every item'),
+    ('plan', _plan, 'block_meta.plan_storage_action_deps'),
+]
+
+
+def measure(func, state, repeat=1, memory=True):
+    """Return the best time in seconds of repeat runs of func(state) and,
+    if memory is true, the peak memory in bytes it allocates."""
+    best = None
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        func(state)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            func(state)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return best, peak
+
+
+def run(layout, phases=None, repeat=1, memory=True):
+    """Generate probe data for layout, the keyword arguments of
+    make_probe_data, and measure phases, all of them by default.
+
+    Returns a dict with the number of devices in the extracted config and
+    the seconds and peak bytes of each phase."""
+    if phases is None:
+        phases = [name for name, _func, _desc in PHASES]
+    state = {'probe_data': make_probe_data(**layout)}
+    results = {'layout': dict(layout), 'phases': {}}
+    for name, func, _desc in PHASES:
+        # the later phases need what extract produces
+        if name not in phases and name != 'extract':
+            continue
+        seconds, peak = measure(func, state, repeat=repeat, memory=memory)
+        if name in phases:
+            results['phases'][name] = {'seconds': seconds, 'peak': peak}
+    results['devices'] = len(state['sconfig'])
+    return results
+
+
+def format_results(results):
+    lines = ['%d devices from %s' % (
+        results['devices'],
+        ', '.join('%s=%s' % kv for kv in sorted(results['layout'].items())))]
+    lines.append('%-14s %12s %14s' % ('phase', 'seconds', 'peak KiB'))
+    for name, _func, _desc in PHASES:
+        if name not in results['phases']:
+            continue
+        phase = results['phases'][name]
+        peak = '-' if phase['peak'] is None else '%d' % (phase['peak'] // 1024)
+        lines.append('%-14s %12.4f %14s' % (name, phase['seconds'], peak))
+    return '\n'.join(lines)
+
+
+def _limit(value):
+    name, _, seconds = value.partition('=')
+    if name not in [phase[0] for phase in PHASES]:
+        raise argparse.ArgumentTypeError('unknown phase %s' % name)
+    try:
+        return name, float(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid seconds in %s' % value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        epilog='phases: ' + '; '.join(
+            '%s: %s' % (name, desc) for name, _func, desc in PHASES))
+    for arg, default, desc in [
+            ('disks', 64, 'partitioned disks'),
+            ('partitions', 8, 'partitions on each disk'),
+            ('raid', 32, 'raid1 arrays of two partitions'),
+            ('lvm', 32, 'volume groups of two partitions'),
+            ('bcache', 32, 'bcache devices of two partitions'),
+            ('dmcrypt', 32, 'dm-crypt volumes of one partition'),
+            ('multipath', 8, 'multipath disks')]:
+        parser.add_argument('--' + arg, type=int, default=default,
+                            help='number of %s (default %d)' % (
+                                desc, default))
+    parser.add_argument('--phase', action='append', dest='phases',
+                        choices=[name for name, _func, _desc in PHASES],
+                        help='phase to measure, may be repeated '
+                             '(default all)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='runs of each phase to take the best time of')
+    parser.add_argument('--no-memory', action='store_false', dest='memory',
+                        help='do not measure peak memory')
+    parser.add_argument('--max-seconds', action='append', type=_limit,
+                        default=[], metavar='PHASE=SECONDS',
+                        help='fail if PHASE takes longer than SECONDS')
+    parser.add_argument('--json', action='store_true',
+                        help='write the results as json')
+    args = parser.parse_args(argv)
+
+    layout = {key: getattr(args, key) for key in (
+        'disks', 'partitions', 'raid', 'lvm', 'bcache', 'dmcrypt',
+        'multipath')}
+    results = run(layout, phases=args.phases, repeat=args.repeat,
+                  memory=args.memory)
+    if args.json:
+        print(json.dumps(results, indent=1, sort_keys=True))
+    else:
+        print(format_results(results))
+
+    ret = 0
+    for name, limit in args.max_seconds:
+        phase = results['phases'].get(name)
+        if phase is not None and phase['seconds'] > limit:
+            sys.stderr.write('%s took %.4fs, more than %.4fs\n' % (
+                name, phase['seconds'], limit))
+            ret = 1
+    return ret
+
+# vi: ts=4 expandtab syntax=python
@@ -0,0 +1,282 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+"""Generate synthetic probert storage data of any size.
+
+make_probe_data returns probe data, in the format of the
+tests/data/probert_storage_*.json fixtures, for a number of gpt
+partitioned disks.  The partitions are handed out, spread over the disks,
+as members of raid1 arrays, lvm volume groups, bcache backing and cache
+devices and dm-crypt volumes; every device left at the top of a stack
+gets an ext4 filesystem that is mounted.  Multipath disks, each seen
+through two paths, hold plain partitions with filesystems.
+"""
+
+import string
+import uuid
+
+SECTOR = 512
+LINUX_GUID = '0fc63daf-8483-4772-8e79-3d69d8477de4'
+_UUID_NAMESPACE = uuid.UUID('0d5ff9a4-7c3e-4bb5-9c55-e4c4bd3b1f6e')
+
+
+def _uuid(name):
+    return str(uuid.uuid5(_UUID_NAMESPACE, name))
+
+
+def disk_name(index, prefix='sd'):
+    """Return the kernel name of disk index: sda ... sdz, sdaa ..."""
+    letters = ''
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        letters = string.ascii_lowercase[rem] + letters
+    return prefix + letters
+
+
+class _Builder(object):
+
+    def __init__(self, disk_size, part_size):
+        self.disk_size = disk_size
+        self.part_size = part_size
+        self.blockdev = {}
+        self.filesystem = {}
+        self.mounts = []
+        self.dm_count = 0
+
+    def _blockdev(self, devname, devpath, devlinks=(), **props):
+        data = {
+            'DEVLINKS': ' '.join(devlinks),
+            'DEVNAME': devname,
+            'DEVPATH': devpath,
+            'DEVTYPE': 'disk',
+            'MAJOR': '8',
+            'SUBSYSTEM': 'block',
+            'attrs': {'size': str(self.part_size)},
+        }
+        data.update(props)
+        self.blockdev[devname] = data
+        return data
+
+    def _virtual(self, kname, devlinks=(), **props):
+        props.setdefault('MAJOR', '253')
+        return self._blockdev('/dev/' + kname,
+                              '/devices/virtual/block/' + kname,
+                              devlinks, **props)
+
+    def next_dm(self):
+        kname = 'dm-%d' % self.dm_count
+        self.dm_count += 1
+        return kname
+
+    def _ptable(self, devname, nodes):
+        part_sectors = self.part_size // SECTOR
+        partitions = []
+        for number, node in enumerate(nodes, 1):
+            partitions.append({
+                'node': node,
+                'start': 2048 + (number - 1) * part_sectors,
+                'size': part_sectors,
+                'type': LINUX_GUID.upper(),
+                'uuid': _uuid(node).upper(),
+            })
+        return {'label': 'gpt', 'id': _uuid(devname).upper(),
+                'device': devname, 'unit': 'sectors',
+                'partitions': partitions}
+
+    def _partition_props(self, number, ptable):
+        entry = ptable['partitions'][number - 1]
+        return {
+            'DEVTYPE': 'partition',
+            'ID_PART_ENTRY_NUMBER': str(number),
+            'ID_PART_ENTRY_SCHEME': 'gpt',
+            'ID_PART_ENTRY_TYPE': LINUX_GUID,
+            'ID_PART_ENTRY_UUID': entry['uuid'].lower(),
+            'PARTN': str(number),
+        }
+
+    def disk(self, kname, partitions):
+        devname = '/dev/' + kname
+        devpath = '/devices/pci0000:00/0000:00:04.0/block/' + kname
+        nodes = ['%s%d' % (devname, n) for n in range(1, partitions + 1)]
+        ptable = self._ptable(devname, nodes)
+        self._blockdev(
+            devname, devpath, ['/dev/disk/by-id/wwn-' + kname],
+            ID_SERIAL='serial-' + kname, ID_PART_TABLE_TYPE='gpt',
+            partitiontable=ptable, attrs={'size': str(self.disk_size)})
+        for number, node in enumerate(nodes, 1):
+            props = self._partition_props(number, ptable)
+            props['attrs'] = {
+                'partition': str(number),
+                'start': str(ptable['partitions'][number - 1]['start']),
+                'size': str(self.part_size),
+            }
+            self._blockdev(node, '%s/%s%d' % (devpath, kname, number),
+                           ['/dev/disk/by-id/wwn-%s-part%d' % (kname, number)],
+                           **props)
+        return nodes
+
+    def multipath_disk(self, name, paths, partitions):
+        wwn = '0x%016x' % (0x5000000000000000 + len(self.blockdev))
+        for path in paths:
+            self._blockdev(
+                '/dev/' + path, '/devices/pci0000:00/0000:00:05.0/block/' +
+                path, DM_MULTIPATH_DEVICE_PATH='1', ID_WWN=wwn,
+                ID_FS_TYPE='mpath_member')
+        kname = self.next_dm()
+        mapper = '/dev/mapper/' + name
+        nodes = ['%s-part%d' % (mapper, n) for n in range(1, partitions + 1)]
+        ptable = self._ptable('/dev/' + kname, nodes)
+        self._virtual(kname, [mapper, '/dev/disk/by-id/dm-name-' + name],
+                      DM_NAME=name, DM_UUID='mpath-' + wwn, DM_WWN=wwn,
+                      ID_PART_TABLE_TYPE='gpt', partitiontable=ptable,
+                      attrs={'size': str(self.disk_size)})
+        devnames = []
+        for number, node in enumerate(nodes, 1):
+            part_kname = self.next_dm()
+            props = self._partition_props(number, ptable)
+            props['DEVTYPE'] = 'disk'
+            self._virtual(part_kname, [node],
+                          DM_NAME='%s-part%d' % (name, number),
+                          DM_MPATH=name, DM_PART=str(number),
+                          DM_UUID='part%d-mpath-%s' % (number, wwn), **props)
+            devnames.append('/dev/' + part_kname)
+        return devnames
+
+    def raid(self, kname, devices):
+        data = self._virtual(
+            kname, ['/dev/disk/by-id/md-name-' + kname], MAJOR='9',
+            MD_LEVEL='raid1', MD_METADATA='1.2', MD_UUID=_uuid(kname))
+        return dict(data, devices=list(devices), raidlevel='raid1',
+                    spare_devices=[])
+
+    def lvm_volume(self, vg_name, lv_name):
+        kname = self.next_dm()
+        self._virtual(kname, ['/dev/%s/%s' % (vg_name, lv_name),
+                              '/dev/mapper/%s-%s' % (vg_name, lv_name)],
+                      DM_LV_NAME=lv_name, DM_VG_NAME=vg_name,
+                      DM_NAME='%s-%s' % (vg_name, lv_name),
+                      DM_UUID='LVM-' + _uuid(lv_name))
+        return '/dev/' + kname
+
+    def bcache(self, kname, backing_uuid):
+        self._virtual(kname, ['/dev/bcache/by-uuid/' + backing_uuid],
+                      MAJOR='251')
+
+    def dmcrypt(self, name):
+        kname = self.next_dm()
+        self._virtual(kname, ['/dev/mapper/' + name], DM_NAME=name,
+                      DM_UUID='CRYPT-LUKS2-%s-%s' % (
+                          _uuid(name).replace('-', ''), name))
+        return '/dev/' + kname
+
+    def format(self, devname, fstype='ext4', mount=True):
+        usage = 'crypto' if fstype == 'crypto_LUKS' else 'filesystem'
+        self.filesystem[devname] = {'TYPE': fstype, 'USAGE': usage,
+                                    'UUID': _uuid('fs' + devname)}
+        if mount:
+            self.mounts.append({
+                'source': devname, 'fstype': fstype, 'options': 'rw',
+                'target': '/srv/%s' % devname.replace('/', '_')[1:]})
+
+
+def make_probe_data(disks=4, partitions=4, raid=0, lvm=0, bcache=0,
+                    dmcrypt=0, multipath=0, disk_size=100 * 2 ** 30):
+    """Return probert storage data for the layout described.
+
+    :param disks: number of partitioned disks.
+    :param partitions: number of partitions on each disk and each
+        multipath disk.
+    :param raid: number of raid1 arrays, each from two partitions.
+    :param lvm: number of volume groups, each from two partitions and
+        holding one logical volume.
+    :param bcache: number of bcache devices, each from a backing and a
+        cache partition.
+    :param dmcrypt: number of dm-crypt volumes, each on one partition.
+    :param multipath: number of multipath disks, each with two paths.
+    :param disk_size: size of every disk in bytes.
+    :raises ValueError: if the layers need more partitions than the disks
+        provide.
+    """
+    needed = 2 * raid + 2 * lvm + 2 * bcache + dmcrypt
+    if needed > disks * partitions:
+        raise ValueError('%d partitions needed but %d disks of %d provide '
+                         'only %d' % (needed, disks, partitions,
+                                      disks * partitions))
+    builder = _Builder(disk_size, disk_size // (partitions + 1))
+    per_disk = [builder.disk(disk_name(i), partitions) for i in range(disks)]
+    # hand out partitions across disks so members of one array or volume
+    # group sit on different disks
+    pool = [parts[n] for n in range(partitions) for parts in per_disk]
+    pool.reverse()
+    leaves = []
+
+    raids = {}
+    for i in range(raid):
+        kname = 'md%d' % i
+        raids['/dev/' + kname] = builder.raid(kname, [pool.pop(), pool.pop()])
+        leaves.append('/dev/' + kname)
+
+    volume_groups = {}
+    logical_volumes = {}
+    for i in range(lvm):
+        vg_name, lv_name = 'vg%d' % i, 'lv%d' % i
+        volume_groups[vg_name] = {'name': vg_name,
+                                  'devices': [pool.pop(), pool.pop()],
+                                  'size': '%dB' % (2 * builder.part_size)}
+        logical_volumes['%s/%s' % (vg_name, lv_name)] = {
+            'fullname': '%s/%s' % (vg_name, lv_name), 'name': lv_name,
+            'volgroup': vg_name, 'size': '%dB' % builder.part_size}
+        leaves.append(builder.lvm_volume(vg_name, lv_name))
+
+    backing = {}
+    caching = {}
+    for i in range(bcache):
+        kname = 'bcache%d' % i
+        backing_uuid, cset_uuid = _uuid(kname), _uuid('cset' + kname)
+        backing[backing_uuid] = {
+            'blockdev': pool.pop(),
+            'superblock': {'cset.uuid': cset_uuid,
+                           'dev.data.cache_mode': '1 [writeback]',
+                           'dev.label': kname, 'dev.uuid': backing_uuid}}
+        caching[_uuid('cache' + kname)] = {
+            'blockdev': pool.pop(), 'superblock': {'cset.uuid': cset_uuid}}
+        builder.bcache(kname, backing_uuid)
+        leaves.append('/dev/' + kname)
+
+    crypts = {}
+    for i in range(dmcrypt):
+        name = 'crypt%d' % i
+        volume = pool.pop()
+        builder.format(volume, fstype='crypto_LUKS', mount=False)
+        crypts[name] = {'name': name, 'blkdevs_used': volume[len('/dev/'):],
+                        'subsystem': 'CRYPT'}
+        leaves.append(builder.dmcrypt(name))
+
+    for i in range(multipath):
+        paths = [disk_name(2 * i, 'mp'), disk_name(2 * i + 1, 'mp')]
+        leaves.extend(builder.multipath_disk('mpath%d' % i, paths,
+                                             partitions))
+
+    for devname in leaves + sorted(pool):
+        builder.format(devname)
+
+    return {
+        'bcache': {'backing': backing, 'caching': caching},
+        'blockdev': builder.blockdev,
+        'dasd': {},
+        'dmcrypt': crypts,
+        'filesystem': builder.filesystem,
+        'lvm': {'logical_volumes': logical_volumes,
+                'physical_volumes': {
+                    name: vg['devices']
+                    for name, vg in volume_groups.items()},
+                'volume_groups': volume_groups},
+        'mount': [{'source': '/dev/root', 'target': '/', 'fstype': 'ext4',
+                   'options': 'rw', 'children': builder.mounts}],
+        'multipath': {},
+        'nvme': {},
+        'raid': raids,
+        'zfs': {'zpools': {}},
+    }
+
+# vi: ts=4 expandtab syntax=python
@@ -0,0 +1,59 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+from collections import Counter
+
+from .helpers import CiTestCase, skipUnlessJsonSchema
+from curtin import storage_config
+from tests.bench import storage_planning
+from tests.bench.synthetic_probe import disk_name, make_probe_data
+
+
+class TestSyntheticProbe(CiTestCase):
+
+    def test_disk_name(self):
+        self.assertEqual(['sda', 'sdz', 'sdaa', 'sdbz'],
+                         [disk_name(i) for i in (0, 25, 26, 77)])
+
+    def test_too_few_partitions(self):
+        with self.assertRaises(ValueError):
+            make_probe_data(disks=2, partitions=1, raid=1, dmcrypt=1)
+
+    @skipUnlessJsonSchema()
+    def test_extracts_every_layer(self):
+        probe_data = make_probe_data(disks=4, partitions=4, raid=2, lvm=1,
+                                     bcache=1, dmcrypt=2, multipath=1)
+        extracted = storage_config.extract_storage_config(probe_data,
+                                                          strict=True)
+        types = Counter(cfg['type']
+                        for cfg in extracted['storage']['config'])
+        self.assertEqual({
+            'disk': 5, 'partition': 20, 'raid': 2, 'lvm_volgroup': 1,
+            'lvm_partition': 1, 'bcache': 1, 'dm_crypt': 2,
+            # ten devices on top of stacks, six unused partitions and the
+            # two partitions holding dm-crypt volumes
+            'format': 18, 'mount': 16}, dict(types))
+
+
+class TestStoragePlanning(CiTestCase):
+
+    @skipUnlessJsonSchema()
+    def test_run(self):
+        results = storage_planning.run(
+            {'disks': 2, 'partitions': 2, 'raid': 1}, phases=['graph'],
+            memory=False)
+        self.assertEqual(['graph'], list(results['phases']))
+        self.assertIsNone(results['phases']['graph']['peak'])
+        # two disks, four partitions, md0 and three formats and mounts
+        self.assertEqual(13, results['devices'])
+        self.assertIn('graph', storage_planning.format_results(results))
+
+    @skipUnlessJsonSchema()
+    def test_main_max_seconds(self):
+        args = ['--disks=1', '--partitions=1', '--raid=0', '--lvm=0',
+                '--bcache=0', '--dmcrypt=0', '--multipath=0',
+                '--phase=plan', '--no-memory']
+        self.assertEqual(0, storage_planning.main(args))
+        self.assertEqual(
+            1, storage_planning.main(args + ['--max-seconds=plan=-1']))
+
+# vi: ts=4 expandtab syntax=python
@@ -1,9 +1,12 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
+import ctypes
 import errno
 import functools
 import json
 import os
+import stat
+import struct
 from unittest import mock
 import textwrap
 
@@ -448,6 +451,114 @@ class TestWipeFile(CiTestCase):
         mock_os_close.assert_called_once_with(mock_fd)
 
 
+class TestZeroDevice(CiTestCase):
+
+    def _mkfile(self, name, content):
+        path = self.tmp_path(name)
+        util.write_file(path, content, omode="wb")
+        return path
+
+    def test_zero_device_offload(self):
+        flen = 3 * 4096 + 17
+        myfile = self._mkfile("offload", flen * b'\1')
+        method = block.zero_device(myfile)
+        self.assertIn(method, ('fallocate-zero-range', 'fallocate-punch-hole',
+                               'write'))
+        self.assertEqual(flen * b'\0', util.load_file(myfile, decode=False))
+
+    def test_zero_device_write(self):
+        flen = 3 * 4096 + 17
+        myfile = self._mkfile("write", flen * b'\1')
+        self.assertEqual(
+            'write', block.zero_device(myfile, buflen=4096, offload=False))
+        self.assertEqual(flen * b'\0', util.load_file(myfile, decode=False))
+
+    @mock.patch('curtin.block._fallocate')
+    def test_zero_device_falls_back_when_unsupported(self, m_fallocate):
+        m_fallocate.side_effect = OSError(errno.EOPNOTSUPP, 'not supported')
+        myfile = self._mkfile("fallback", 1024 * b'\1')
+        self.assertEqual('write', block.zero_device(myfile))
+        self.assertEqual(2, m_fallocate.call_count)
+        self.assertEqual(1024 * b'\0', util.load_file(myfile, decode=False))
+
+    @mock.patch('curtin.block._fallocate')
+    def test_zero_device_raises_real_errors(self, m_fallocate):
+        m_fallocate.side_effect = OSError(errno.EIO, 'I/O error')
+        myfile = self._mkfile("eio", 1024 * b'\1')
+        with self.assertRaises(OSError):
+            block.zero_device(myfile)
+
+    @mock.patch('curtin.block.WIPE_CHUNK_BYTES', 4096)
+    @mock.patch('curtin.block._fallocate')
+    def test_zero_device_offload_in_chunks(self, m_fallocate):
+        myfile = self._mkfile("chunks", (2 * 4096 + 512) * b'\1')
+        self.assertEqual('fallocate-zero-range', block.zero_device(myfile))
+        self.assertEqual(
+            [mock.call(mock.ANY, block.FALLOC_FL_ZERO_RANGE, 0, 4096),
+             mock.call(mock.ANY, block.FALLOC_FL_ZERO_RANGE, 4096, 4096),
+             mock.call(mock.ANY, block.FALLOC_FL_ZERO_RANGE, 8192, 512)],
+            m_fallocate.call_args_list)
+
+    def test_fallocate_prototype_has_64bit_offsets(self):
+        self.assertEqual(
+            [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64],
+            block._libc_fallocate.argtypes)
+
+    def test_fallocate_beyond_4gib(self):
+        myfile = self._mkfile("sparse", b'')
+        with open(myfile, 'wb') as fp:
+            fp.truncate(5 << 32)
+        fd = os.open(myfile, os.O_RDWR)
+        self.addCleanup(os.close, fd)
+        try:
+            block._fallocate(
+                fd, block.FALLOC_FL_PUNCH_HOLE | block.FALLOC_FL_KEEP_SIZE,
+                (4 << 32) + 4096, 4096)
+        except OSError as e:
+            if e.errno not in block._WIPE_UNSUPPORTED_ERRNOS:
+                raise
+        self.assertEqual(5 << 32, os.path.getsize(myfile))
+
+    @mock.patch('curtin.block._ZERO_BUFFER', None)
+    def test_zero_buffer_only_grows(self):
+        small = block._zero_buffer(4096)
+        large = block._zero_buffer(3 * 4096)
+        again = block._zero_buffer(4096)
+        self.assertEqual(4096 * b'\0', small.tobytes())
+        self.assertEqual(3 * 4096 * b'\0', large.tobytes())
+        self.assertEqual(4096, len(again))
+        self.assertEqual(3 * 4096, len(block._ZERO_BUFFER))
+
+    @mock.patch('curtin.block.fcntl.ioctl')
+    @mock.patch('curtin.block.os.fstat')
+    def test_zero_device_block_device_uses_blkzeroout(self, m_fstat,
+                                                      m_ioctl):
+        m_fstat.return_value = mock.Mock(st_mode=stat.S_IFBLK)
+        myfile = self._mkfile("blk", 4096 * b'\1')
+        self.assertEqual('BLKZEROOUT', block.zero_device(myfile))
+        m_ioctl.assert_called_once_with(
+            mock.ANY, block.BLKZEROOUT, struct.pack('QQ', 0, 4096))
+
+    @mock.patch('curtin.block.fcntl.ioctl')
+    @mock.patch('curtin.block.os.fstat')
+    def test_discard_device_block_device(self, m_fstat, m_ioctl):
+        m_fstat.return_value = mock.Mock(st_mode=stat.S_IFBLK)
+        myfile = self._mkfile("discard", 4096 * b'\1')
+        self.assertEqual('BLKDISCARD', block.discard_device(myfile))
+        m_ioctl.assert_called_once_with(
+            mock.ANY, block.BLKDISCARD, struct.pack('QQ', 0, 4096))
+        self.assertEqual('BLKSECDISCARD',
+                         block.discard_device(myfile, secure=True))
+
+    @mock.patch('curtin.block.fcntl.ioctl')
+    @mock.patch('curtin.block.os.fstat')
+    def test_discard_device_unsupported(self, m_fstat, m_ioctl):
+        m_fstat.return_value = mock.Mock(st_mode=stat.S_IFBLK)
+        m_ioctl.side_effect = OSError(errno.EOPNOTSUPP, 'not supported')
+        myfile = self._mkfile("nodiscard", 4096 * b'\1')
+        self.assertIsNone(block.discard_device(myfile))
+
+
 class TestWipeVolume(CiTestCase):
     dev = '/dev/null'
 
@@ -485,6 +596,32 @@ class TestWipeVolume(CiTestCase):
                 self.dev, exclusive=True,
                 reader=mock_open.return_value.__enter__().read)
 
+    @mock.patch('curtin.block.zero_device')
+    def test_wipe_zeroout(self, m_zero_device):
+        block.wipe_volume(self.dev, mode='zeroout')
+        m_zero_device.assert_called_with(self.dev, exclusive=True)
+
+    @mock.patch('curtin.block.quick_zero')
+    @mock.patch('curtin.block.zero_device')
+    @mock.patch('curtin.block.discard_device')
+    def test_wipe_discard(self, m_discard, m_zero_device, m_quick_zero):
+        m_discard.return_value = 'BLKDISCARD'
+        block.wipe_volume(self.dev, mode='discard')
+        m_discard.assert_called_with(self.dev, exclusive=True)
+        m_quick_zero.assert_called_with(
+            self.dev, partitions=False, exclusive=True)
+        self.assertFalse(m_zero_device.called)
+
+    @mock.patch('curtin.block.quick_zero')
+    @mock.patch('curtin.block.zero_device')
+    @mock.patch('curtin.block.discard_device')
+    def test_wipe_discard_unsupported_zeroes(self, m_discard, m_zero_device,
+                                             m_quick_zero):
+        m_discard.return_value = None
+        block.wipe_volume(self.dev, mode='discard', exclusive=False)
+        m_zero_device.assert_called_with(self.dev, exclusive=False)
+        self.assertFalse(m_quick_zero.called)
+
     def test_bad_input(self):
         with self.assertRaises(ValueError):
             block.wipe_volume(self.dev, mode='invalidmode')
@@ -0,0 +1,273 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import errno
+import gzip
+import hashlib
+import os
+import threading
+from unittest import mock, skipIf
+
+from curtin import url_helper, util
+from curtin.block import image
+from .helpers import CiTestCase
+
+
+class TestDecompressCommands(CiTestCase):
+
+    @mock.patch('curtin.block.image.util.which')
+    def test_prefers_multithreaded_commands(self, m_which):
+        m_which.return_value = '/usr/bin/found'
+        self.assertEqual([['pigz', '-dc'], ['tar', '-xOf', '-']],
+                         image.decompress_commands('dd-tgz'))
+
+    @mock.patch('curtin.block.image.util.which')
+    def test_falls_back_to_last_command(self, m_which):
+        m_which.side_effect = lambda p: '/bin/gzip' if p == 'gzip' else None
+        self.assertEqual([['gzip', '-dc']], image.decompress_commands('dd-gz'))
+        m_which.side_effect = None
+        m_which.return_value = None
+        self.assertEqual([['bzip2', '-dc']],
+                         image.decompress_commands('dd-bz2'))
+
+    def test_raw_needs_no_commands(self):
+        self.assertEqual([], image.decompress_commands('dd-raw'))
+
+    def test_unsupported_type(self):
+        with self.assertRaises(ValueError):
+            image.decompress_commands('dd-foo')
+
+
+class TestImageSource(CiTestCase):
+
+    @mock.patch('curtin.block.image.time.sleep')
+    @mock.patch('curtin.block.image.url_helper.UrlReader')
+    def test_resumes_url_from_offset(self, m_reader, m_sleep):
+        first = mock.Mock(info={'etag': '"v1"'})
+        first.read.side_effect = [
+            b'abc', url_helper.UrlError(OSError('reset'), code=None)]
+        second = mock.Mock()
+        second.read.side_effect = [b'def', b'']
+        m_reader.side_effect = [first, second]
+
+        with image.ImageSource('http://host/disk.img') as src:
+            self.assertEqual(b'abc', src.read())
+            self.assertEqual(b'def', src.read())
+            self.assertEqual(b'', src.read())
+        self.assertEqual([mock.call('http://host/disk.img'),
+                          mock.call('http://host/disk.img', offset=3,
+                                    validator='"v1"')],
+                         m_reader.call_args_list)
+        first.close.assert_called_with()
+
+    @mock.patch('curtin.block.image.time.sleep')
+    @mock.patch('curtin.block.image.url_helper.UrlReader')
+    def test_client_errors_not_retried(self, m_reader, m_sleep):
+        m_reader.return_value.read.side_effect = url_helper.UrlError(
+            OSError('gone'), code=404)
+        with image.ImageSource('http://host/disk.img') as src:
+            with self.assertRaises(url_helper.UrlError):
+                src.read()
+        self.assertEqual(1, m_reader.call_count)
+
+
+class TestProbeFstype(CiTestCase):
+
+    def _probe(self, head):
+        path = self.tmp_path('fs.img')
+        util.write_file(path, head + bytes(4096 - len(head)), omode='wb')
+        return image.probe_fstype(path)
+
+    def _ext(self, compat=0, incompat=0, ro_compat=0):
+        sb = bytearray(2048)
+        sb[1080:1082] = b'\x53\xef'
+        for offset, flags in ((1116, compat), (1120, incompat),
+                              (1124, ro_compat)):
+            sb[offset:offset + 4] = flags.to_bytes(4, 'little')
+        return bytes(sb)
+
+    def test_probe_fstype(self):
+        self.assertEqual('xfs', self._probe(b'XFSB'))
+        self.assertEqual('squashfs', self._probe(b'hsqs'))
+        self.assertEqual('ext2', self._probe(self._ext(incompat=0x2)))
+        self.assertEqual('ext3', self._probe(self._ext(compat=0x4)))
+        self.assertEqual('ext4', self._probe(
+            self._ext(compat=0x4, incompat=0x2 | 0x40)))
+        self.assertEqual('ext4', self._probe(self._ext(ro_compat=0x400)))
+        self.assertIsNone(self._probe(b''))
+
+    def test_block_deployed(self):
+        scratch = self.tmp_dir()
+        self.assertEqual(set(), image.load_block_deployed(scratch))
+        image.save_block_deployed(scratch, {'/srv/root.img'})
+        self.assertEqual({'/srv/root.img'},
+                         image.load_block_deployed(scratch))
+
+
+class TestWriteImage(CiTestCase):
+
+    def setUp(self):
+        super(TestWriteImage, self).setUp()
+        self.tmpd = self.tmp_dir()
+        # not a multiple of the buffer size or the O_DIRECT alignment
+        self.data = os.urandom(3 * 8192 + 1000)
+        self.raw = self.tmp_path('disk.img', self.tmpd)
+        with open(self.raw, 'wb') as fp:
+            fp.write(self.data)
+        self.target = self.tmp_path('target', self.tmpd)
+        util.write_file(self.target, '')
+
+    def _written(self):
+        with open(self.target, 'rb') as fp:
+            return fp.read()
+
+    def test_write_raw_image(self):
+        source = {'type': 'dd-raw', 'uri': 'file://' + self.raw,
+                  'sha256': hashlib.sha256(self.data).hexdigest()}
+        written = image.write_image(source, self.target, buflen=8192)
+        self.assertEqual(len(self.data), written)
+        self.assertEqual(self.data, self._written())
+
+    @skipIf(not util.which('gzip'), 'gzip is not installed')
+    @mock.patch('curtin.block.image.decompress_commands')
+    def test_write_compressed_image(self, m_commands):
+        m_commands.return_value = [['gzip', '-dc']]
+        compressed = gzip.compress(self.data)
+        path = self.tmp_path('disk.img.gz', self.tmpd)
+        util.write_file(path, compressed, omode='wb')
+        source = {'type': 'dd-gz', 'uri': path,
+                  'sha256': hashlib.sha256(compressed).hexdigest()}
+        image.write_image(source, self.target, buflen=8192)
+        self.assertEqual(self.data, self._written())
+
+    def test_checksum_mismatch(self):
+        source = {'type': 'dd-raw', 'uri': self.raw, 'sha256': '0' * 64}
+        with self.assertRaises(ValueError):
+            image.write_image(source, self.target, buflen=8192)
+
+    @mock.patch('curtin.block.image.decompress_commands')
+    def test_failed_command_raises(self, m_commands):
+        m_commands.return_value = [['sh', '-c', 'exit 3']]
+        source = {'type': 'dd-gz', 'uri': self.raw}
+        with self.assertRaises(util.ProcessExecutionError) as ctx:
+            image.write_image(source, self.target, buflen=8192)
+        self.assertEqual(3, ctx.exception.exit_code)
+
+    @mock.patch('curtin.block.image.decompress_commands')
+    def test_upstream_sigpipe_accepted(self, m_commands):
+        # head exits long before cat has written all of its input
+        m_commands.return_value = [['cat'], ['head', '-c', '100']]
+        util.write_file(self.raw, os.urandom(1 << 20), omode='wb')
+        source = {'type': 'dd-gz', 'uri': self.raw}
+        self.assertEqual(100, image.write_image(source, self.target,
+                                                buflen=8192))
+        self.assertEqual(util.load_file(self.raw, decode=False)[:100],
+                         self._written())
+
+    @mock.patch('curtin.block.image.decompress_commands')
+    def test_failed_upstream_command_raises(self, m_commands):
+        m_commands.return_value = [['sh', '-c', 'exit 3'], ['cat']]
+        source = {'type': 'dd-gz', 'uri': self.raw}
+        with self.assertRaises(util.ProcessExecutionError) as ctx:
+            image.write_image(source, self.target, buflen=8192)
+        self.assertEqual(3, ctx.exception.exit_code)
+
+    @mock.patch('curtin.block.image.IMAGE_FEED_TIMEOUT', 0.1)
+    @mock.patch('curtin.block.image.ImageSource')
+    @mock.patch('curtin.block.image.decompress_commands')
+    def test_stuck_source_times_out(self, m_commands, m_source):
+        m_commands.return_value = [['cat'], ['head', '-c', '0']]
+        stuck = threading.Event()
+        self.addCleanup(stuck.set)
+        src = m_source.return_value.__enter__.return_value
+        src.read.side_effect = lambda *args: stuck.wait() and b''
+        source = {'type': 'dd-gz', 'uri': 'http://example.com/disk.img.gz'}
+        with self.assertRaises(OSError) as ctx:
+            image.write_image(source, self.target, buflen=8192)
+        self.assertEqual(errno.ETIMEDOUT, ctx.exception.errno)
+
+    @mock.patch('curtin.block.image.events.report_progress_event')
+    def test_progress_reported(self, m_progress):
+        with image.ImageWriter(self.target, buflen=8192, report_name='test',
+                               report_interval=0) as writer:
+            writer.write(self.data)
+        self.assertEqual('test', m_progress.call_args[0][0])
+        self.assertIn('wrote', m_progress.call_args[0][1])
+
+
+class TestSparseWriteImage(CiTestCase):
+
+    def setUp(self):
+        super(TestSparseWriteImage, self).setUp()
+        self.tmpd = self.tmp_dir()
+        mib = image.SPARSE_BLOCK
+        # data, two zero blocks, data, a zero block and an unaligned tail
+        self.data = (os.urandom(mib) + bytes(2 * mib) + os.urandom(mib) +
+                     bytes(mib) + os.urandom(1000))
+        self.target = self.tmp_path('target', self.tmpd)
+        util.write_file(self.target, '')
+
+    def _written(self):
+        with open(self.target, 'rb') as fp:
+            return fp.read()
+
+    @mock.patch('curtin.block.image._fallocate')
+    @mock.patch('curtin.block.image.decompress_commands')
+    def test_zero_blocks_zeroed_out(self, m_commands, m_fallocate):
+        m_commands.return_value = [['cat']]
+        path = self.tmp_path('disk.img', self.tmpd)
+        util.write_file(path, self.data, omode='wb')
+        source = {'type': 'dd-gz', 'uri': path}
+        with mock.patch('curtin.block.image.ImageWriter',
+                        wraps=image.ImageWriter) as m_writer:
+            image.write_image(source, self.target, buflen=2 * (1 << 20),
+                              sparse='zeroout')
+        self.assertEqual(3, m_fallocate.call_count)
+        self.assertEqual([mib * (1 << 20) for mib in (1, 2, 4)],
+                         [c[0][2] for c in m_fallocate.call_args_list])
+        # the image is complete, zeros read back from the file
+        self.assertEqual(self.data, self._written())
+        self.assertEqual('zeroout', m_writer.call_args[1]['sparse'])
+
+    @mock.patch('curtin.block.image._fallocate')
+    def test_zeroout_unsupported_writes_zeros(self, m_fallocate):
+        m_fallocate.side_effect = OSError(errno.EOPNOTSUPP, 'not supported')
+        with image.ImageWriter(self.target, buflen=image.SPARSE_BLOCK,
+                               sparse='zeroout') as writer:
+            writer.write(self.data)
+        self.assertEqual(1, m_fallocate.call_count)
+        self.assertEqual(0, writer.skipped)
+        self.assertEqual(self.data, self._written())
+
+    def test_skip_local_holes(self):
+        mib = image.SPARSE_BLOCK
+        path = self.tmp_path('disk.img', self.tmpd)
+        with open(path, 'wb') as fp:
+            fp.write(self.data[:mib])
+            fp.seek(8 * mib)
+            fp.write(self.data[:mib])
+            fp.truncate(16 * mib)
+        with open(path, 'rb') as fp:
+            expected = fp.read()
+        source = {'type': 'dd-raw', 'uri': 'file://' + path,
+                  'sha256': hashlib.sha256(expected).hexdigest()}
+        with mock.patch('curtin.block.image.ImageSource.read',
+                        autospec=True,
+                        side_effect=image.ImageSource.read) as m_read:
+            written = image.write_image(source, self.target,
+                                        buflen=2 * mib, sparse='skip')
+        self.assertEqual(16 * mib, written)
+        self.assertEqual(expected, self._written())
+        # only the data was read when the filesystem reports holes
+        self.assertEqual(2 * mib,
+                         sum(c[0][1] for c in m_read.call_args_list))
+
+    def test_skip_requires_sparse(self):
+        with image.ImageWriter(self.target) as writer:
+            with self.assertRaises(ValueError):
+                writer.skip(10)
+
+    def test_invalid_sparse_mode(self):
+        with self.assertRaises(ValueError):
+            image.ImageWriter(self.target, sparse='holes')
+
+# vi: ts=4 expandtab syntax=python
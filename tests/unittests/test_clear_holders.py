@@ -3,6 +3,8 @@
 from unittest import mock
 import os
 import textwrap
+import threading
+import time
 import uuid
 
 from curtin.block import clear_holders
@@ -867,4 +869,205 @@ class TestClearHolders(CiTestCase):
         clear_holders.shutdown_swap(blockdev)
         self.assertEqual(0, mock_util.subp.call_count)
 
+
+class TestClearHoldersConcurrency(CiTestCase):
+
+    plan = [
+        {'device': '/sys/class/block/md0', 'dev_type': 'raid', 'level': 3},
+        {'device': '/sys/class/block/sda/sda1', 'dev_type': 'partition',
+         'level': 2},
+        {'device': '/sys/class/block/sdb/sdb1', 'dev_type': 'partition',
+         'level': 2},
+        {'device': '/sys/class/block/sda', 'dev_type': 'disk', 'level': 1},
+        {'device': '/sys/class/block/sdb', 'dev_type': 'disk', 'level': 1},
+    ]
+
+    def setUp(self):
+        super(TestClearHoldersConcurrency, self).setUp()
+        self.calls = []
+        self.m_wipe = mock.Mock(side_effect=lambda d: self.calls.append(d))
+        self.m_raid = mock.Mock(side_effect=lambda d: self.calls.append(d))
+        dev_types = {
+            'partition': {'shutdown': self.m_wipe},
+            'disk': {'shutdown': self.m_wipe},
+            'raid': {'shutdown': self.m_raid},
+        }
+        basepath = 'curtin.block.clear_holders.'
+        self.add_patch(basepath + 'DEV_TYPES', new=dev_types)
+        self.add_patch(basepath + 'CONCURRENT_SHUTDOWN_HANDLERS',
+                       new=[self.m_wipe])
+        self.add_patch(basepath + 'DATA_DESTROYING_HANDLERS',
+                       new=[self.m_wipe])
+        self.add_patch(basepath + 'gen_holders_tree')
+        self.add_patch(basepath + 'format_holders_tree', return_value='')
+        self.add_patch(basepath + 'plan_shutdown_holder_trees', 'm_plan')
+        self.m_plan.return_value = self.plan
+        self.add_patch(basepath + 'os.path.exists', 'm_exists')
+        self.m_exists.return_value = True
+        self.add_patch(basepath + '_get_holder_disk', 'm_disk')
+        self.m_disk.side_effect = (
+            lambda info: '/sys/class/block/' +
+            info['device'].split('/')[4])
+
+    def test_sequential_keeps_plan_order(self):
+        clear_holders.clear_holders(['/dev/sda', '/dev/sdb'])
+        self.assertEqual([d['device'] for d in self.plan], self.calls)
+        self.assertFalse(self.m_disk.called)
+
+    def test_concurrent_keeps_per_disk_order(self):
+        clear_holders.clear_holders(['/dev/sda', '/dev/sdb'], workers=2)
+        self.assertEqual(self.plan[0]['device'], self.calls[0])
+        self.assertEqual(sorted(d['device'] for d in self.plan),
+                         sorted(self.calls))
+        for disk in ('sda', 'sdb'):
+            disk_calls = [c for c in self.calls if disk in c]
+            self.assertEqual(['/sys/class/block/%s/%s1' % (disk, disk),
+                              '/sys/class/block/%s' % disk], disk_calls)
+
+    def test_concurrent_raises_error(self):
+        def wipe(device):
+            if device.endswith('sdb1'):
+                raise OSError('wipe failed')
+            self.calls.append(device)
+        self.m_wipe.side_effect = wipe
+        with self.assertRaises(OSError):
+            clear_holders.clear_holders(['/dev/sda', '/dev/sdb'], workers=2)
+        # sda was still wiped completely
+        self.assertIn('/sys/class/block/sda', self.calls)
+        self.assertNotIn('/sys/class/block/sdb', self.calls)
+
+    def test_preserve_skips_concurrent_wipes(self):
+        clear_holders.clear_holders(['/dev/sda', '/dev/sdb'], workers=2,
+                                    try_preserve=True)
+        self.assertEqual(['/sys/class/block/md0'], self.calls)
+
+    @mock.patch('curtin.block.clear_holders.events.ReportEventStack')
+    def test_report_stack_per_device(self, m_stack):
+        parent = mock.Mock()
+        clear_holders.clear_holders(['/dev/sda', '/dev/sdb'], workers=2,
+                                    report_stack=parent)
+        self.assertEqual(len(self.plan), m_stack.call_count)
+        for args in m_stack.call_args_list:
+            self.assertEqual(parent, args[1]['parent'])
+
+
+class TestWipeSuperblockConcurrency(CiTestCase):
+
+    @mock.patch('curtin.block.clear_holders.multipath')
+    @mock.patch('curtin.block.clear_holders.is_swap_device')
+    @mock.patch('curtin.block.clear_holders.zfs')
+    @mock.patch('curtin.block.clear_holders.block')
+    def test_pool_members_export_once(self, m_block, m_zfs, m_swap, m_mp):
+        """members of one zpool wiped at once export the pool once"""
+        pools = ['fake_pool']
+        exporting = threading.Event()
+
+        def zpool_export(poolname):
+            exporting.set()
+            # give the other wipe the chance to see the pool still listed
+            time.sleep(0.05)
+            pools.remove(poolname)
+
+        m_block.sysfs_to_devpath.side_effect = (
+            lambda device: '/dev/' + os.path.basename(device))
+        m_block.is_online.return_value = True
+        m_block.is_extended_partition.return_value = False
+        m_block.get_sysfs_partitions.return_value = []
+        m_block.is_zfs_member.return_value = True
+        m_zfs.zfs_supported.return_value = True
+        m_zfs.device_to_poolname.return_value = 'fake_pool'
+        m_zfs.zpool_list.side_effect = lambda: list(pools)
+        m_zfs.zpool_export.side_effect = zpool_export
+        m_swap.return_value = False
+        m_mp.multipath_supported.return_value = False
+
+        threads = [threading.Thread(target=clear_holders.wipe_superblock,
+                                    args=(device,))
+                   for device in ('/sys/class/block/sda',
+                                  '/sys/class/block/sdb')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(exporting.is_set())
+        m_zfs.zpool_export.assert_called_once_with('fake_pool')
+        self.assertEqual(2, m_block.wipe_volume.call_count)
+
+
+class TestHoldersSnapshot(CiTestCase):
+
+    def setUp(self):
+        super(TestHoldersSnapshot, self).setUp()
+        self.tmp = self.tmp_dir()
+        self.root = os.path.join(self.tmp, 'class', 'block')
+        os.makedirs(self.root)
+        self.devices = os.path.join(self.tmp, 'devices')
+        # sda1 and sdb1 form md0, which holds an lvm volume group with one
+        # volume that holds a crypt device
+        self._add('sda')
+        self._add('sda1', parent='sda', holders=['md0'])
+        self._add('sda2', parent='sda')
+        self._add('sdb')
+        self._add('sdb1', parent='sdb', holders=['md0'])
+        self._add('md0', holders=['dm-0'])
+        self._add('dm-0', holders=['dm-1'], dm_uuid='LVM-abc')
+        self._add('dm-1', dm_uuid='CRYPT-LUKS2-abc')
+        self.add_patch('curtin.block.clear_holders.util.subp', 'm_subp')
+
+    def _add(self, kname, parent=None, holders=(), dm_uuid=None):
+        if parent:
+            devdir = os.path.join(self.devices, parent, kname)
+        else:
+            devdir = os.path.join(self.devices, kname)
+        os.makedirs(os.path.join(devdir, 'holders'))
+        for holder in holders:
+            open(os.path.join(devdir, 'holders', holder), 'w').close()
+        if parent:
+            open(os.path.join(devdir, 'partition'), 'w').close()
+        if dm_uuid:
+            os.makedirs(os.path.join(devdir, 'dm'))
+            with open(os.path.join(devdir, 'dm', 'uuid'), 'w') as fp:
+                fp.write(dm_uuid + '\n')
+        os.symlink(devdir, os.path.join(self.root, kname))
+
+    def _flatten(self, tree):
+        found = [(tree['name'], tree['dev_type'])]
+        for holder in tree['holders']:
+            found.extend(self._flatten(holder))
+        return found
+
+    def test_holders_tree_from_snapshot(self):
+        snapshot = clear_holders.HoldersSnapshot(sysfs_root=self.root)
+        tree = clear_holders.gen_holders_tree('sda', snapshot=snapshot)
+        self.assertEqual(os.path.join(self.root, 'sda'), tree['device'])
+        self.assertEqual(
+            [('sda', 'disk'), ('sda1', 'partition'), ('md0', 'raid'),
+             ('dm-0', 'lvm'), ('dm-1', 'crypt'), ('sda2', 'partition')],
+            self._flatten(tree))
+        self.assertEqual(0, self.m_subp.call_count)
+
+    def test_sysfs_read_once_for_many_trees(self):
+        snapshot = clear_holders.HoldersSnapshot(sysfs_root=self.root)
+        with mock.patch.object(snapshot, 'refresh',
+                               wraps=snapshot.refresh) as m_refresh:
+            for kname in ('sda', 'sdb', 'md0'):
+                snapshot.holders_tree(kname)
+        self.assertEqual(1, m_refresh.call_count)
+
+    def test_mpath_partition_identified(self):
+        self._add('dm-2', dm_uuid='part1-mpath-3600a098038')
+        snapshot = clear_holders.HoldersSnapshot(sysfs_root=self.root)
+        self.assertEqual('partition', snapshot.dev_type('dm-2'))
+
+    def test_new_device_refreshes_snapshot(self):
+        snapshot = clear_holders.HoldersSnapshot(sysfs_root=self.root)
+        self.assertNotIn('sdc', snapshot.devices)
+        self._add('sdc')
+        self.assertEqual('disk', snapshot.holders_tree('sdc')['dev_type'])
+
+    def test_missing_device_raises(self):
+        snapshot = clear_holders.HoldersSnapshot(sysfs_root=self.root)
+        with self.assertRaises(OSError):
+            snapshot.holders_tree('sdz')
+
 # vi: ts=4 expandtab syntax=python
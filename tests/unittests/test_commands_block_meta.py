@@ -11,6 +11,7 @@ from unittest.mock import (
 )
 import os
 import random
+import time
 import uuid
 
 from curtin.block import dasd
@@ -24,6 +25,7 @@ def random_uuid():
 
 
 empty_context = block_meta.BlockMetaContext({})
+real_devsync = block_meta.devsync
 
 
 class TestToUTF8HexNotation(CiTestCase):
@@ -467,6 +469,156 @@ class TestGetPathToStorageVolume(CiTestCase):
             block_meta.get_path_to_storage_volume(disk_id, s_cfg))
 
 
+class TestDevsync(CiTestCase):
+
+    def setUp(self):
+        super(TestDevsync, self).setUp()
+        basepath = 'curtin.commands.block_meta.'
+        self.add_patch(basepath + 'util.subp', 'm_subp')
+        self.add_patch(basepath + 'udevadm_settle', 'm_settle')
+        self.add_patch(basepath + 'os.path.exists', 'm_exists')
+        self.m_exists.return_value = True
+
+    def test_devsync_settles_fully(self):
+        block_meta.devsync('/dev/sda')
+        self.m_subp.assert_called_with(['partprobe', '/dev/sda'],
+                                       rcs=[0, 1])
+        self.m_settle.assert_called_with()
+
+    def test_devsync_waits_on_partition(self):
+        block_meta.devsync('/dev/sda', wait_for='/dev/sda2')
+        self.m_subp.assert_called_with(['partprobe', '/dev/sda'],
+                                       rcs=[0, 1])
+        self.m_settle.assert_called_with(exists='/dev/sda2')
+
+    @patch('curtin.commands.block_meta.block')
+    def test_partition_path_syncs_disk_and_waits_on_partition(self, m_block):
+        m_block.path_to_kname.return_value = 'sda'
+        m_block.partition_kname.return_value = 'sda2'
+        m_block.kname_to_path.return_value = '/dev/sda2'
+        s_cfg = OrderedDict([
+            ('disk-a', {'id': 'disk-a', 'type': 'disk', 'path': '/dev/sda'}),
+            ('part-2', {'id': 'part-2', 'type': 'partition', 'number': 2,
+                        'device': 'disk-a'}),
+            ])
+        with patch('curtin.commands.block_meta.devsync') as m_devsync:
+            self.assertEqual(
+                '/dev/sda2',
+                block_meta.get_path_to_storage_volume('part-2', s_cfg))
+        self.assertEqual(call('/dev/sda', wait_for='/dev/sda2'),
+                         m_devsync.call_args)
+
+
+class TestBlockDeviceInventory(CiTestCase):
+
+    def setUp(self):
+        super(TestBlockDeviceInventory, self).setUp()
+        basepath = 'curtin.commands.block_meta.'
+        self.add_patch(
+            basepath + 'udev_all_block_device_properties', 'm_udev_all')
+        self.add_patch(basepath + 'devsync', 'm_devsync')
+        self.add_patch(basepath + 'multipath.is_mpath_member', 'm_mp')
+        self.m_mp.return_value = False
+        self.m_udev_all.return_value = [
+            {'DEVNAME': '/dev/sda', 'ID_SERIAL': 'serial-a',
+             'DEVLINKS': '/dev/disk/by-id/a /dev/disk/by-path/pa'},
+            {'DEVNAME': '/dev/sda1', 'PARTN': '1', 'ID_SERIAL': 'serial-a'},
+            {'DEVNAME': '/dev/sdb', 'ID_SERIAL': 'serial-b',
+             'ID_WWN': 'wwn-b'},
+        ]
+        self.inventory = block_meta.BlockDeviceInventory()
+
+    def test_lookups_enumerate_devices_once(self):
+        dev = self.inventory.by_path('/dev/disk/by-id/a')
+        self.assertEqual('/dev/sda', dev['DEVNAME'])
+        self.assertEqual(
+            ['/dev/sdb'],
+            [d['DEVNAME'] for d in self.inventory.by_keys('wwn-b', 'ID_WWN')])
+        self.assertEqual(
+            ['/dev/sda'],
+            [d['DEVNAME'] for d in
+             self.inventory.by_keys('serial-a', 'DM_SERIAL', 'ID_SERIAL')])
+        self.assertEqual(1, self.m_udev_all.call_count)
+
+    def test_miss_refreshes_once(self):
+        self.inventory.by_path('/dev/sda')
+        self.m_udev_all.return_value = self.m_udev_all.return_value + [
+            {'DEVNAME': '/dev/sdc', 'ID_SERIAL': 'serial-c'}]
+        self.assertEqual('/dev/sdc',
+                         self.inventory.by_path('/dev/sdc')['DEVNAME'])
+        self.assertEqual(2, self.m_udev_all.call_count)
+        with self.assertRaises(KeyError):
+            self.inventory.by_path('/dev/sdz')
+        self.assertEqual(3, self.m_udev_all.call_count)
+
+    def test_invalidate_rebuilds(self):
+        self.inventory.by_path('/dev/sda')
+        self.inventory.invalidate()
+        self.inventory.by_path('/dev/sda')
+        self.assertEqual(2, self.m_udev_all.call_count)
+
+    @patch('curtin.commands.block_meta.os.path.exists')
+    def test_get_path_to_storage_volume_remembers_paths(self, m_exists):
+        m_exists.return_value = True
+        s_cfg = OrderedDict({
+            'disk-a': {'id': 'disk-a', 'type': 'disk', 'serial': 'serial-a'},
+            'disk-b': {'id': 'disk-b', 'type': 'disk', 'wwn': 'wwn-b'},
+        })
+        s_cfg.version = 2
+        s_cfg.inventory = self.inventory
+        for _ in range(3):
+            self.assertEqual(
+                '/dev/sda',
+                block_meta.get_path_to_storage_volume('disk-a', s_cfg))
+            self.assertEqual(
+                '/dev/sdb',
+                block_meta.get_path_to_storage_volume('disk-b', s_cfg))
+        self.assertEqual(1, self.m_udev_all.call_count)
+        # known paths are not synced again
+        self.assertEqual([call('/dev/sda'), call('/dev/sdb')],
+                         self.m_devsync.call_args_list)
+
+    @patch('curtin.commands.block_meta.udevadm_settle')
+    @patch('curtin.commands.block_meta.util.subp')
+    @patch('curtin.commands.block_meta.os.path.exists')
+    @patch('curtin.commands.block_meta.block')
+    def test_repeated_lookups_partprobe_once(self, m_block, m_exists,
+                                             m_subp, m_settle):
+        self.m_devsync.side_effect = real_devsync
+        m_exists.return_value = True
+        m_block.path_to_kname.return_value = 'sda'
+        m_block.partition_kname.side_effect = lambda kname, num: (
+            '%s%s' % (kname, num))
+        m_block.kname_to_path.side_effect = lambda kname: '/dev/' + kname
+        s_cfg = OrderedDict([
+            ('disk-a', {'id': 'disk-a', 'type': 'disk',
+                        'serial': 'serial-a'}),
+            ('part-1', {'id': 'part-1', 'type': 'partition', 'number': 1,
+                        'device': 'disk-a'}),
+            ('part-2', {'id': 'part-2', 'type': 'partition', 'number': 2,
+                        'device': 'disk-a'}),
+        ])
+        s_cfg.version = 2
+        s_cfg.inventory = self.inventory
+        for _ in range(3):
+            for part in (1, 2):
+                self.assertEqual(
+                    '/dev/sda%d' % part,
+                    block_meta.get_path_to_storage_volume(
+                        'part-%d' % part, s_cfg))
+        partprobes = [c for c in m_subp.call_args_list
+                      if c[0][0][0] == 'partprobe']
+        # the disk once, then once for each partition
+        self.assertEqual([call(['partprobe', '/dev/sda'], rcs=[0, 1])] * 3,
+                         partprobes)
+
+    @patch('curtin.commands.block_meta.os.path.exists')
+    def test_remembered_path_dropped_when_missing(self, m_exists):
+        m_exists.return_value = False
+        self.inventory.remember_volume_path('disk-a', '/dev/sda')
+        self.assertIsNone(self.inventory.volume_path('disk-a'))
+
+
 class TestBlockMetaSimple(CiTestCase):
     def setUp(self):
         super(TestBlockMetaSimple, self).setUp()
@@ -490,6 +642,7 @@ class TestBlockMetaSimple(CiTestCase):
                        'mock_block_is_valid_device')
         self.add_patch('curtin.block.lvm.activate_volgroups',
                        'mock_activate_volgroups')
+        self.add_patch('curtin.block.image.write_image', 'mock_write_image')
         # config
         self.add_patch('curtin.config.load_command_config',
                        'mock_config_load')
@@ -509,14 +662,10 @@ class TestBlockMetaSimple(CiTestCase):
 
         block_meta.write_image_to_disk(source, devname)
 
-        write = [
-            'sh', '-c',
-            'wget "$1" --progress=dot:mega -O - | xzcat | dd bs=4M of="$2"',
-            '--', source['uri'], devnode,
-            ]
         self.mock_block_get_dev_name_entry.assert_called_with(devname)
-        self.mock_subp.assert_has_calls([call(args=write),
-                                         call(['partprobe', devnode]),
+        self.mock_write_image.assert_called_with(source, devnode,
+                                                 sparse='zeroout')
+        self.mock_subp.assert_has_calls([call(['partprobe', devnode]),
                                          call(['udevadm', 'trigger', devnode]),
                                          call(['udevadm', 'settle']),
                                          call(['udevadm', 'settle'])])
@@ -535,15 +684,10 @@ class TestBlockMetaSimple(CiTestCase):
 
         block_meta.write_image_to_disk(source, devname)
 
-        write = [
-            'sh', '-c',
-            'wget "$1" --progress=dot:mega -O - | '
-            'tar -xOzf - | dd bs=4M of="$2"',
-            '--', source['uri'], devnode,
-            ]
         self.mock_block_get_dev_name_entry.assert_called_with(devname)
-        self.mock_subp.assert_has_calls([call(args=write),
-                                         call(['partprobe', devnode]),
+        self.mock_write_image.assert_called_with(source, devnode,
+                                                 sparse='zeroout')
+        self.mock_subp.assert_has_calls([call(['partprobe', devnode]),
                                          call(['udevadm', 'trigger', devnode]),
                                          call(['udevadm', 'settle']),
                                          call(['udevadm', 'settle'])])
@@ -562,14 +706,10 @@ class TestBlockMetaSimple(CiTestCase):
 
         block_meta.write_image_to_disk(source, devname)
 
-        write = [
-            'sh', '-c',
-            'cat "$1" | dd bs=4M of="$2"',
-            '--', '/pc.img', devnode,
-            ]
         self.mock_block_get_dev_name_entry.assert_called_with(devname)
-        self.mock_subp.assert_has_calls([call(args=write),
-                                         call(['partprobe', devnode]),
+        self.mock_write_image.assert_called_with(source, devnode,
+                                                 sparse='zeroout')
+        self.mock_subp.assert_has_calls([call(['partprobe', devnode]),
                                          call(['udevadm', 'trigger', devnode]),
                                          call(['udevadm', 'settle']),
                                          call(['udevadm', 'settle'])])
@@ -606,6 +746,36 @@ class TestBlockMetaSimple(CiTestCase):
         self.mock_subp.assert_has_calls(
             [call(['mount', devname, self.target])])
 
+    def test_write_image_to_disk_sparse_modes(self):
+        devname = "fakedisk1p1"
+        self.mock_block_get_dev_name_entry.return_value = (
+            devname, "/dev/" + devname)
+        for sparse, expected in (('skip', 'skip'), (False, None),
+                                 (None, None)):
+            source = {'type': 'dd-raw', 'uri': 'file:///pc.img',
+                      'sparse': sparse}
+            block_meta.write_image_to_disk(source, devname)
+            self.mock_write_image.assert_called_with(
+                source, "/dev/" + devname, sparse=expected)
+
+    @patch('curtin.commands.block_meta.meta_clear')
+    @patch('curtin.commands.block_meta.write_image_to_disk')
+    def test_meta_simple_rejects_bad_sparse_mode(self, mock_write_image,
+                                                 mock_clear):
+        devname = "fakedisk1p1"
+        self.mock_config_load.return_value = {
+            'block-meta': {'devices': [devname]},
+            'sources': {'unittest': {'type': 'dd-raw', 'uri': 'file:///a',
+                                     'sparse': 'true'}},
+        }
+        args = Namespace(target=self.target, devices=None, mode=None,
+                         boot_fstype=None, fstype=None, force_mode=False,
+                         testmode=True)
+        with self.assertRaisesRegex(ValueError, 'sparse'):
+            block_meta.block_meta(args)
+        mock_clear.assert_not_called()
+        mock_write_image.assert_not_called()
+
     @patch('curtin.commands.block_meta.meta_clear')
     @patch('curtin.commands.block_meta.write_image_to_disk')
     @patch('curtin.commands.block_meta.get_device_paths_from_storage_config')
@@ -977,6 +1147,145 @@ class TestBlockMeta(CiTestCase):
         self.assertEqual(expected, rendered_fstab)
 
 
+class TestStorageActionScheduling(CiTestCase):
+
+    def setUp(self):
+        super(TestStorageActionScheduling, self).setUp()
+        self.config = {
+            'storage': {
+                'version': 1,
+                'config': [
+                    {'id': 'sda', 'type': 'disk', 'ptable': 'gpt'},
+                    {'id': 'sdb', 'type': 'disk', 'ptable': 'gpt'},
+                    {'id': 'sda1', 'type': 'partition', 'device': 'sda',
+                     'size': '1G', 'number': 1},
+                    {'id': 'sdb1', 'type': 'partition', 'device': 'sdb',
+                     'size': '1G', 'number': 1},
+                    {'id': 'sda2', 'type': 'partition', 'device': 'sda',
+                     'size': '1G', 'number': 2},
+                    {'id': 'sda1-fmt', 'type': 'format', 'fstype': 'ext4',
+                     'volume': 'sda1'},
+                    {'id': 'md0', 'type': 'raid', 'raidlevel': 1,
+                     'devices': ['sda2', 'sdb1']},
+                    {'id': 'md0-fmt', 'type': 'format', 'fstype': 'ext4',
+                     'volume': 'md0'},
+                    {'id': 'sda1-mnt', 'type': 'mount', 'path': '/',
+                     'device': 'sda1-fmt'},
+                ],
+            }
+        }
+        self.storage_config = (
+            block_meta.extract_storage_ordered_dict(self.config))
+
+    def test_plan_deps_chains_actions_per_disk(self):
+        deps = block_meta.plan_storage_action_deps(self.storage_config)
+        self.assertEqual(set(), deps['sda'])
+        self.assertEqual(set(), deps['sdb'])
+        self.assertEqual({'sda'}, deps['sda1'])
+        self.assertEqual({'sdb'}, deps['sdb1'])
+        self.assertEqual({'sda', 'sda1'}, deps['sda2'])
+        self.assertEqual({'sda1', 'sda2'}, deps['sda1-fmt'])
+
+    def test_plan_deps_global_actions_are_barriers(self):
+        deps = block_meta.plan_storage_action_deps(self.storage_config)
+        self.assertEqual(
+            {'sda', 'sdb', 'sda1', 'sdb1', 'sda2', 'sda1-fmt'}, deps['md0'])
+        self.assertEqual({'md0'}, deps['md0-fmt'])
+        self.assertEqual({'md0', 'md0-fmt', 'sda1-fmt'}, deps['sda1-mnt'])
+
+    def test_plan_deps_disks_on_same_controller_are_independent(self):
+        self.config['storage']['config'] = [
+            {'id': 'nvme0', 'type': 'nvme_controller', 'transport': 'pcie'},
+            {'id': 'disk0', 'type': 'disk', 'nvme_controller': 'nvme0'},
+            {'id': 'disk1', 'type': 'disk', 'nvme_controller': 'nvme0'},
+        ]
+        storage_config = block_meta.extract_storage_ordered_dict(self.config)
+        deps = block_meta.plan_storage_action_deps(storage_config)
+        self.assertEqual({'nvme0'}, deps['disk0'])
+        self.assertEqual({'nvme0'}, deps['disk1'])
+
+    def test_run_storage_actions_sequential_keeps_config_order(self):
+        seen = []
+        handler = Mock(side_effect=lambda info, sc, ctx: seen.append(
+            info['id']))
+        handlers = {stype: handler for stype in
+                    ('disk', 'partition', 'format', 'raid', 'mount')}
+        context = block_meta.BlockMetaContext(handlers)
+        block_meta.run_storage_actions(self.storage_config, context, '')
+        self.assertEqual(list(self.storage_config.keys()), seen)
+
+    def test_run_storage_actions_parallel_respects_deps(self):
+        seen = []
+        handler = Mock(side_effect=lambda info, sc, ctx: seen.append(
+            info['id']))
+        handlers = {stype: handler for stype in
+                    ('disk', 'partition', 'format', 'raid', 'mount')}
+        context = block_meta.BlockMetaContext(handlers)
+        block_meta.run_storage_actions(
+            self.storage_config, context, '', workers=4)
+        self.assertEqual(sorted(self.storage_config.keys()), sorted(seen))
+        deps = block_meta.plan_storage_action_deps(self.storage_config)
+        for item_id, item_deps in deps.items():
+            for dep in item_deps:
+                self.assertLess(seen.index(dep), seen.index(item_id))
+
+    def test_run_storage_actions_parallel_stops_on_error(self):
+        seen = []
+
+        def handler(info, sc, ctx):
+            if info['id'] == 'sda1':
+                raise RuntimeError('sgdisk failed')
+            seen.append(info['id'])
+
+        handlers = {stype: handler for stype in
+                    ('disk', 'partition', 'format', 'raid', 'mount')}
+        context = block_meta.BlockMetaContext(handlers)
+        with self.assertRaises(RuntimeError):
+            block_meta.run_storage_actions(
+                self.storage_config, context, '', workers=4)
+        self.assertNotIn('sda2', seen)
+        self.assertNotIn('md0', seen)
+
+    def test_run_storage_actions_parallel_context_matches_serial(self):
+        config = []
+        for disk in range(8):
+            disk_id = 'disk%d' % disk
+            config.append({'id': disk_id, 'type': 'disk', 'ptable': 'gpt'})
+            for part in range(1, 5):
+                part_id = '%s-part%d' % (disk_id, part)
+                config.extend([
+                    {'id': part_id, 'type': 'partition', 'device': disk_id,
+                     'size': '1G', 'number': part},
+                    {'id': part_id + '-fmt', 'type': 'format',
+                     'fstype': 'ext4', 'volume': part_id}])
+        storage_config = block_meta.extract_storage_ordered_dict(
+            {'storage': {'version': 1, 'config': config}})
+
+        def handler(info, sc, ctx):
+            time.sleep(0.001)
+            ctx.record_device(info['id'], '/dev/' + info['id'])
+            if info['type'] == 'format':
+                ctx.record_block_deployed(info['id'])
+
+        contexts = []
+        for workers in (1, 4):
+            context = block_meta.BlockMetaContext(
+                {stype: handler for stype in ('disk', 'partition', 'format')})
+            block_meta.run_storage_actions(storage_config, context, '',
+                                           workers=workers)
+            contexts.append(context)
+        serial, parallel = contexts
+        self.assertEqual(len(storage_config), len(parallel.id_to_device))
+        self.assertEqual(serial.id_to_device, parallel.id_to_device)
+        self.assertEqual(serial.block_deployed, parallel.block_deployed)
+
+    def test_run_storage_actions_unknown_type(self):
+        context = block_meta.BlockMetaContext({})
+        with self.assertRaises(ValueError):
+            block_meta.run_storage_actions(
+                self.storage_config, context, '', workers=2)
+
+
 class TestZpoolHandler(CiTestCase):
     @patch('curtin.commands.block_meta.zfs')
     @patch('curtin.commands.block_meta.block')
@@ -1879,6 +2188,107 @@ class TestDiskHandler(CiTestCase):
         m_subp.assert_called_once_with(['fdasd', '-c', '/dev/null', path])
 
 
+class TestFormatHandlerBlockDeploy(CiTestCase):
+
+    def setUp(self):
+        super(TestFormatHandlerBlockDeploy, self).setUp()
+        basepath = 'curtin.commands.block_meta.'
+        self.add_patch(basepath + 'get_path_to_storage_volume', 'm_getpath',
+                       return_value='/dev/vda2')
+        self.add_patch(basepath + 'mkfs.mkfs_from_config', 'm_mkfs')
+        self.add_patch(basepath + 'image.probe_fstype', 'm_probe',
+                       return_value='ext4')
+        self.add_patch('curtin.commands.block_meta_v2.deploy_fsimage',
+                       'm_deploy')
+        self.info = {'id': 'format-root', 'type': 'format', 'fstype': 'ext4',
+                     'volume': 'vda2'}
+        self.storage_config = OrderedDict([
+            ('vda2', {'id': 'vda2', 'type': 'partition'}),
+            ('format-root', self.info),
+            ('mount-root', {'id': 'mount-root', 'type': 'mount',
+                            'device': 'format-root', 'path': '/'}),
+        ])
+        self.source = {'type': 'fsimage', 'uri': '/srv/root.img',
+                       'deploy': 'block'}
+        self.context = block_meta.BlockMetaContext({})
+        self.context.sources = [self.source]
+
+    def test_root_deployed_at_block_level(self):
+        block_meta.format_handler(self.info, self.storage_config,
+                                  self.context)
+        self.m_deploy.assert_called_with('/dev/vda2', self.source, self.info)
+        self.assertEqual(0, self.m_mkfs.call_count)
+        self.assertEqual({'/srv/root.img'}, self.context.block_deployed)
+
+    def test_fstype_mismatch_formats(self):
+        self.m_probe.return_value = 'squashfs'
+        block_meta.format_handler(self.info, self.storage_config,
+                                  self.context)
+        self.assertEqual(0, self.m_deploy.call_count)
+        self.m_mkfs.assert_called_with('/dev/vda2', self.info)
+        self.assertEqual(set(), self.context.block_deployed)
+
+    def test_not_root_formats(self):
+        self.storage_config['mount-root']['path'] = '/srv'
+        block_meta.format_handler(self.info, self.storage_config,
+                                  self.context)
+        self.assertEqual(0, self.m_deploy.call_count)
+        self.assertEqual(0, self.m_probe.call_count)
+
+    def test_without_deploy_block_formats(self):
+        del self.source['deploy']
+        block_meta.format_handler(self.info, self.storage_config,
+                                  self.context)
+        self.assertEqual(0, self.m_deploy.call_count)
+        self.assertEqual(1, self.m_mkfs.call_count)
+
+    def test_layered_source_formats(self):
+        self.source['type'] = 'fsimage-layered'
+        block_meta.format_handler(self.info, self.storage_config,
+                                  self.context)
+        self.assertEqual(0, self.m_deploy.call_count)
+        self.assertEqual(1, self.m_mkfs.call_count)
+
+
+class TestDeployFsimage(CiTestCase):
+
+    def setUp(self):
+        super(TestDeployFsimage, self).setUp()
+        basepath = 'curtin.commands.block_meta_v2.'
+        self.add_patch(basepath + 'image.write_image', 'm_write')
+        self.add_patch(basepath + 'block.read_sys_block_size_bytes',
+                       'm_size', return_value=10 << 30)
+        self.add_patch(basepath + 'util.subp', 'm_subp')
+        self.source = {'type': 'fsimage', 'uri': '/srv/root.img'}
+
+    def test_deploy_ext4(self):
+        info = {'fstype': 'ext4', 'label': 'root'}
+        fs_uuid = block_meta_v2.deploy_fsimage('/dev/vda2', self.source, info)
+        self.m_write.assert_called_with(self.source, '/dev/vda2',
+                                        sparse='zeroout')
+        self.assertEqual([
+            call(['e2fsck', '-p', '-f', '/dev/vda2']),
+            call(['resize2fs', '/dev/vda2', '{}k'.format(10 << 20)]),
+            call(['tune2fs', '-U', fs_uuid, '-L', 'root', '/dev/vda2']),
+        ], self.m_subp.call_args_list)
+        self.assertEqual(str(uuid.UUID(fs_uuid)), fs_uuid)
+
+    def test_deploy_xfs_keeps_configured_uuid(self):
+        info = {'fstype': 'xfs',
+                'uuid': 'fb26cc6c-bd2d-4a3c-9bd2-0f3e9e0b3c1b'}
+        fs_uuid = block_meta_v2.deploy_fsimage('/dev/vda2', self.source, info)
+        self.assertEqual(info['uuid'], fs_uuid)
+        cmds = [c[0][0] for c in self.m_subp.call_args_list]
+        self.assertEqual(['mount', 'xfs_growfs', 'umount', 'xfs_admin'],
+                         [c[0] for c in cmds])
+        # the uuid is only changed after the grow, so the mount must not
+        # clash with a mounted filesystem from the same image
+        self.assertEqual(['mount', '-t', 'xfs', '-o', 'nouuid', '/dev/vda2'],
+                         cmds[0][:-1])
+        self.assertEqual(['xfs_admin', '-U', info['uuid'], '/dev/vda2'],
+                         cmds[-1])
+
+
 class TestLvmVolgroupHandler(CiTestCase):
 
     def setUp(self):
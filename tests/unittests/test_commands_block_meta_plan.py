@@ -0,0 +1,178 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+from argparse import Namespace
+from collections import OrderedDict
+import json
+from unittest import mock
+
+from curtin.commands import block_meta, block_meta_plan
+from .helpers import CiTestCase
+
+LOAD_ENV = 'curtin.commands.block_meta_plan.util.load_command_environment'
+MiB = 1 << 20
+GiB = 1 << 30
+
+
+def _sconfig(*actions):
+    return OrderedDict((action['id'], action) for action in actions)
+
+
+def _layout(**disk):
+    disk_a = dict({'id': 'disk-a', 'type': 'disk', 'ptable': 'gpt',
+                   'serial': 'a'}, **disk)
+    return _sconfig(
+        disk_a,
+        {'id': 'disk-b', 'type': 'disk', 'ptable': 'gpt', 'serial': 'b'},
+        {'id': 'a1', 'type': 'partition', 'device': 'disk-a',
+         'size': '1G', 'flag': 'boot'},
+        {'id': 'a2', 'type': 'partition', 'device': 'disk-a',
+         'size': 10 * GiB + 1},
+        {'id': 'b1', 'type': 'partition', 'device': 'disk-b',
+         'size': '20G'},
+        {'id': 'md0', 'type': 'raid', 'raidlevel': 'raid1',
+         'devices': ['a2', 'b1']},
+        {'id': 'md0-fs', 'type': 'format', 'volume': 'md0',
+         'fstype': 'ext4'},
+        {'id': 'md0-mount', 'type': 'mount', 'device': 'md0-fs',
+         'path': '/'},
+    )
+
+
+class TestPlanStorageActions(CiTestCase):
+
+    def _plan(self, sconfig, version=2):
+        plan = block_meta_plan.plan_storage_actions(
+            sconfig, version=version, resolve=False)
+        return plan, {action['id']: action for action in plan['actions']}
+
+    def test_partition_offsets(self):
+        _plan, actions = self._plan(_layout())
+        steps = [actions[pid]['steps'][0] for pid in ('a1', 'a2', 'b1')]
+        self.assertEqual([1, 2, 1], [step['number'] for step in steps])
+        # a2 starts on the first MiB boundary after a1
+        self.assertEqual([MiB, MiB + GiB, MiB],
+                         [step['offset'] for step in steps])
+        self.assertEqual([GiB, 10 * GiB, 20 * GiB],
+                         [step['size'] for step in steps])
+
+    def test_v1_offsets_only_when_given(self):
+        sconfig = _layout()
+        sconfig['a2']['offset'] = '2G'
+        _plan, actions = self._plan(sconfig, version=1)
+        self.assertIsNone(actions['a1']['steps'][0]['offset'])
+        self.assertEqual(2 * GiB, actions['a2']['steps'][0]['offset'])
+
+    def test_costs(self):
+        plan, actions = self._plan(_layout())
+        self.assertEqual(
+            ['wipe', 'ptable'],
+            [step['step'] for step in actions['disk-a']['steps']])
+        self.assertEqual(2 * MiB, actions['disk-a']['cost']['wipe_bytes'])
+        # new partitions get a superblock wipe
+        self.assertEqual(2 * MiB, actions['a1']['cost']['wipe_bytes'])
+        # a raid1 array is the size of, and resyncs, its smallest member
+        self.assertEqual(10 * GiB + 1, actions['md0']['size'])
+        self.assertEqual(10 * GiB + 1, actions['md0']['cost']['resync_bytes'])
+        self.assertEqual(0, actions['md0']['cost']['wipe_bytes'])
+        self.assertEqual([{'step': 'mkfs', 'fstype': 'ext4'}],
+                         actions['md0-fs']['steps'])
+        self.assertEqual({'wipe_bytes': 5 * 2 * MiB,
+                          'resync_bytes': 10 * GiB + 1}, plan['totals'])
+        self.assertEqual(['a2', 'b1'], actions['md0']['depends'])
+
+    def test_unknown_disk_size(self):
+        plan, actions = self._plan(_layout(wipe='zero'))
+        self.assertIsNone(actions['disk-a']['path'])
+        self.assertIsNone(actions['disk-a']['cost']['wipe_bytes'])
+        self.assertIsNone(plan['totals']['wipe_bytes'])
+
+    def test_preserve(self):
+        sconfig = _layout(preserve=True)
+        for item_id in ('a1', 'a2', 'md0', 'md0-fs'):
+            sconfig[item_id]['preserve'] = True
+        _plan, actions = self._plan(sconfig)
+        for item_id in ('disk-a', 'md0', 'md0-fs'):
+            self.assertEqual([], actions[item_id]['steps'])
+        self.assertEqual([], [step for step in actions['a2']['steps']
+                              if step['step'] == 'wipe'])
+        self.assertEqual(0, actions['md0']['cost']['resync_bytes'])
+
+    def test_raid_size(self):
+        sizes = [4, 4, 6, 4]
+        self.assertEqual(
+            [18, 4, 12, 8, 8],
+            [block_meta_plan._raid_size(level, sizes)
+             for level in ('0', '1', '5', '6', '10')])
+        self.assertIsNone(block_meta_plan._raid_size('5', [4, None]))
+        self.assertEqual(
+            ['1', '0', '5'], [block_meta_plan._raid_level(level)
+                              for level in ('mirror', 'stripe', 'raid5')])
+
+    @mock.patch('curtin.commands.block_meta_plan.block')
+    @mock.patch('curtin.commands.block_meta_plan.v1_get_path_to_disk')
+    def test_resolve_disks(self, m_get_path, m_block):
+        m_get_path.side_effect = lambda vol: '/dev/sd' + vol['serial']
+        m_block.path_to_kname.side_effect = lambda path: path[len('/dev/'):]
+        m_block.read_sys_block_size_bytes.return_value = 100 * GiB
+        m_block.get_blockdev_sector_size.return_value = (4096, 4096)
+        plan = block_meta_plan.plan_storage_actions(
+            _layout(wipe='zero'), version=1)
+        disk_a = plan['actions'][0]
+        self.assertEqual('/dev/sda', disk_a['path'])
+        self.assertEqual(100 * GiB + 2 * MiB, disk_a['cost']['wipe_bytes'])
+        m_block.read_sys_block_size_bytes.assert_any_call('sda')
+
+    @mock.patch('curtin.commands.block_meta_plan.block')
+    @mock.patch('curtin.commands.block_meta_plan.v1_get_path_to_disk')
+    def test_missing_disk(self, m_get_path, m_block):
+        m_get_path.side_effect = ValueError('no disk with serial')
+        plan = block_meta_plan.plan_storage_actions(_layout(), version=1)
+        self.assertIsNone(plan['actions'][0]['path'])
+        self.assertEqual([], m_block.read_sys_block_size_bytes.call_args_list)
+
+
+class TestMetaPlan(CiTestCase):
+
+    @mock.patch('curtin.commands.block_meta_plan.block')
+    @mock.patch('curtin.commands.block_meta_plan.v2_get_path_to_disk')
+    @mock.patch('curtin.commands.block_meta.meta_clear')
+    @mock.patch('curtin.commands.block_meta_plan.config.load_command_config')
+    @mock.patch(LOAD_ENV)
+    def test_block_meta_plan(self, m_env, m_load, m_clear, m_get_path,
+                             m_block):
+        m_env.return_value = {}
+        m_load.return_value = {'storage': {
+            'version': 2, 'config': list(_layout().values())}}
+        m_get_path.return_value = None
+        args = Namespace(target=None, devices=None, mode='custom',
+                         force_mode=False, testmode=False, plan=True)
+        with mock.patch('sys.stdout') as m_stdout:
+            self.assertEqual(0, block_meta.block_meta(args))
+        plan = json.loads(
+            ''.join(c[0][0] for c in m_stdout.write.call_args_list))
+        self.assertEqual(2, plan['version'])
+        self.assertEqual(
+            ['disk-a', 'disk-b', 'a1', 'a2', 'b1', 'md0', 'md0-fs',
+             'md0-mount'], [action['id'] for action in plan['actions']])
+        m_clear.assert_not_called()
+
+    @mock.patch('curtin.commands.block_meta.meta_simple')
+    @mock.patch('curtin.commands.block_meta_plan.meta_plan')
+    def test_plan_rejects_other_modes(self, m_plan, m_simple):
+        for mode in (block_meta.SIMPLE, block_meta.SIMPLE_BOOT):
+            args = Namespace(target=None, devices=None, mode=mode,
+                             force_mode=False, testmode=False, plan=True)
+            with self.assertRaisesRegex(ValueError, '--plan'):
+                block_meta.block_meta(args)
+        m_plan.assert_not_called()
+        m_simple.assert_not_called()
+
+    @mock.patch('curtin.commands.block_meta_plan.config.load_command_config')
+    @mock.patch(LOAD_ENV)
+    def test_no_storage_config(self, m_env, m_load):
+        m_env.return_value = {}
+        m_load.return_value = {}
+        with self.assertRaises(ValueError):
+            block_meta_plan.meta_plan(Namespace())
+
+# vi: ts=4 expandtab syntax=python
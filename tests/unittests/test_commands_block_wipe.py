@@ -0,0 +1,50 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+from argparse import Namespace
+from unittest import mock
+
+from curtin.commands import block_wipe
+from .helpers import CiTestCase
+
+
+class TestBlockWipe(CiTestCase):
+
+    def setUp(self):
+        super(TestBlockWipe, self).setUp()
+        self.add_patch('curtin.commands.block_wipe.block.wipe_volume',
+                       'm_wipe')
+        self.add_patch(
+            'curtin.commands.block_wipe.events.ReportEventStack', 'm_stack')
+
+    def _wipe(self, devices, workers):
+        args = Namespace(devices=devices, mode='zero', workers=workers)
+        with self.assertRaises(SystemExit) as exc:
+            block_wipe.wipe_main(args)
+        return exc.exception.code
+
+    def test_single_worker_does_not_report(self):
+        self.assertEqual(0, self._wipe(['/dev/sda', '/dev/sdb'], 1))
+        self.assertEqual(
+            [mock.call('/dev/sda', mode='zero'),
+             mock.call('/dev/sdb', mode='zero')],
+            self.m_wipe.call_args_list)
+        self.m_stack.assert_not_called()
+
+    def test_workers_report_each_device(self):
+        self.assertEqual(0, self._wipe(['/dev/sda', '/dev/sdb'], 2))
+        self.assertEqual(2, self.m_wipe.call_count)
+        self.assertEqual(
+            ['block-wipe/sda', 'block-wipe/sdb'],
+            sorted(c[1]['name'] for c in self.m_stack.call_args_list))
+
+    def test_workers_fail_after_every_device(self):
+        def wipe(dev, mode):
+            if dev == '/dev/sda':
+                raise OSError('wipe failed')
+        self.m_wipe.side_effect = wipe
+        with mock.patch('sys.stderr') as m_stderr:
+            self.assertEqual(1, self._wipe(['/dev/sda', '/dev/sdb'], 2))
+        self.assertEqual(2, self.m_wipe.call_count)
+        self.assertIn('/dev/sda', m_stderr.write.call_args[0][0])
+
+# vi: ts=4 expandtab syntax=python
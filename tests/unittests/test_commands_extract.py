@@ -1,12 +1,20 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 import os
+import threading
+from unittest import mock
 
 from .helpers import CiTestCase
 
 from curtin import util
 from curtin.commands.extract import (
     extract_source,
+    get_copy_mode,
+    get_source_cache,
+    squashfs_listing,
+    SquashfsListingError,
+    unsquashfs_to_target,
     _get_image_stack,
+    _LayerProgress,
     )
 from curtin.url_helper import UrlError
 
@@ -50,7 +58,7 @@ class MountTracker:
 
 class ExtractTestCase(CiTestCase):
 
-    def _fake_download(self, url, path, retries=0):
+    def _fake_download(self, url, path, **kwargs):
         self.downloads.append(os.path.abspath(path))
         with open(path, "w") as fp:
             fp.write("fake content from " + url + "\n")
@@ -402,11 +410,11 @@ class TestExtractSourceLayeredFsImageUrl(ExtractTestCase):
         target = self.random_string()
         myurl = "http://example.io/minimal.standard.debug.squashfs"
 
-        def fail_download_minimal_standard(url, path, retries=0):
+        def fail_download_minimal_standard(url, path, **kwargs):
             if url == "http://example.io/minimal.standard.squashfs":
                 raise UrlError(url, 404, "Couldn't download",
                                None, None)
-            return self._fake_download(url, path, retries)
+            return self._fake_download(url, path, **kwargs)
         self.m_download.side_effect = fail_download_minimal_standard
 
         self.assertRaises(
@@ -420,13 +428,13 @@ class TestExtractSourceLayeredFsImageUrl(ExtractTestCase):
         target = self.random_string()
         myurl = "http://example.io/minimal.standard.debug.squashfs"
 
-        def empty_download_minimal_standard(url, path, retries=0):
+        def empty_download_minimal_standard(url, path, **kwargs):
             if url == "http://example.io/minimal.standard.squashfs":
                 self.downloads.append(os.path.abspath(path))
                 with open(path, "w") as fp:
                     fp.write("")
                 return
-            return self._fake_download(url, path, retries)
+            return self._fake_download(url, path, **kwargs)
         self.m_download.side_effect = empty_download_minimal_standard
 
         self.assertRaises(
@@ -435,11 +443,341 @@ class TestExtractSourceLayeredFsImageUrl(ExtractTestCase):
             target)
         self.assertEqual(0, self.m_copy_to_target.call_count)
         self.assertEqual(3, self.m_download.call_count)
-        for i, image_url in enumerate(["minimal.squashfs",
-                                       "minimal.standard.squashfs",
-                                       "minimal.standard.debug.squashfs"]):
-            self.assertEqual("http://example.io/" + image_url,
-                             self.m_download.call_args_list[i][0][0])
+        # layers are downloaded concurrently, in no particular order
+        self.assertEqual(
+            sorted("http://example.io/" + image_url
+                   for image_url in ["minimal.squashfs",
+                                     "minimal.standard.squashfs",
+                                     "minimal.standard.debug.squashfs"]),
+            sorted(c[0][0] for c in self.m_download.call_args_list))
+
+    def test_remote_layers_mounted_as_they_land(self):
+        mount_tracker = self.track_mounts()
+        target = self.random_string()
+        myurl = "http://example.io/minimal.standard.debug.squashfs"
+        top_mounted = threading.Event()
+        tracker_mount = mount_tracker.mount
+
+        def mount(device, mountpoint, options=None, type=None):
+            tracker_mount(device, mountpoint, options, type)
+            if device.endswith('debug.squashfs'):
+                top_mounted.set()
+
+        def slow_base_download(url, path, **kwargs):
+            if url == "http://example.io/minimal.squashfs":
+                # the top layer lands and is mounted before the base
+                self.assertTrue(top_mounted.wait(10))
+            return self._fake_download(url, path, **kwargs)
+
+        self.add_patch('curtin.commands.extract.mount', new=mount)
+        self.m_download.side_effect = slow_base_download
+        extract_source({'type': 'fsimage-layered', 'uri': myurl}, target)
+
+        urls = [
+            "http://example.io/minimal.squashfs",
+            "http://example.io/minimal.standard.squashfs",
+            "http://example.io/minimal.standard.debug.squashfs",
+            ]
+        self.assert_downloaded_and_mounted_and_extracted(
+            mount_tracker, urls, target)
+        for call in self.m_download.call_args_list:
+            self.assertIn('reporthook', call[1])
+
+
+class TestExtractSourceCached(ExtractTestCase):
+    """Test extract_source with a source cache."""
+
+    def test_layers_mounted_from_cache(self):
+        mount_tracker = self.track_mounts()
+        cachedir = self.tmp_dir()
+        cache = mock.Mock()
+
+        def fetch(url, sha256=None, **kwargs):
+            path = os.path.join(cachedir, os.path.basename(url))
+            util.write_file(path, url)
+            return path
+        cache.fetch.side_effect = fetch
+        target = self.random_string()
+
+        extract_source(
+            {'type': 'fsimage-layered', 'uri': 'http://host/a.b.squashfs'},
+            target, cache=cache)
+
+        self.assertEqual(0, self.m_download.call_count)
+        cached = [os.path.join(cachedir, f) for f in ('a.squashfs',
+                                                      'a.b.squashfs')]
+        self.assert_mounted_and_extracted(mount_tracker, cached, target)
+        # cached layers outlive the install
+        self.assertTrue(all(os.path.exists(f) for f in cached))
+
+
+class TestExtractSourceUnsquashfs(ExtractTestCase):
+    """Test extract_source with copy_mode unsquashfs."""
+
+    def setUp(self):
+        super(TestExtractSourceUnsquashfs, self).setUp()
+        self.add_patch('curtin.commands.extract.image.probe_fstype',
+                       'm_probe', return_value='squashfs')
+
+    def test_layers_unpacked_in_order(self):
+        self.track_mounts()
+        self.add_patch('curtin.commands.extract.unsquashfs_to_target',
+                       'm_unsquashfs')
+        tdir = self.tmp_dir()
+        for name in ('a.squashfs', 'a.b.squashfs'):
+            util.write_file(os.path.join(tdir, name), name)
+        target = self.random_string()
+
+        extract_source(
+            {'type': 'fsimage-layered',
+             'uri': os.path.join(tdir, 'a.b.squashfs')},
+            target, copy_mode='unsquashfs')
+
+        self.m_unsquashfs.assert_called_once_with(
+            [os.path.join(tdir, 'a.squashfs'),
+             os.path.join(tdir, 'a.b.squashfs')], target)
+        self.assertEqual(0, self.m_copy_to_target.call_count)
+
+    def test_remote_image_downloaded(self):
+        self.track_mounts()
+        self.add_patch('curtin.commands.extract.unsquashfs_to_target',
+                       'm_unsquashfs')
+        target = self.random_string()
+
+        extract_source({'type': 'fsimage', 'uri': 'http://host/a.squashfs'},
+                       target, copy_mode='unsquashfs')
+
+        self.assertEqual([self.downloads], [self.m_unsquashfs.call_args[0][0]])
+
+    def test_other_images_copied_with_rsync(self):
+        mount_tracker = self.track_mounts()
+        self.add_patch('curtin.commands.extract.unsquashfs_to_target',
+                       'm_unsquashfs')
+        self.m_probe.return_value = 'ext4'
+        target = self.random_string()
+
+        extract_source({'type': 'fsimage', 'uri': 'http://host/a.img'},
+                       target, copy_mode='unsquashfs')
+
+        self.assertEqual(0, self.m_unsquashfs.call_count)
+        # the image fetched for probing is mounted, not downloaded again
+        self.assert_downloaded_and_mounted_and_extracted(
+            mount_tracker, ['http://host/a.img'], target)
+
+    def test_extra_rsync_args_use_rsync(self):
+        mount_tracker = self.track_mounts()
+        self.add_patch('curtin.commands.extract.unsquashfs_to_target',
+                       'm_unsquashfs')
+        path = self.tmp_path('a.squashfs')
+        util.write_file(path, 'a.squashfs')
+        target = self.random_string()
+
+        with self.assertLogs('curtin', level='WARNING') as logs:
+            extract_source({'type': 'fsimage', 'uri': path}, target,
+                           extra_rsync_args=['--exclude=/boot'],
+                           copy_mode='unsquashfs')
+
+        self.assertIn('extra_rsync_args', logs.output[0])
+        self.assertEqual(0, self.m_unsquashfs.call_count)
+        self.assertEqual(0, self.m_probe.call_count)
+        self.m_copy_to_target.assert_called_once_with(
+            mount_tracker.mounts[0].mountpoint, target,
+            extra_rsync_args=['--exclude=/boot'])
+
+    def test_unlistable_image_copied_with_rsync(self):
+        mount_tracker = self.track_mounts()
+        self.add_patch('curtin.commands.extract.unsquashfs_to_target',
+                       'm_unsquashfs')
+        self.m_unsquashfs.side_effect = SquashfsListingError('bad name')
+        path = self.tmp_path('a.squashfs')
+        util.write_file(path, 'a.squashfs')
+        target = self.random_string()
+
+        with self.assertLogs('curtin', level='WARNING') as logs:
+            extract_source({'type': 'fsimage', 'uri': path}, target,
+                           copy_mode='unsquashfs')
+
+        self.assertIn('bad name', logs.output[0])
+        self.m_copy_to_target.assert_called_once_with(
+            mount_tracker.mounts[0].mountpoint, target,
+            extra_rsync_args=None)
+
+
+class TestGetCopyMode(CiTestCase):
+
+    @mock.patch('curtin.commands.extract.util.which')
+    def test_copy_mode(self, m_which):
+        m_which.return_value = '/usr/bin/unsquashfs'
+        self.assertEqual('rsync', get_copy_mode({}))
+        self.assertEqual('unsquashfs', get_copy_mode(
+            {'install': {'copy_mode': 'unsquashfs'}}))
+        with self.assertRaises(ValueError):
+            get_copy_mode({'install': {'copy_mode': 'tar'}})
+
+    @mock.patch('curtin.commands.extract.util.which')
+    def test_unsquashfs_missing(self, m_which):
+        m_which.return_value = None
+        self.assertEqual('rsync', get_copy_mode(
+            {'install': {'copy_mode': 'unsquashfs'}}))
+
+
+class TestUnsquashfsToTarget(CiTestCase):
+
+    def setUp(self):
+        super(TestUnsquashfsToTarget, self).setUp()
+        self.target = self.tmp_dir()
+        self.layers = {}
+        self.opaque = set()
+        self.add_patch('curtin.commands.extract.util.subp', 'm_subp',
+                       side_effect=self._subp)
+        self.add_patch('curtin.commands.extract.os.getxattr',
+                       side_effect=self._getxattr)
+        self.add_patch('curtin.commands.extract.os.removexattr')
+        self.add_patch('curtin.commands.extract.events')
+
+    def _getxattr(self, path, name, follow_symlinks=True):
+        if path in self.opaque:
+            return b'y'
+        raise OSError(61, 'No data available')
+
+    def _subp(self, cmd, capture=False, decode='replace'):
+        image, root = cmd[-1], cmd[-2]
+        if '-lln' in cmd:
+            lines = ['drwxr-xr-x 0/0  42 2024-01-01 00:00 %s' % root]
+            for path, content in self.layers[image]:
+                if content is None:
+                    lines.append('crw-r--r-- 0/0  0,  0 2024-01-01 00:00 '
+                                 '%s/%s' % (root, path))
+                elif content == '/':
+                    lines.append('drwxr-xr-x 0/0  3 2024-01-01 00:00 '
+                                 '%s/%s' % (root, path))
+                else:
+                    lines.append('-rw-r--r-- 0/0  %d 2024-01-01 00:00 '
+                                 '%s/%s' % (len(content), root, path))
+            return ('\n'.join(lines) + '\n').encode(), b''
+        for path, content in self.layers[image]:
+            dest = os.path.join(root, path)
+            if content is None:
+                util.write_file(dest, '')
+            elif content == '/':
+                os.makedirs(dest, exist_ok=True)
+            else:
+                util.write_file(dest, content)
+        return '', ''
+
+    def _tree(self):
+        found = {}
+        for root, dirs, files in os.walk(self.target):
+            for name in files:
+                path = os.path.join(root, name)
+                found[os.path.relpath(path, self.target)] = util.load_file(
+                    path)
+        return found
+
+    def test_listing(self):
+        self.layers['img'] = [('etc', '/'), ('etc/a file', 'xyz'),
+                              ('gone', None)]
+        entries = squashfs_listing('img', '/t')
+        self.assertEqual({'/t': ('d', 42), '/t/etc': ('d', 3),
+                          '/t/etc/a file': ('-', 3),
+                          '/t/gone': ('c', (0, 0))}, entries)
+
+    def _listing(self, *lines):
+        self.m_subp.side_effect = None
+        self.m_subp.return_value = (b'\n'.join(lines) + b'\n', b'')
+        return squashfs_listing('img', '/t')
+
+    def test_symlink_listing(self):
+        self.assertEqual(
+            {'/t/bin': ('l', 7), '/t/dev/sda1': ('b', (8, 1))},
+            self._listing(
+                b'Parallel unsquashfs: Using 4 processors',
+                b'',
+                b'lrwxrwxrwx 0/0  7 2024-01-01 00:00 /t/bin -> usr/bin',
+                b'brw-rw---- 0/6  8,  1 2024-01-01 00:00 /t/dev/sda1'))
+
+    def test_listing_keeps_undecodable_names(self):
+        entries = self._listing(
+            b'drwxr-xr-x 0/0  3 2024-01-01 00:00 /t',
+            b'-rw-r--r-- 0/0  1 2024-01-01 00:00 /t/\xff \x0b\x1c')
+        self.assertEqual(['/t', os.fsdecode(b'/t/\xff \x0b\x1c')],
+                         sorted(entries))
+
+    def test_listing_name_with_newline(self):
+        for name in (b'a\nb', b'a\n'):
+            with self.assertRaises(SquashfsListingError):
+                self._listing(
+                    b'drwxr-xr-x 0/0  3 2024-01-01 00:00 /t',
+                    b'-rw-r--r-- 0/0  1 2024-01-01 00:00 /t/' + name,
+                    b'-rw-r--r-- 0/0  1 2024-01-01 00:00 /t/c')
+
+    def test_listing_ambiguous_symlink(self):
+        with self.assertRaises(SquashfsListingError):
+            self._listing(
+                b'lrwxrwxrwx 0/0  6 2024-01-01 00:00 /t/a -> b -> c')
+
+    def test_unlistable_layer_leaves_target_alone(self):
+        self.layers['base'] = [('etc', '/'), ('etc/keep', 'base')]
+        self.layers['upper'] = [('etc', '/'), ('etc/new\nfile', 'upper')]
+        with self.assertRaises(SquashfsListingError):
+            unsquashfs_to_target(['base', 'upper'], self.target)
+        self.assertEqual({}, self._tree())
+        self.assertEqual(['-lln', '-lln'],
+                         [c[0][0][1] for c in self.m_subp.call_args_list])
+
+    def test_whiteouts_and_opaque_dirs(self):
+        self.layers['base'] = [('etc', '/'), ('etc/keep', 'base'),
+                               ('etc/remove', 'base'), ('opt', '/'),
+                               ('opt/old', 'base'), ('lib', '/'),
+                               ('lib/mod', 'base')]
+        self.layers['upper'] = [('etc', '/'), ('etc/keep', 'upper'),
+                                ('etc/remove', None), ('opt', '/'),
+                                ('opt/new', 'upper'), ('lib', 'a file now')]
+        self.opaque.add(os.path.join(self.target, 'opt'))
+
+        unsquashfs_to_target(['base', 'upper'], self.target)
+
+        self.assertEqual({'etc/keep': 'upper', 'opt/new': 'upper',
+                          'lib': 'a file now'}, self._tree())
+        unpacks = [c[0][0] for c in self.m_subp.call_args_list
+                   if '-lln' not in c[0][0]]
+        self.assertEqual(['base', 'upper'], [c[-1] for c in unpacks])
+        self.assertIn('-f', unpacks[0])
+        self.assertIn('-p', unpacks[0])
+
+
+class TestGetSourceCache(CiTestCase):
+
+    def test_not_configured(self):
+        self.assertIsNone(get_source_cache({}))
+        self.assertIsNone(get_source_cache({'install': {}}))
+
+    def test_path(self):
+        path = self.tmp_dir()
+        cache = get_source_cache({'install': {'source_cache': path}})
+        self.assertEqual(path, cache.path)
+        self.assertIsNone(cache.max_size)
+
+    def test_max_size(self):
+        path = self.tmp_dir()
+        cache = get_source_cache(
+            {'install': {'source_cache': {'path': path, 'max_size': '2G'}}})
+        self.assertEqual(2 << 30, cache.max_size)
+
+
+class TestLayerProgress(CiTestCase):
+
+    @mock.patch('curtin.commands.extract.events.report_progress_event')
+    def test_total_progress(self, m_report):
+        progress = _LayerProgress('layers', interval=0)
+        progress.reporthook('a')(0, 1024, '4096')
+        progress.reporthook('b')(2, 1024, 2048)
+        progress.reporthook('a')(5, 1024, '4096')
+        self.assertEqual(3, m_report.call_count)
+        self.assertEqual(
+            mock.call('layers', 'downloaded 6144 of 6144 bytes of 2 layers',
+                      level='DEBUG'),
+            m_report.call_args)
 
 
 class TestGetImageStack(CiTestCase):
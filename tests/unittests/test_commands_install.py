@@ -4,6 +4,8 @@ import copy
 import json
 from unittest import mock
 import os
+import subprocess
+import sys
 
 from curtin import config
 from curtin.commands import install
@@ -185,6 +187,149 @@ class TestCmdInstall(CiTestCase):
             self.m_copy_log.call_args_list)
 
 
+class TestStage(CiTestCase):
+
+    def setUp(self):
+        super(TestStage, self).setUp()
+        self.logfile = self.tmp_path('install.log')
+        self.stdout = []
+
+    def _stage(self, commands, **kwargs):
+        stage = install.Stage('test', commands, os.environ.copy(),
+                              logfile=self.logfile, **kwargs)
+        stage.write_stdout = self.stdout.append
+        return stage
+
+    def _log(self):
+        with open(self.logfile, 'rb') as fp:
+            return fp.read()
+
+    def test_output_written_by_line(self):
+        stage = self._stage({'cmd': ['sh', '-c', 'printf "a\\nb\\nc"']})
+        stage.run()
+        self.assertEqual(b'a\nb\nc', b''.join(self.stdout))
+        self.assertEqual(b'a\nb\nc', self._log())
+        # complete lines are written together, the partial line after them
+        self.assertEqual([b'a\nb\n', b'c'], self.stdout)
+        self.assertEqual({'bytes': 5, 'lines': 2},
+                         {k: v for k, v in stage.stats['cmd'].items()
+                          if k != 'seconds'})
+
+    def test_timestamps(self):
+        stage = self._stage({'cmd': ['sh', '-c', 'printf "a\\nb\\n"']},
+                            timestamps=True)
+        stage.run()
+        lines = self._log().splitlines()
+        self.assertEqual(2, len(lines))
+        for line, text in zip(lines, (b'a', b'b')):
+            self.assertRegex(line, rb'^\[\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\] ')
+            self.assertTrue(line.endswith(b'] ' + text))
+
+    def test_failure_keeps_output_tail(self):
+        stage = self._stage(
+            {'cmd': ['sh', '-c', 'head -c 3000 /dev/zero | tr "\\\\0" x;'
+                                 ' echo end; exit 2']})
+        with mock.patch('curtin.commands.install.STAGE_OUTPUT_TAIL', 1000):
+            with self.assertRaises(install.util.ProcessExecutionError) as ctx:
+                stage.run()
+        self.assertEqual(2, ctx.exception.exit_code)
+        self.assertEqual(3004, len(self._log()))
+        # the error holds the last 1000 bytes, 'x' * 996 + 'end\n'
+        self.assertEqual(996, ctx.exception.stdout.count('x'))
+        self.assertIn('end', ctx.exception.stdout)
+
+
+class TestForkCommands(TestStage):
+
+    def setUp(self):
+        super(TestForkCommands, self).setUp()
+        # threads other tests leave behind would prevent forking
+        self.add_patch('curtin.commands.install.threading.active_count',
+                       'm_active_count', return_value=1)
+
+    def _fake_main(self, argv):
+        print('ran %s from %s' % (' '.join(argv), os.environ['FAKE']))
+        sys.stdout.flush()
+        sys.stderr.write('to stderr\n')
+        sys.exit(int(argv[-1]))
+
+    def _stage(self, commands, **kwargs):
+        stage = super(TestForkCommands, self)._stage(
+            commands, fork_commands=True, **kwargs)
+        stage.env['FAKE'] = 'the stage env'
+        return stage
+
+    @mock.patch('curtin.commands.main.main')
+    def test_curtin_commands_forked(self, m_main):
+        m_main.side_effect = self._fake_main
+        with mock.patch('curtin.commands.install.subprocess.Popen') as m_p:
+            self._stage({'cmd': ['curtin', 'hook', '0']}).run()
+        self.assertEqual(0, m_p.call_count)
+        self.assertEqual(b'ran hook 0 from the stage env\nto stderr\n',
+                         self._log())
+
+    @mock.patch('curtin.commands.main.main')
+    def test_exit_code_kept(self, m_main):
+        m_main.side_effect = self._fake_main
+        with self.assertRaises(install.util.ProcessExecutionError) as ctx:
+            self._stage({'cmd': ['curtin', 'hook', '3']}).run()
+        self.assertEqual(3, ctx.exception.exit_code)
+        self.assertIn('ran hook 3', ctx.exception.stdout)
+
+    @mock.patch('curtin.commands.main.main')
+    def test_exception_fails_command(self, m_main):
+        m_main.side_effect = ValueError('boom')
+        with self.assertRaises(install.util.ProcessExecutionError) as ctx:
+            self._stage({'cmd': ['curtin', 'hook']}).run()
+        self.assertEqual(1, ctx.exception.exit_code)
+        self.assertIn('ValueError: boom', ctx.exception.stdout)
+
+    @mock.patch('curtin.commands.main.main')
+    def test_not_forked_with_other_threads(self, m_main):
+        self.m_active_count.return_value = 2
+        popen = subprocess.Popen
+        with mock.patch('curtin.commands.install.subprocess.Popen') as m_p:
+            m_p.side_effect = (
+                lambda cmd, **kwargs: popen(['echo', 'new curtin'], **kwargs))
+            self._stage({'cmd': ['curtin', 'hook', '0']}).run()
+        m_main.assert_not_called()
+        self.assertEqual(['curtin', 'hook', '0'], m_p.call_args[0][0])
+        self.assertEqual(b'new curtin\n', self._log())
+
+    def test_other_commands_not_forked(self):
+        for cmd in (['sh', '-c', 'echo sh'], 'echo shell', ['curtin']):
+            self.assertFalse(install.is_curtin_command(cmd))
+        self._stage({'cmd': ['sh', '-c', 'echo sh']}).run()
+        self.assertEqual(b'sh\n', self._log())
+
+
+class TestCommandConfigCache(CiTestCase):
+
+    def setUp(self):
+        super(TestCommandConfigCache, self).setUp()
+        self.add_patch('curtin.config._CONFIG_CACHE', new={})
+        self.cfg_file = self.tmp_path('config')
+        with open(self.cfg_file, 'w') as fp:
+            json.dump({'a': 1}, fp)
+
+    def test_cached_config_returned(self):
+        config.cache_config(self.cfg_file, {'a': 1, 'cached': True})
+        cfg = config.load_command_config(None, {'config': self.cfg_file})
+        self.assertEqual({'a': 1, 'cached': True}, cfg)
+        # callers get their own copy
+        cfg['b'] = 2
+        self.assertNotIn('b', config.load_command_config(
+            None, {'config': self.cfg_file}))
+
+    def test_changed_file_parsed(self):
+        config.cache_config(self.cfg_file, {'cached': True})
+        with open(self.cfg_file, 'w') as fp:
+            json.dump({'a': 1, 'changed': True}, fp)
+        self.assertEqual(
+            {'a': 1, 'changed': True},
+            config.load_command_config(None, {'config': self.cfg_file}))
+
+
 class TestWorkingDir(CiTestCase):
     def test_target_dir_may_exist(self):
         """WorkingDir supports existing empty target directory."""
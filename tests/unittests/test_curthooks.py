@@ -3050,6 +3050,8 @@ class TestBuiltinCurthooks(CiTestCase):
 @patch("curtin.commands.curthooks.util.EFIVarFSBug", Mock())
 @patch("curtin.commands.curthooks.events.ReportEventStack",
        Mock(return_value=contextlib.nullcontext()))
+@patch("curtin.commands.curthooks.util.ChrootableTarget",
+       Mock(return_value=contextlib.nullcontext()))
 class TestCurthooks(CiTestCase):
     def test_ubuntu(
             self, m_builtin_curthooks, m_uc_curthooks, m_is_uc, m_run_hookk):
@@ -3095,5 +3097,17 @@ class TestCurthooks(CiTestCase):
         m_run_hook.assert_not_called()
         m_builtin_curthooks.assert_called()
 
+    def test_shared_chroot_only_with_target_executor(
+            self, m_builtin_curthooks, m_uc_curthooks, m_is_uc, m_run_hook):
+        for target_executor, entered in ((False, False), (True, True)):
+            cfg = {"curthooks": {"target_executor": target_executor}}
+            with patch("curtin.commands.curthooks.util.ChrootableTarget",
+                       Mock(return_value=contextlib.nullcontext())) as m_ct:
+                with self.assertRaises(SystemExit):
+                    curthooks.curthooks(
+                        argparse.Namespace(target="/target", config=cfg))
+            self.assertEqual(entered, m_ct.called)
+            m_builtin_curthooks.assert_called_with(cfg, "/target", ANY)
+
 
 # vi: ts=4 expandtab syntax=python
@@ -78,7 +78,8 @@ class TestBlock(CiTestCase):
             "sda1", self.storage_config)
         mock_parted.getDevice.assert_called_with("/dev/fake/serial-DISK_1")
         self.assertTrue(mock_parted.newDisk.called)
-        mock_devsync.assert_called_with("/dev/fake/serial-DISK_1")
+        mock_devsync.assert_called_with("/dev/fake/serial-DISK_1",
+                                        wait_for=path)
 
         # Test lvm partition
         path = curtin.commands.block_meta.get_path_to_storage_volume(
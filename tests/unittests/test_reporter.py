@@ -6,6 +6,7 @@ from __future__ import (
     unicode_literals,
     )
 
+from unittest import mock
 from unittest.mock import patch
 
 from curtin.reporter.legacy import (
@@ -27,6 +28,8 @@ from .helpers import CiTestCase
 
 import base64
 import os
+import threading
+import time
 
 
 class TestLegacyReporter(CiTestCase):
@@ -204,4 +207,144 @@ class TestReporter(CiTestCase):
             url='127.0.0.1:8000', data=event.as_dict(),
             headers=webhook_handler.headers, retries=None)
 
+
+class TestAsyncWebHookHandler(CiTestCase):
+
+    def setUp(self):
+        super(TestAsyncWebHookHandler, self).setUp()
+        self.add_patch('curtin.url_helper.OauthUrlHelper', 'm_helper')
+        self.add_patch('curtin.reporter.handlers.WEBHOOK_BACKOFF', new=(0, 0))
+        self.posted = []
+        self.release = threading.Event()
+        self.release.set()
+
+        def geturl(url, data, headers, retries):
+            self.release.wait()
+            self.posted.append(data)
+        self.geturl = geturl
+        self.m_helper.return_value.geturl.side_effect = self._geturl
+
+    def _geturl(self, *args, **kwargs):
+        return self.geturl(*args, **kwargs)
+
+    def _handler(self, **kwargs):
+        handler = handlers.WebHookHandler('127.0.0.1:8000', level='INFO',
+                                          asynchronous=True, **kwargs)
+        self.addCleanup(self.release.set)
+        return handler
+
+    def _event(self, name, event_type=events.START_EVENT_TYPE):
+        if event_type == events.FINISH_EVENT_TYPE:
+            return events.FinishReportingEvent(name, 'desc', level='INFO')
+        return events.ReportingEvent(event_type, name, 'desc', level='INFO')
+
+    def _names(self, posted):
+        return [[d['name'] for d in data] if isinstance(data, list)
+                else data['name'] for data in posted]
+
+    def _block(self, handler):
+        # hold the worker in the post of a first event
+        self.release.clear()
+        handler.publish_event(self._event('first'))
+        for _ in range(100):
+            if not handler._queue:
+                break
+            time.sleep(0.01)
+
+    def test_events_posted_in_background(self):
+        handler = self._handler()
+        self._block(handler)
+        handler.publish_event(self._event('a'))
+        handler.publish_event(self._event('b'))
+        self.assertEqual([], self.posted)
+        self.release.set()
+        self.assertTrue(handler.flush())
+        self.assertEqual(['first', 'a', 'b'], self._names(self.posted))
+
+    def test_batches(self):
+        handler = self._handler(batch_size=3)
+        self._block(handler)
+        for name in 'abcd':
+            handler.publish_event(self._event(name))
+        self.release.set()
+        handler.flush()
+        self.assertEqual([['first'], ['a', 'b', 'c'], ['d']],
+                         self._names(self.posted))
+
+    def test_drop_when_full(self):
+        handler = self._handler(queue_size=2)
+        self._block(handler)
+        for name in 'abc':
+            handler.publish_event(self._event(name))
+        self.assertEqual(1, handler.dropped)
+        self.release.set()
+        handler.flush()
+        self.assertEqual(['first', 'a', 'b'], self._names(self.posted))
+        self.assertEqual(0, handler.dropped)
+
+    def test_coalesce_progress(self):
+        handler = self._handler(queue_size=2, overflow='coalesce')
+        self._block(handler)
+        handler.publish_event(self._event('p', events.PROGRESS_EVENT_TYPE))
+        handler.publish_event(self._event('a'))
+        later = self._event('p', events.PROGRESS_EVENT_TYPE)
+        later.description = 'later'
+        handler.publish_event(later)
+        # the later progress event replaced the queued one, and is now
+        # dropped to make room for an event it cannot coalesce with
+        handler.publish_event(self._event('b'))
+        self.release.set()
+        handler.flush()
+        self.assertEqual(['first', 'a', 'b'], self._names(self.posted))
+        handler = self._handler(queue_size=2, overflow='coalesce')
+        self.posted.clear()
+        self._block(handler)
+        handler.publish_event(self._event('a'))
+        handler.publish_event(self._event('p', events.PROGRESS_EVENT_TYPE))
+        handler.publish_event(later)
+        self.release.set()
+        handler.flush()
+        self.assertEqual('later', self.posted[-1]['description'])
+
+    def test_finish_waits_for_room(self):
+        handler = self._handler(queue_size=1)
+        self._block(handler)
+        handler.publish_event(self._event('a'))
+        threading.Timer(0.1, self.release.set).start()
+        handler.publish_event(self._event('a', events.FINISH_EVENT_TYPE))
+        handler.flush()
+        self.assertEqual(['first', 'a', 'a'], self._names(self.posted))
+        self.assertEqual('finish', self.posted[-1]['event_type'])
+
+    def test_failed_post_retried(self):
+        handler = self._handler()
+        failures = [url_helper.UrlError(OSError('refused'))]
+
+        def geturl(url, data, headers, retries):
+            if failures:
+                raise failures.pop()
+            self.posted.append(data)
+        self.geturl = geturl
+        handler.publish_event(self._event('a'))
+        handler.flush()
+        self.assertEqual(['a'], self._names(self.posted))
+
+    def test_flush_timeout(self):
+        handler = self._handler()
+        self._block(handler)
+        self.assertFalse(handler.flush(timeout=0.01))
+        self.release.set()
+        self.assertTrue(handler.flush())
+
+    def test_invalid_overflow(self):
+        with self.assertRaises(ValueError):
+            self._handler(overflow='block')
+
+    @patch('curtin.reporter.instantiated_handler_registry')
+    def test_reporter_flush(self, m_registry):
+        handler = mock.Mock()
+        m_registry.registered_items = {'hook': handler}
+        reporter.flush(timeout=5)
+        handler.flush.assert_called_with(timeout=5)
+
 # vi: ts=4 expandtab syntax=python
@@ -37,6 +37,16 @@ class TestStorageConfigSchema(CiTestCase):
         config = {'config': [disk], 'version': 1}
         storage_config.validate_config(config)
 
+    @skipUnlessJsonSchema()
+    def test_schema_accepts_workers(self):
+        disk = {'id': 'disk-a', 'type': 'disk', 'path': '/dev/sda'}
+        config = {'config': [disk], 'version': 1, 'workers': 4}
+        storage_config.validate_config(config)
+        for workers in (0, 'four'):
+            config['workers'] = workers
+            with self.assertRaises(ValueError):
+                storage_config.validate_config(config)
+
     @skipUnlessJsonSchema()
     def test_disk_schema_accepts_nvme_uuid(self):
         disk = {
@@ -109,6 +119,46 @@ class TestStorageConfigSchema(CiTestCase):
         with self.assertRaises(ValueError):
             storage_config.validate_config(config)
 
+    @skipUnlessJsonSchema()
+    def test_validators_compiled_once(self):
+        disk = {"id": "disk-vdc", "path": "/dev/vdc", "type": "disk"}
+        self.add_patch('curtin.storage_config._SCHEMA_VALIDATORS', new={})
+        storage_config.validate_config({'config': [disk], 'version': 1})
+        validators = dict(storage_config._SCHEMA_VALIDATORS)
+        # the document and the disk schema
+        self.assertEqual({None, 'disk'}, set(validators))
+        storage_config.validate_config({'config': [disk], 'version': 1})
+        storage_config.validate_config(disk)
+        self.assertEqual(validators, storage_config._SCHEMA_VALIDATORS)
+
+    @skipUnlessJsonSchema()
+    def test_validate_item(self):
+        storage_config.validate_config(
+            {"id": "disk-vdc", "path": "/dev/vdc", "type": "disk"})
+        with self.assertRaisesRegex(ValueError, 'Unknown storage type'):
+            storage_config.validate_config({"id": "x", "type": "floppy"})
+
+    @skipUnlessJsonSchema()
+    def test_validate_reports_all_errors(self):
+        config = {
+            'version': 3,
+            'config': [
+                {"id": "disk-vdc", "path": "/dev/vdc", "type": "disk"},
+                {"id": "format-1", "fstype": "BitLocker", "type": "format",
+                 "volume": "disk-vdc"},
+                {"id": "format-2", "type": "format", "volume": "disk-vdc"},
+                {"id": "notype"},
+            ],
+        }
+        with self.assertRaises(ValueError) as cm:
+            storage_config.validate_config(config)
+        message = str(cm.exception)
+        self.assertIn('Unexpected value (version) for property "3"',
+                      message)
+        self.assertIn('format-1', message)
+        self.assertIn("'fstype' is a required property", message)
+        self.assertIn("'type' is a required property", message)
+
 
 class TestDecodeLibblkidString(CiTestCase):
     def test_easy(self):
@@ -293,6 +343,134 @@ def _get_data(datafile):
     return jdata.get('storage') if 'storage' in jdata else jdata
 
 
+class TestProbeIndex(CiTestCase):
+
+    def setUp(self):
+        super(TestProbeIndex, self).setUp()
+        self.blockdev_data = {
+            '/dev/sda': {
+                'DEVLINKS': '/dev/disk/by-id/wwn-a /dev/disk/by-path/p0',
+                'partitiontable': {'partitions': [
+                    {'node': '/dev/disk/by-id/wwn-a-part1', 'start': 2048},
+                    {'node': '/dev/sda2', 'start': 4096}]}},
+            '/dev/sda1': {'DEVLINKS': '/dev/disk/by-id/wwn-a-part1'},
+            '/dev/sda2': {},
+            '/dev/sdb': {'DEVLINKS': '/dev/disk/by-path/p0'},
+        }
+        self.index = storage_config.ProbeIndex(self.blockdev_data)
+
+    def test_lookup_devname(self):
+        self.assertEqual('/dev/sda',
+                         self.index.lookup_devname('/dev/sda'))
+        self.assertEqual('/dev/sda',
+                         self.index.lookup_devname('/dev/disk/by-id/wwn-a'))
+        self.assertIsNone(self.index.lookup_devname('/dev/sdc'))
+        self.assertIsNone(self.index.lookup_devname(None))
+
+    def test_lookup_devname_shared_link_returns_first(self):
+        self.assertEqual('/dev/sda',
+                         self.index.lookup_devname('/dev/disk/by-path/p0'))
+        self.assertEqual(['/dev/sda', '/dev/sdb'],
+                         self.index.devlinks['/dev/disk/by-path/p0'])
+
+    def test_ptable_entry(self):
+        self.assertEqual(
+            2048, self.index.ptable_entry('/dev/sda', '/dev/sda1')['start'])
+        self.assertEqual(
+            4096, self.index.ptable_entry('/dev/sda', '/dev/sda2')['start'])
+        self.assertIsNone(self.index.ptable_entry('/dev/sda', '/dev/sdb'))
+        self.assertIsNone(self.index.ptable_entry('/dev/sdb', '/dev/sdb1'))
+
+    @skipUnlessJsonSchema()
+    def test_extract_storage_config_shares_index(self):
+        probe_data = _get_data('probert_storage_dasd.json')
+        with mock.patch.object(storage_config, 'ProbeIndex',
+                               wraps=storage_config.ProbeIndex) as m_index:
+            storage_config.extract_storage_config(probe_data)
+        self.assertEqual(1, m_index.call_count)
+
+
+class TestStorageConfigGraph(CiTestCase):
+
+    def _graph(self, items, **kwargs):
+        sconfig = storage_config.extract_storage_ordered_dict(
+            {'storage': {'config': items}})
+        return storage_config.StorageConfigGraph(sconfig, **kwargs)
+
+    def setUp(self):
+        super(TestStorageConfigGraph, self).setUp()
+        self.items = [
+            {'type': 'format', 'id': 'md0-fmt', 'volume': 'md0',
+             'fstype': 'ext4'},
+            {'type': 'raid', 'id': 'md0', 'raidlevel': 1,
+             'devices': ['sdb1', 'sda1']},
+            {'type': 'partition', 'id': 'sda2', 'device': 'sda',
+             'number': 2},
+            {'type': 'partition', 'id': 'sda1', 'device': 'sda',
+             'number': 1},
+            {'type': 'partition', 'id': 'sdb1', 'device': 'sdb',
+             'number': 1},
+            {'type': 'disk', 'id': 'sdb', 'ptable': 'gpt'},
+            {'type': 'disk', 'id': 'sda', 'ptable': 'gpt'},
+        ]
+
+    def test_references(self):
+        graph = self._graph(self.items)
+        self.assertEqual(['sdb1', 'sda1'], graph.references('md0'))
+        self.assertEqual([('volume', 'md0')], graph.edges('md0-fmt'))
+        self.assertEqual([], graph.references('sda'))
+        self.assertEqual(['sda2', 'sda1'], graph.referrers('device', 'sda'))
+
+    def test_closure_matches_config_tree(self):
+        graph = self._graph(self.items)
+        final_config = {'storage': {'config': self.items}}
+        for item in self.items:
+            tree = storage_config.get_config_tree(item['id'], final_config)
+            self.assertEqual(set(tree), graph.closure(item['id']))
+
+    def test_ordered_matches_merged_trees(self):
+        graph = self._graph(self.items)
+        final_config = {'storage': {'config': self.items}}
+        trees = [storage_config.get_config_tree(item['id'], final_config)
+                 for item in self.items]
+        self.assertEqual(
+            storage_config.merge_config_trees_to_list(trees),
+            graph.ordered())
+        self.assertEqual(
+            ['sda', 'sdb', 'sdb1', 'sda1', 'sda2', 'md0', 'md0-fmt'],
+            [cfg['id'] for cfg in graph.ordered()])
+
+    def test_ordered_drops_duplicates(self):
+        graph = self._graph(self.items)
+        with self.assertLogs(SCLogger, level='WARNING'):
+            ordered = graph.ordered(['sda', 'sdb', 'sda'])
+        self.assertEqual(['sda', 'sdb'], [cfg['id'] for cfg in ordered])
+
+    def test_cycle_raises(self):
+        items = [
+            {'type': 'raid', 'id': 'md0', 'raidlevel': 1,
+             'devices': ['md1']},
+            {'type': 'raid', 'id': 'md1', 'raidlevel': 1,
+             'devices': ['md0']},
+        ]
+        graph = self._graph(items)
+        with self.assertRaisesRegex(ValueError, 'md0 -> md1 -> md0'):
+            graph.ordered()
+
+    def test_invalid_dependency_raises(self):
+        items = [{'type': 'partition', 'id': 'sda1', 'device': 'sda9',
+                  'number': 1}]
+        with self.assertRaisesRegex(ValueError, 'sda9'):
+            self._graph(items).ordered()
+        self.assertEqual(['sda1'], [cfg['id'] for cfg in self._graph(
+            items, validate=False).ordered()])
+
+    def test_unknown_types_have_no_references(self):
+        graph = self._graph([{'type': 'image', 'id': 'img0',
+                              'device': 'sda'}], validate=False)
+        self.assertEqual([], graph.references('img0'))
+
+
 class TestBcacheParser(CiTestCase):
 
     def setUp(self):
@@ -0,0 +1,164 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import os
+import socket
+from unittest import mock, skipIf
+
+from curtin import target_executor, util
+from .helpers import CiTestCase
+
+
+class TestMessages(CiTestCase):
+
+    def test_round_trip(self):
+        left, right = socket.socketpair()
+        self.addCleanup(left.close)
+        self.addCleanup(right.close)
+        target_executor.send_message(left, {'args': ['x']}, b'abc', b'')
+        header, blobs = target_executor.recv_message(right)
+        self.assertEqual({'args': ['x']}, header)
+        self.assertEqual([b'abc', b''], blobs)
+
+    def test_closed(self):
+        left, right = socket.socketpair()
+        self.addCleanup(right.close)
+        left.close()
+        with self.assertRaises(EOFError):
+            target_executor.recv_message(right)
+
+    def test_run(self):
+        response, out, err = target_executor._run(
+            {'args': ['sh', '-c', 'cat; echo err >&2; exit 3'],
+             'capture': 'pipe'}, b'in')
+        self.assertEqual((3, b'in', b'err\n'),
+                         (response['rc'], out, err))
+        response, out, err = target_executor._run(
+            {'args': ['sh', '-c', 'echo out; echo err >&2'],
+             'capture': 'combine'}, b'')
+        self.assertEqual((b'out\nerr\n', False),
+                         (out, response['stderr']))
+
+    def test_run_missing_command(self):
+        response, out, err = target_executor._run(
+            {'args': ['/nonexistent/command']}, b'')
+        self.assertNotIn('rc', response)
+        self.assertEqual(os.strerror(2), response['error'])
+
+
+@skipIf(os.geteuid() != 0, 'the executor chroots, which needs root')
+class TestTargetExecutor(CiTestCase):
+
+    def setUp(self):
+        super(TestTargetExecutor, self).setUp()
+        self.executor = target_executor.TargetExecutor('/', []).start()
+        self.addCleanup(self.executor.close)
+
+    def test_run(self):
+        self.assertEqual(
+            (0, b'hi\n', b''),
+            self.executor.run(['echo', 'hi'], env=dict(os.environ),
+                              capture='pipe'))
+        self.assertEqual(
+            (1, None, None), self.executor.run(['false'], env={}))
+
+    def test_missing_command(self):
+        with self.assertRaises(OSError):
+            self.executor.run(['/nonexistent/command'])
+        # the helper keeps running
+        self.assertEqual(0, self.executor.run(['true'])[0])
+
+    def test_closed(self):
+        self.executor.close()
+        with self.assertRaises(OSError):
+            self.executor.run(['true'])
+
+
+class TestSubpWithExecutor(CiTestCase):
+
+    allowed_subp = True
+
+    def setUp(self):
+        super(TestSubpWithExecutor, self).setUp()
+        self.target = self.tmp_dir()
+        self.executor = mock.Mock()
+        self.executor.run.return_value = (0, b'out', b'')
+        self.add_patch('curtin.util._TARGET_EXECUTORS',
+                       new={self.target: self.executor})
+        self.add_patch('curtin.util.subprocess.Popen', 'm_popen')
+        self.add_patch('curtin.util._get_unshare_pid_args', 'm_unshare')
+
+    def test_target_commands_use_executor(self):
+        out, _err = util.subp(['ls', '/'], target=self.target, capture=True)
+        self.assertEqual('out', out)
+        self.assertEqual(0, self.m_popen.call_count)
+        self.assertEqual(0, self.m_unshare.call_count)
+        args, kwargs = self.executor.run.call_args
+        self.assertEqual((['ls', '/'],), args)
+        self.assertEqual('pipe', kwargs['capture'])
+        self.assertEqual('1', kwargs['env']['SYSTEMD_OFFLINE'])
+
+    def test_failure_raises(self):
+        self.executor.run.return_value = (2, b'', b'oops')
+        with self.assertRaises(util.ProcessExecutionError) as cm:
+            util.subp(['ls'], target=self.target, capture=True)
+        self.assertEqual(2, cm.exception.exit_code)
+
+    def test_missing_command_raises(self):
+        self.executor.run.side_effect = OSError(2, 'No such file')
+        with self.assertRaises(util.ProcessExecutionError):
+            util.subp(['ls'], target=self.target)
+
+    def test_explicit_unshare_bypasses_executor(self):
+        self.m_unshare.return_value = []
+        self.m_popen.return_value.communicate.return_value = (None, None)
+        self.m_popen.return_value.returncode = 0
+        util.subp(['ls'], target=self.target, unshare_pid=False)
+        self.assertEqual(0, self.executor.run.call_count)
+        self.assertEqual(1, self.m_popen.call_count)
+
+    def test_other_targets_bypass_executor(self):
+        self.m_unshare.return_value = []
+        self.m_popen.return_value.communicate.return_value = (None, None)
+        self.m_popen.return_value.returncode = 0
+        util.subp(['ls'], target=self.tmp_dir())
+        self.assertEqual(0, self.executor.run.call_count)
+
+
+class TestChrootableTargetExecutor(CiTestCase):
+
+    def setUp(self):
+        super(TestChrootableTargetExecutor, self).setUp()
+        self.target = self.tmp_dir()
+        self.add_patch('curtin.util._TARGET_EXECUTORS', new={})
+        self.add_patch('curtin.util._get_unshare_pid_args',
+                       return_value=['unshare', '--fork', '--pid', '--'])
+        self.add_patch('curtin.util.target_executor.TargetExecutor',
+                       'm_executor')
+        self.add_patch('curtin.util.do_mount', return_value=False)
+        self.add_patch('curtin.util.disable_daemons_in_root')
+        self.add_patch('curtin.util.undisable_daemons_in_root')
+
+    def test_disabled_by_default(self):
+        with util.ChrootableTarget(self.target, mounts=[]):
+            self.assertEqual({}, util._TARGET_EXECUTORS)
+        self.assertEqual(0, self.m_executor.call_count)
+
+    def test_executor_lifetime(self):
+        executor = self.m_executor.return_value.start.return_value
+        with util.ChrootableTarget(self.target, mounts=[], executor=True):
+            self.assertEqual({self.target: executor}, util._TARGET_EXECUTORS)
+            # a nested chroot shares it
+            with util.ChrootableTarget(self.target, mounts=[],
+                                       executor=True):
+                pass
+            self.assertEqual(0, executor.close.call_count)
+        self.assertEqual({}, util._TARGET_EXECUTORS)
+        self.assertEqual(1, self.m_executor.call_count)
+        executor.close.assert_called_once_with()
+
+    def test_start_failure_falls_back(self):
+        self.m_executor.return_value.start.side_effect = OSError('nope')
+        with util.ChrootableTarget(self.target, mounts=[], executor=True):
+            self.assertEqual({}, util._TARGET_EXECUTORS)
+
+# vi: ts=4 expandtab syntax=python
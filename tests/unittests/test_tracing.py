@@ -0,0 +1,157 @@
+# This file is part of curtin. See LICENSE file for copyright and license info.
+
+import os
+from unittest import mock
+
+from curtin import tracing, util
+from curtin.commands import profile
+from curtin.reporter import events
+from .helpers import CiTestCase
+
+
+class TracingTestCase(CiTestCase):
+
+    allowed_subp = ['true', 'echo', 'false']
+
+    def setUp(self):
+        super(TracingTestCase, self).setUp()
+        self.trace = self.tmp_path('trace.json')
+        env = mock.patch.dict(os.environ)
+        env.start()
+        self.addCleanup(env.stop)
+        os.environ.pop('CURTIN_REPORTSTACK', None)
+        tracing.start(self.trace)
+        self.addCleanup(tracing.stop)
+
+    def _events(self, cat=None):
+        return [e for e in tracing.load(self.trace)
+                if cat is None or e.get('cat') == cat]
+
+
+class TestTracing(TracingTestCase):
+
+    def test_disabled(self):
+        tracing.stop()
+        with tracing.span('noop'):
+            pass
+        self.assertEqual([], self._events())
+
+    def test_nested_spans(self):
+        with tracing.span('outer', cat='test'):
+            with tracing.span('inner', cat='test', extra=1):
+                pass
+        inner, outer = self._events()
+        self.assertEqual(('inner', 'X', os.getpid()),
+                         (inner['name'], inner['ph'], inner['pid']))
+        self.assertEqual({'parent': 'outer', 'extra': 1}, inner['args'])
+        self.assertEqual({}, outer['args'])
+        self.assertLessEqual(outer['ts'], inner['ts'])
+        self.assertGreaterEqual(outer['dur'], inner['dur'])
+
+    def test_error_recorded(self):
+        with self.assertRaises(ValueError):
+            with tracing.span('fails'):
+                raise ValueError('bad')
+        self.assertEqual('ValueError', self._events()[0]['args']['error'])
+
+    def test_parent_from_report_stack_env(self):
+        os.environ['CURTIN_REPORTSTACK'] = 'cmd-install/stage-extract'
+        with tracing.span('extract'):
+            pass
+        self.assertEqual('cmd-install/stage-extract',
+                         self._events()[0]['args']['parent'])
+
+    def test_subp_and_report_stack_traced(self):
+        with events.ReportEventStack('stage', 'running',
+                                     reporting_enabled=False):
+            util.subp(['true'])
+            util.subp(['echo', 'secret'], logstring='echo <redacted>')
+        true, echo = self._events('subp')
+        self.assertEqual('true', true['name'])
+        self.assertEqual(['true'], true['args']['cmd'])
+        self.assertEqual('stage', true['args']['parent'])
+        self.assertEqual(('echo', 'echo <redacted>'),
+                         (echo['name'], echo['args']['cmd']))
+        stage, = self._events('report')
+        self.assertEqual('stage', stage['name'])
+
+    def test_name_process(self):
+        tracing.name_process('curtin test')
+        self.assertEqual({'name': 'curtin test'}, self._events()[0]['args'])
+
+    def test_append(self):
+        with tracing.span('first'):
+            pass
+        tracing.start(self.trace, append=True)
+        with tracing.span('second'):
+            pass
+        self.assertEqual(['first', 'second'],
+                         [e['name'] for e in self._events()])
+
+
+class TestSubpProfile(TracingTestCase):
+
+    def setUp(self):
+        super(TestSubpProfile, self).setUp()
+        self.add_patch('curtin.tracing.SUBP_PROFILE', new={})
+        self.add_patch('curtin.util.time.sleep')
+
+    def test_argv_class(self):
+        for cmd, expected in (
+                (['udevadm', 'settle', '--timeout=5'], 'udevadm settle'),
+                (['/sbin/lvm', 'vgs', '-o', 'name'], 'lvm vgs'),
+                (['mkfs.ext4', '-q', '/dev/vda1'], 'mkfs.ext4'),
+                (['wipefs', '/dev/vda'], 'wipefs'),
+                (['env', 'A=b', 'x'], 'env'),
+                ('sh -c true', 'sh'),
+                ([], '')):
+            self.assertEqual(expected, tracing.argv_class(cmd))
+
+    def test_calls_accounted(self):
+        util.subp(['echo', 'hello'], capture=True)
+        util.subp(['false'], rcs=[1])
+        with self.assertRaises(util.ProcessExecutionError):
+            util.subp(['false'], retries=[0, 0])
+        echo = tracing.SUBP_PROFILE['echo hello']
+        self.assertEqual((1, 0, 0, 6), (echo['calls'], echo['failed'],
+                                        echo['retries'], echo['captured']))
+        false = tracing.SUBP_PROFILE['false']
+        self.assertEqual((2, 2, 2), (false['calls'], false['failed'],
+                                     false['retries']))
+        self.assertGreaterEqual(false['seconds'], false['max'])
+        # the trace holds the same figures
+        traced = tracing.subp_profile(self._events())
+        self.assertEqual(sorted(tracing.SUBP_PROFILE), sorted(traced))
+        for cls, entry in traced.items():
+            self.assertEqual(
+                [tracing.SUBP_PROFILE[cls][f] for f in ('calls', 'failed',
+                                                        'captured')],
+                [entry[f] for f in ('calls', 'failed', 'captured')])
+        last = self._events('subp')[-1]
+        self.assertEqual({'rc': 1, 'retries': 2, 'captured': 0},
+                         {k: last['args'][k]
+                          for k in ('rc', 'retries', 'captured')})
+
+    def test_format_profile(self):
+        for seconds in (1.0, 3.0):
+            tracing.account_subp('udevadm settle', seconds, 0, 0, 0)
+        tracing.account_subp('lvm vgs', 0.5, 5, 1, 100)
+        lines = tracing.format_profile(tracing.SUBP_PROFILE).splitlines()
+        self.assertEqual(['command', 'udevadm', 'lvm'],
+                         [line.split()[0] for line in lines])
+        self.assertEqual(['udevadm', 'settle', '2', '4.000', '2.000',
+                          '3.000', '0', '0', '0'], lines[1].split())
+        self.assertEqual(2, len(tracing.format_profile(
+            tracing.SUBP_PROFILE, top=1).splitlines()))
+
+    def test_profile_command(self):
+        util.subp(['true'])
+        args = mock.Mock(trace=self.trace, top=5, config={})
+        with mock.patch('sys.stdout') as m_stdout:
+            with self.assertRaises(SystemExit):
+                profile.profile_main(args)
+        output = ''.join(c[0][0] for c in m_stdout.write.call_args_list)
+        self.assertIn('1 commands ran', output)
+        self.assertIn('\ntrue ', output)
+
+# vi: ts=4 expandtab syntax=python
@@ -5,9 +5,11 @@ import shlex
 
 from curtin.udev import (
         udevadm_info,
+        udevadm_settle,
         shlex_quote,
+        UdevDeviceWaiter,
         )
-from curtin import util
+from curtin import udev, util
 from .helpers import CiTestCase
 
 
@@ -116,3 +118,172 @@ class TestUdevInfo(CiTestCase):
             ['udevadm', 'info', '--query=property', '--export', mypath],
             capture=True)
         self.assertEqual({'SCSI_IDENT_TARGET_VENDOR': 'clusterid=92901'}, info)
+
+
+class TestUdevDeviceWaiter(CiTestCase):
+
+    def setUp(self):
+        super(TestUdevDeviceWaiter, self).setUp()
+        self.add_patch('curtin.udev.os.path.exists', 'm_exists')
+        self.waiter = UdevDeviceWaiter()
+        self.m_monitor = mock.Mock()
+        self.waiter._monitor = self.m_monitor
+        self.waiter._available = True
+
+    def events(self, *events):
+        # the first poll is the drain at the start of the wait
+        self.m_monitor.poll.side_effect = [None] + list(events)
+
+    @staticmethod
+    def event(action, device_node, device_links=()):
+        return mock.Mock(action=action, device_node=device_node,
+                         device_links=list(device_links))
+
+    @mock.patch('curtin.udev.os.geteuid')
+    def test_unavailable_when_not_root(self, m_geteuid):
+        m_geteuid.return_value = 1000
+        waiter = UdevDeviceWaiter()
+        self.assertIsNone(waiter.wait('/dev/sda1'))
+        self.assertFalse(self.m_exists.called)
+
+    @mock.patch('curtin.udev.os.geteuid')
+    def test_unavailable_without_udevd(self, m_geteuid):
+        m_geteuid.return_value = 0
+        self.m_exists.return_value = False
+        waiter = UdevDeviceWaiter()
+        self.assertIsNone(waiter.wait('/dev/sda1'))
+        self.m_exists.assert_called_with(udev.UDEV_CONTROL)
+
+    def test_returns_when_matching_event_arrives(self):
+        self.m_exists.side_effect = [False, False, True]
+        self.events(self.event('add', '/dev/sdb1'),
+                    self.event('add', '/dev/sda1',
+                               ['/dev/disk/by-id/foo-part1']))
+        waited = self.waiter.wait('/dev/disk/by-id/foo-part1')
+        self.assertIsNotNone(waited)
+        self.assertEqual(3, self.m_monitor.poll.call_count)
+        self.assertEqual(mock.call(timeout=0),
+                         self.m_monitor.poll.call_args_list[0])
+
+    def test_rechecks_node_after_matching_event(self):
+        # the add was followed by a remove before the node was checked
+        self.m_exists.side_effect = [False, False, False, True]
+        target = self.event('add', '/dev/sda1')
+        self.events(target, target)
+        self.assertIsNotNone(self.waiter.wait('/dev/sda1'))
+        self.assertEqual(3, self.m_monitor.poll.call_count)
+
+    def test_ignores_remove_events(self):
+        self.m_exists.side_effect = [False, False, True]
+        removed = self.event('remove', '/dev/sda1')
+        self.events(removed, removed)
+        self.assertIsNotNone(self.waiter.wait('/dev/sda1'))
+        self.assertEqual(3, self.m_monitor.poll.call_count)
+        self.assertEqual([mock.call('/dev/sda1')] * 3,
+                         self.m_exists.call_args_list)
+
+    def test_ignores_events_received_before_the_wait(self):
+        # a stale add for a node that is gone is drained, not trusted:
+        # the wait goes on to check the udev queue
+        self.m_exists.side_effect = [False, True, True]
+        stale = self.event('add', '/dev/sda1')
+        self.m_monitor.poll.side_effect = [stale, None, None]
+        self.assertIsNotNone(self.waiter.wait('/dev/sda1'))
+        self.assertEqual([mock.call(timeout=0)] * 2,
+                         self.m_monitor.poll.call_args_list[:2])
+        self.assertEqual(
+            [mock.call('/dev/sda1'), mock.call(udev.UDEV_QUEUE),
+             mock.call('/dev/sda1')], self.m_exists.call_args_list)
+
+    def test_sees_events_received_by_another_waiter(self):
+        self.m_exists.side_effect = [False, True]
+        self.events(None)
+        # another waiter received the event after this one started
+        real_receive = self.waiter._receive
+
+        def receive(monitor, timeout):
+            if timeout:
+                self.waiter._seq += 1
+                self.waiter._events.append(
+                    (self.waiter._seq, 'add', '/dev/sda1', ()))
+                return False
+            return real_receive(monitor, timeout)
+
+        with mock.patch.object(self.waiter, '_receive', side_effect=receive):
+            self.assertIsNotNone(self.waiter.wait('/dev/sda1'))
+
+    def test_gives_up_when_udev_is_idle(self):
+        # target missing, no event and no udev queue
+        self.m_exists.return_value = False
+        self.m_monitor.poll.return_value = None
+        self.assertIsNone(self.waiter.wait('/dev/sda1'))
+        self.assertEqual(2, self.m_monitor.poll.call_count)
+
+    def test_keeps_waiting_while_udev_is_busy(self):
+        # target, queue, target, queue, target
+        self.m_exists.side_effect = [False, True, False, True, True]
+        self.m_monitor.poll.return_value = None
+        self.assertIsNotNone(self.waiter.wait('/dev/sda1'))
+        self.assertEqual(3, self.m_monitor.poll.call_count)
+
+    def test_timeout_returns_none(self):
+        self.m_exists.side_effect = lambda p: p == udev.UDEV_QUEUE
+        self.m_monitor.poll.return_value = None
+        self.assertIsNone(self.waiter.wait('/dev/sda1', timeout=0))
+        self.assertEqual(1, self.m_monitor.poll.call_count)
+
+
+class TestUdevDeviceWaiterDrain(CiTestCase):
+
+    def test_drain_logs_buffered_events(self):
+        waiter = UdevDeviceWaiter()
+        stale = mock.Mock(action='add', device_node='/dev/sda1',
+                          device_links=[])
+        monitor = mock.Mock()
+        monitor.poll.side_effect = [stale, stale, None]
+        self.assertEqual(2, waiter._drain(monitor))
+        self.assertEqual([mock.call(timeout=0)] * 3,
+                         monitor.poll.call_args_list)
+        self.assertEqual(2, len(waiter._events))
+
+    def test_drain_stops_on_receive_error(self):
+        waiter = UdevDeviceWaiter()
+        monitor = mock.Mock()
+        monitor.poll.side_effect = OSError('ENOBUFS')
+        self.assertEqual(0, waiter._drain(monitor))
+        self.assertEqual(1, monitor.poll.call_count)
+
+
+class TestUdevadmSettle(CiTestCase):
+
+    def setUp(self):
+        super(TestUdevadmSettle, self).setUp()
+        self.add_patch('curtin.util.subp', 'm_subp')
+        self.add_patch('curtin.udev.os.path.exists', 'm_exists')
+        self.add_patch('curtin.udev._DEVICE_WAITER.wait', 'm_wait')
+
+    def test_settle_no_exists(self):
+        udevadm_settle()
+        self.m_subp.assert_called_with(['udevadm', 'settle'])
+        self.assertFalse(self.m_wait.called)
+
+    def test_settle_exists_skips_when_present(self):
+        self.m_exists.return_value = True
+        udevadm_settle(exists='/dev/sda1')
+        self.assertFalse(self.m_wait.called)
+        self.assertFalse(self.m_subp.called)
+
+    def test_settle_exists_uses_monitor(self):
+        self.m_exists.return_value = False
+        self.m_wait.return_value = 0.25
+        udevadm_settle(exists='/dev/sda1', timeout=30)
+        self.m_wait.assert_called_with('/dev/sda1', timeout=30)
+        self.assertFalse(self.m_subp.called)
+
+    def test_settle_exists_falls_back_to_udevadm(self):
+        self.m_exists.return_value = False
+        self.m_wait.return_value = None
+        udevadm_settle(exists='/dev/sda1', timeout=30)
+        self.m_subp.assert_called_with(
+            ['udevadm', 'settle', '--exit-if-exists=/dev/sda1',
+             '--timeout=30'])
@@ -1,7 +1,11 @@
 # This file is part of curtin. See LICENSE file for copyright and license info.
 
 import filecmp
+import hashlib
+import http.server
 import json
+import os
+import threading
 from unittest import mock
 
 from curtin import url_helper
@@ -78,6 +82,258 @@ class TestDownload(CiTestCase):
                         "Downloaded file differed from source file.")
 
 
+class _RangeHandler(http.server.BaseHTTPRequestHandler):
+    """serve the server's content with keep-alive and range support"""
+    protocol_version = 'HTTP/1.1'
+    if_range_supported = True
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super(_RangeHandler, self).setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, self.headers.get('Range')))
+        server.headers.append(self.headers)
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/file')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        etag = '"%s"' % server.etag
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        content = server.content
+        start, end = 0, len(content)
+        rng = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if rng and server.ranges and (
+                if_range in (None, etag) or not self.if_range_supported):
+            first, last = rng[len('bytes='):].split('-')
+            start = int(first)
+            if last:
+                end = int(last) + 1
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, end - 1, len(content)))
+        else:
+            self.send_response(200)
+        if server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+        body = content[start:end]
+        if server.fail_after is not None:
+            # drop the connection part way through the transfer
+            self.wfile.write(body[:server.fail_after])
+            server.fail_after = None
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+class TestUrlReaderPooled(CiTestCase):
+
+    def setUp(self):
+        super(TestUrlReaderPooled, self).setUp()
+        self.add_patch('curtin.url_helper.urllib_request.getproxies',
+                       return_value={})
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      _RangeHandler)
+        self.server.content = bytes(range(256)) * 1024
+        self.server.ranges = True
+        self.server.fail_after = None
+        self.server.connections = 0
+        self.server.requests = []
+        self.server.headers = []
+        self.server.etag = 'v1'
+        # dropped connections are expected, do not print them
+        self.server.handle_error = lambda request, address: None
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(url_helper._POOL.clear)
+        self.url = 'http://127.0.0.1:%s/file' % self.server.server_port
+        self.target = self.tmp_path('target', self.tmp_dir())
+
+    def _read(self, reader):
+        with reader:
+            return reader.read(len(self.server.content) * 2)
+
+    def test_range_connection_reused(self):
+        for _ in range(3):
+            self.assertEqual(
+                self.server.content[10:],
+                self._read(url_helper.UrlReader(self.url, offset=10)))
+        self.assertEqual(1, self.server.connections)
+
+    def test_plain_get_not_pooled(self):
+        with mock.patch.object(url_helper._POOL, 'get') as m_get:
+            self.assertEqual(self.server.content,
+                             self._read(url_helper.UrlReader(self.url)))
+        m_get.assert_not_called()
+
+    def test_offset_sends_range_header(self):
+        self.assertEqual(self.server.content[10:],
+                         self._read(url_helper.UrlReader(self.url,
+                                                         offset=10)))
+        self.assertEqual([('/file', 'bytes=10-')], self.server.requests)
+
+    def test_end_sends_bounded_range(self):
+        self.assertEqual(
+            self.server.content[10:20],
+            self._read(url_helper.UrlReader(self.url, offset=10, end=20)))
+        self.assertEqual([('/file', 'bytes=10-19')], self.server.requests)
+
+    def test_range_not_supported(self):
+        self.server.ranges = False
+        with self.assertRaises(url_helper.UrlError) as ctx:
+            url_helper.UrlReader(self.url, offset=10)
+        self.assertEqual(url_helper.RANGE_NOT_SUPPORTED,
+                         ctx.exception.reason)
+
+    def test_range_of_changed_content(self):
+        with self.assertRaises(url_helper.UrlError) as ctx:
+            url_helper.UrlReader(self.url, offset=10, validator='"v0"')
+        self.assertEqual(url_helper.CONTENT_CHANGED, ctx.exception.reason)
+        self.assertEqual('"v0"', self.server.headers[0]['If-Range'])
+
+    def test_range_validator_checked(self):
+        # a server ignoring If-Range still serves the range
+        self.server.etag = 'v2'
+        with mock.patch.object(_RangeHandler, 'if_range_supported', False):
+            with self.assertRaises(url_helper.UrlError) as ctx:
+                url_helper.UrlReader(self.url, offset=10, validator='"v1"')
+        self.assertEqual(url_helper.CONTENT_CHANGED, ctx.exception.reason)
+
+    def test_redirect_followed(self):
+        url = self.url.replace('/file', '/redirect')
+        self.assertEqual(self.server.content[10:],
+                         self._read(url_helper.UrlReader(url, offset=10)))
+        self.assertEqual(['/redirect', '/file'],
+                         [r[0] for r in self.server.requests])
+
+    @mock.patch('curtin.url_helper.time.sleep')
+    def test_download_resumes(self, m_sleep):
+        self.server.fail_after = 1000
+        url_helper.download(self.url, self.target, retries=1)
+        with open(self.target, 'rb') as fp:
+            self.assertEqual(self.server.content, fp.read())
+        self.assertEqual([('/file', None), ('/file', 'bytes=1000-')],
+                         self.server.requests)
+        self.assertEqual('"v1"', self.server.headers[1]['If-Range'])
+
+    @mock.patch('curtin.url_helper.time.sleep')
+    def test_download_restarts_changed_content(self, m_sleep):
+        self.server.fail_after = 1000
+        old_handle = _RangeHandler.do_GET
+
+        def do_GET(handler):
+            # the content changes after the first transfer broke off
+            if len(self.server.requests) == 1:
+                self.server.content = self.server.content[::-1]
+                self.server.etag = 'v2'
+            old_handle(handler)
+        with mock.patch.object(_RangeHandler, 'do_GET', do_GET):
+            url_helper.download(self.url, self.target, retries=1)
+        with open(self.target, 'rb') as fp:
+            self.assertEqual(self.server.content, fp.read())
+        self.assertEqual([('/file', None), ('/file', 'bytes=1000-'),
+                          ('/file', None)], self.server.requests)
+
+    @mock.patch('curtin.url_helper.time.sleep')
+    def test_download_restarts_without_ranges(self, m_sleep):
+        self.server.ranges = False
+        self.server.fail_after = 1000
+        url_helper.download(self.url, self.target, retries=1)
+        with open(self.target, 'rb') as fp:
+            self.assertEqual(self.server.content, fp.read())
+
+    @mock.patch('curtin.url_helper.SPLIT_DOWNLOAD_MIN', 1024)
+    def test_download_split(self):
+        url_helper.download(self.url, self.target, connections=4)
+        with open(self.target, 'rb') as fp:
+            self.assertEqual(self.server.content, fp.read())
+        step = len(self.server.content) // 4
+        self.assertEqual(
+            {None} | {'bytes=%d-%d' % (n * step, (n + 1) * step - 1)
+                      for n in (1, 2, 3)},
+            {r[1] for r in self.server.requests})
+        self.assertEqual(4, len(self.server.requests))
+        self.assertEqual(['"v1"'] * 3,
+                         [h['If-Range'] for h in self.server.headers[1:]])
+
+    @mock.patch('curtin.url_helper.SPLIT_DOWNLOAD_MIN', 1024)
+    @mock.patch('curtin.url_helper.response_validator', return_value=None)
+    def test_download_not_split_without_validator(self, m_validator):
+        url_helper.download(self.url, self.target, connections=4)
+        with open(self.target, 'rb') as fp:
+            self.assertEqual(self.server.content, fp.read())
+        self.assertEqual([('/file', None)], self.server.requests)
+
+    def _cached(self, path):
+        with open(path, 'rb') as fp:
+            return fp.read()
+
+    def test_cache_revalidates(self):
+        cache = url_helper.DownloadCache(self.tmp_dir())
+        path = cache.fetch(self.url)
+        self.assertEqual(self.server.content, self._cached(path))
+        self.assertEqual(path, cache.fetch(self.url))
+        self.assertEqual('"v1"', self.server.headers[1]['If-None-Match'])
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_cache_refetches_changed(self):
+        cache = url_helper.DownloadCache(self.tmp_dir())
+        path = cache.fetch(self.url)
+        self.server.content = b'new content'
+        self.server.etag = 'v2'
+        self.assertEqual(path, cache.fetch(self.url))
+        self.assertEqual(b'new content', self._cached(path))
+        with open(path + cache.META_SUFFIX) as fp:
+            self.assertEqual('"v2"', json.load(fp)['etag'])
+
+    def test_cache_by_sha256(self):
+        cache = url_helper.DownloadCache(self.tmp_dir())
+        sha256 = hashlib.sha256(self.server.content).hexdigest()
+        path = cache.fetch(self.url, sha256=sha256)
+        # the same content at another url is not fetched again
+        other = self.url + '?mirror'
+        self.assertEqual(path, cache.fetch(other, sha256=sha256.upper()))
+        self.assertEqual(1, len(self.server.requests))
+        self.assertEqual(self.server.content, self._cached(path))
+
+    def test_cache_sha256_mismatch(self):
+        cache = url_helper.DownloadCache(self.tmp_dir())
+        with self.assertRaises(ValueError):
+            cache.fetch(self.url, sha256='0' * 64)
+        self.assertEqual([], os.listdir(cache.path))
+
+    def test_cache_evicts_least_recently_used(self):
+        cachedir = self.tmp_dir()
+        size = len(self.server.content)
+        first = url_helper.DownloadCache(cachedir).fetch(self.url + '?1')
+        second = url_helper.DownloadCache(cachedir).fetch(self.url + '?2')
+        os.utime(first, (1, 1))
+        cache = url_helper.DownloadCache(cachedir, max_size=2 * size)
+        third = cache.fetch(self.url + '?3')
+        self.assertFalse(os.path.exists(first))
+        self.assertFalse(os.path.exists(first + cache.META_SUFFIX))
+        self.assertTrue(os.path.exists(second))
+        self.assertTrue(os.path.exists(third))
+
+
 class TestGetMaasVersion(CiTestCase):
     @mock.patch('curtin.url_helper.geturl')
     def test_get_maas_version(self, mock_get_url):
@@ -891,6 +891,74 @@ class TestChrootableTargetResolvConf(CiTestCase):
         self.assertEqual(content, target_conf)
 
 
+class TestChrootableTargetSession(CiTestCase):
+    """Test ChrootableTargets entered in another share its setup"""
+
+    def setUp(self):
+        super(TestChrootableTargetSession, self).setUp()
+        self.target = self.tmp_dir()
+        self.policy = os.path.join(self.target, 'usr/sbin/policy-rc.d')
+        self.mounted = set()
+        self.add_patch('curtin.util.do_mount', 'm_do_mount',
+                       side_effect=self.mymount)
+        self.add_patch('curtin.util.do_umount', 'm_do_umount',
+                       side_effect=self.myumount)
+        self.add_patch('curtin.util.subp', 'm_subp')
+        self.add_patch('curtin.util.is_uefi_bootable', return_value=False)
+        self.add_patch('curtin.util._CHROOT_SESSIONS', new={})
+
+    def mymount(self, src, dst, opts):
+        if dst in self.mounted:
+            return False
+        self.mounted.add(dst)
+        return True
+
+    def myumount(self, mountpoint, private=False):
+        self.mounted.remove(mountpoint)
+
+    def test_nested_reuses_mounts(self):
+        with util.ChrootableTarget(self.target):
+            self.assertEqual(4, self.m_do_mount.call_count)
+            self.assertTrue(os.path.exists(self.policy))
+            with util.ChrootableTarget(self.target) as inner:
+                self.assertEqual([], inner.umounts)
+            self.assertEqual(0, self.m_do_umount.call_count)
+            self.assertEqual(0, self.m_subp.call_count)
+            self.assertTrue(os.path.exists(self.policy))
+        self.assertEqual(set(), self.mounted)
+        self.assertFalse(os.path.exists(self.policy))
+        # a single settle, for unmounting /dev
+        self.assertEqual(1, self.m_subp.call_count)
+        self.assertEqual({}, util._CHROOT_SESSIONS)
+
+    def test_nested_adds_missing_mounts(self):
+        extra = os.path.join(self.target, 'extra')
+        with util.ChrootableTarget(self.target):
+            with util.ChrootableTarget(self.target,
+                                       mounts=['/dev', '/extra']) as inner:
+                self.assertEqual([extra], inner.umounts)
+            self.assertNotIn(extra, self.mounted)
+            self.assertEqual(4, len(self.mounted))
+
+    def test_nested_allow_daemons(self):
+        with util.ChrootableTarget(self.target):
+            with util.ChrootableTarget(self.target, allow_daemons=True):
+                self.assertFalse(os.path.exists(self.policy))
+            self.assertTrue(os.path.exists(self.policy))
+        self.assertFalse(os.path.exists(self.policy))
+        with util.ChrootableTarget(self.target, allow_daemons=True):
+            with util.ChrootableTarget(self.target):
+                self.assertTrue(os.path.exists(self.policy))
+            self.assertFalse(os.path.exists(self.policy))
+
+    def test_consecutive_set_up_again(self):
+        for _ in range(2):
+            with util.ChrootableTarget(self.target):
+                pass
+        self.assertEqual(8, self.m_do_mount.call_count)
+        self.assertEqual(8, self.m_do_umount.call_count)
+
+
 class TestLoadFile(CiTestCase):
     """Test utility 'load_file'"""
 